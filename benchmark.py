@@ -0,0 +1,271 @@
+import argparse
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+from datetime import datetime, timezone
+
+import compaction
+import create_tables
+import etl
+import instrumentation
+import local_engine
+import manifest
+import parquet_staging
+import synthetic_data
+from sql_queries import insert_table_graph
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# A stage is a regression if it is slower than the baseline by more than the
+# threshold ratio and by more than the noise floor in seconds
+REGRESSION_THRESHOLD = 0.20
+NOISE_FLOOR          = 0.005
+
+STAGING_TABLES = ["staging_events", "staging_songs"]
+
+# The prefixes of the prepared copies of the datasets, and the directory of
+# each copy under '<data_dir>/prepared'
+PREPARED_PREFIXES = {"MANIFEST_PREFIX": "manifests",
+                     "COMPACT_PREFIX" : "song_data_compacted",
+                     "PARQUET_PREFIX" : "parquet"}
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def use_local_dataset(data_dir, prepared=False):
+    """
+    Points the settings of this process at a local dataset and at the local
+    backend. The configuration file is left unchanged.
+
+    Args:
+      data_dir (str): the local dataset (see synthetic_data.py).
+      prepared (bool): if True, the options that load a prepared copy of the
+          datasets (manifests, compacted songs, Parquet) are kept as
+          configured, and the copies are written under '<data_dir>/prepared'.
+          Otherwise, the JSON files are loaded directly.
+    """
+    config = get_settings()
+    config.set("ETL", "BACKEND", "duckdb")
+    config.set("LOCAL", "DATA_DIR", data_dir)
+    config.set("S3", "LOG_DATA", "\'{}\'".format(os.path.join(data_dir, "log_data")))
+    config.set("S3", "SONG_DATA", "\'{}\'".format(os.path.join(data_dir, "song_data")))
+    config.set("S3", "LOG_JSONPATH", "\'{}\'".format(os.path.join(data_dir, "log_json_path.json")))
+    for (option, directory) in PREPARED_PREFIXES.items():
+        config.set("ETL", option, "\'{}\'".format(os.path.join(data_dir, "prepared", directory)))
+    if not prepared:
+        for option in ("USE_MANIFEST", "COMPACT_SONGS", "PARQUET_STAGING"):
+            config.set("ETL", option, "0")
+
+
+def prepare_copies():
+    """
+    Writes the copies of the datasets that the COPY commands load instead of
+    the JSON files, if 'COMPACT_SONGS' or 'PARQUET_STAGING' is set. They are
+    prepared offline in a real deployment, so they are timed apart.
+
+    Returns:
+      stages (dict): the duration in seconds of each preparation.
+    """
+    stages = {}
+    if etl.get_parquet_staging():
+        start = time.perf_counter()
+        parquet_staging.convert_staging_data()
+        stages["prepare.parquet"] = time.perf_counter() - start
+    elif etl.get_compact_songs():
+        start = time.perf_counter()
+        compaction.compact_song_data()
+        stages["prepare.compact_songs"] = time.perf_counter() - start
+    return stages
+
+
+def statement_stages(records):
+    """
+    Sums the recorded statements into the steps of the load, e.g. the DELETE
+    and the COPY of 'staging_events' into 'copy.staging_events', and the
+    commits of a stage transaction into 'copy.commit'.
+    """
+    # The statement labels keep the case of the SQL text
+    tables = {name.lower(): name for name in STAGING_TABLES + [node['name'] for node in insert_table_graph]}
+    stages = {}
+    for record in records:
+        if record['stage'] not in ("copy", "insert"):
+            continue
+        step = "commit" if record['name'] == "COMMIT" else record['name'].split()[-1]
+        step = tables.get(step.lower(), step)
+        name = "{}.{}".format(record['stage'], step)
+        seconds = record['wall_s'] or 0
+        if record['name'] != "COMMIT":
+            seconds += record['commit_s'] or 0
+        stages[name] = stages.get(name, 0.0) + seconds
+    return stages
+
+
+def run_pipeline(data_dir, transaction_mode="statement"):
+    """
+    Runs the whole pipeline once on the local backend and times each stage.
+
+    The tables are built and loaded by the functions of create_tables.py and
+    etl.py, so the benchmark measures the load as 'etl.py' runs it under the
+    settings of myDWH.cfg. The statements are timed by the recorder of
+    instrumentation.py.
+
+    Args:
+      data_dir (str): the local dataset (see synthetic_data.py).
+      transaction_mode (str): 'statement' (one commit per statement) or
+          'stage' (one commit per stage), see 'TRANSACTION_MODE'.
+    Returns:
+      A 3-tuple (stages, rows, commits) where 'stages' maps each stage name to
+      its duration in seconds, 'rows' maps each table to its row count and
+      'commits' holds the number of commits and their total latency.
+    """
+    use_local_dataset(data_dir, prepared=True)
+    get_settings().set("ETL", "TRANSACTION_MODE", transaction_mode)
+    for module in (etl, create_tables, instrumentation, compaction, parquet_staging, manifest):
+        module.VERBOSE = 0
+    conn = local_engine.connect(data_dir, ":memory:")
+    cur = conn.cursor()
+    recorder = instrumentation.start_run("benchmark")
+
+    start = time.perf_counter()
+    create_tables.drop_tables(cur, conn)
+    create_tables.create_tables(cur, conn)
+    stages = {"drop_create": time.perf_counter() - start}
+    stages.update(prepare_copies())
+    start = time.perf_counter()
+    ok = etl.load_staging_tables(cur, conn) and etl.insert_tables(cur, conn)
+    load_s = time.perf_counter() - start
+    if not ok:
+        conn.close()
+        raise RuntimeError("The load of \'{}\' failed".format(data_dir))
+    stages.update(statement_stages(recorder.records))
+    stages["total"] = sum(seconds for (name, seconds) in stages.items()
+                          if name == "drop_create" or name.startswith("prepare.")) + load_s
+    (count, seconds) = recorder.commit_stats()
+    # The benchmark runs are kept out of the run history
+    instrumentation.recorder = None
+
+    rows = {}
+    for table in STAGING_TABLES + [node['name'] for node in insert_table_graph]:
+        cur.execute("SELECT COUNT(*) FROM {}".format(table))
+        rows[table] = cur.fetchone()[0]
+    conn.close()
+    return (stages, rows, {"count": count, "seconds": seconds})
+
+
+def run_benchmark(scales, repeat, data_root, seed=42, transaction_mode="statement"):
+    """
+    Times the pipeline across scale factors.
+
+    Args:
+      scales (list): the scale factors to run.
+      repeat (int): the number of runs per scale factor (the median is kept).
+      data_root (str): where the synthetic datasets are generated and reused.
+      seed (int): the seed of the synthetic datasets.
+      transaction_mode (str): 'statement' or 'stage' (see 'run_pipeline()').
+    Returns:
+      results (dict): the machine-readable benchmark results.
+    """
+    results = {"created_at": datetime.now(timezone.utc).isoformat(),
+               "python": platform.python_version(),
+               "duckdb": local_engine.load_duckdb().__version__,
+               "repeat": repeat,
+               "transaction_mode": transaction_mode,
+               "scales": {}}
+    for scale in scales:
+        data_dir = os.path.join(data_root, "sf_{}_seed_{}".format(scale, seed))
+        if not os.path.isdir(data_dir):
+            synthetic_data.generate(data_dir, scale, seed)
+        runs = [run_pipeline(data_dir, transaction_mode) for _ in range(repeat)]
+        stages = {name: statistics.median(run[0][name] for run in runs) for name in runs[0][0]}
+        commits = {"count": runs[-1][2]["count"],
+                   "seconds": statistics.median(run[2]["seconds"] for run in runs)}
+        results["scales"][str(scale)] = {"stages": stages, "rows": runs[-1][1], "commits": commits}
+        if VERBOSE:
+            print("\nSCALE FACTOR {} (median of {} runs, {} commits):".format(scale, repeat, transaction_mode))
+            for (name, seconds) in stages.items():
+                print("\t{:<26} {:9.4f} s".format(name, seconds))
+            print("\t{:<26} {:9d} ({:.4f} s)".format("commits", commits["count"], commits["seconds"]))
+    return results
+
+
+def compare(results, baseline, threshold=REGRESSION_THRESHOLD, noise_floor=NOISE_FLOOR):
+    """
+    Compares benchmark results with a baseline and flags the regressions.
+
+    Args:
+      results (dict): the results returned by 'run_benchmark()'.
+      baseline (dict): results previously saved as the baseline.
+      threshold (float): the tolerated slow-down ratio (0.2 = 20%).
+      noise_floor (float): slow-downs below this many seconds are ignored.
+    Returns:
+      regressions (list): a list of (scale, stage, baseline, current) tuples.
+    """
+    regressions = []
+    print("\nCOMPARISON WITH BASELINE ({} of {}):".format(baseline.get("created_at"), len(baseline.get("scales", {}))))
+    for (scale, current) in results["scales"].items():
+        reference = baseline.get("scales", {}).get(scale)
+        if reference is None:
+            print("\tscale factor {}: no baseline".format(scale))
+            continue
+        for (stage, seconds) in current["stages"].items():
+            before = reference["stages"].get(stage)
+            if before is None:
+                continue
+            ratio = seconds / before if before > 0 else float("inf")
+            flag = ""
+            if ratio > 1 + threshold and seconds - before > noise_floor:
+                regressions.append((scale, stage, before, seconds))
+                flag = "  <-- REGRESSION"
+            print("\tsf={:<6} {:<26} {:9.4f} s -> {:9.4f} s ({:+6.1%}){}".format(
+                scale, stage, before, seconds, ratio - 1, flag))
+        if "commits" in current and "commits" in reference:
+            print("\tsf={:<6} {:<26} {:>9} -> {:>9} ({:.4f} s -> {:.4f} s)".format(
+                scale, "commits", reference["commits"]["count"], current["commits"]["count"],
+                reference["commits"]["seconds"], current["commits"]["seconds"]))
+        for (table, count) in current["rows"].items():
+            if reference.get("rows", {}).get(table, count) != count:
+                print("\tWARNING: sf={} {} has {} rows instead of {}".format(
+                    scale, table, count, reference["rows"][table]))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the ETL pipeline on synthetic data.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 5, 25], help="scale factors")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per scale factor (default=3)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic data")
+    parser.add_argument("--data-root", default=os.path.join(".etl_state", "bench_data"),
+                        help="where the synthetic datasets are generated")
+    parser.add_argument("--output", default="benchmark_results.json", help="results file")
+    parser.add_argument("--baseline", default="benchmark_baseline.json", help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the baseline")
+    parser.add_argument("--transaction-mode", choices=["statement", "stage"], default="statement",
+                        help="commit after each statement or once per stage (default=statement)")
+    parser.add_argument("--threshold", type=float, default=REGRESSION_THRESHOLD,
+                        help="tolerated slow-down ratio (default=0.2)")
+    args = parser.parse_args(argv)
+
+    results = run_benchmark(args.scales, args.repeat, args.data_root, args.seed, args.transaction_mode)
+    with open(args.output, "w") as f:
+        json.dump(results, f, indent=2)
+    print("\nResults written to \'{}\'".format(args.output))
+
+    if args.save_baseline:
+        with open(args.baseline, "w") as f:
+            json.dump(results, f, indent=2)
+        print("Baseline saved to \'{}\'".format(args.baseline))
+    elif os.path.exists(args.baseline):
+        with open(args.baseline) as f:
+            regressions = compare(results, json.load(f), args.threshold)
+        if regressions:
+            print("\nERROR: {} stage(s) regressed by more than {:.0%}".format(len(regressions), args.threshold))
+            sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
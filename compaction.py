@@ -0,0 +1,215 @@
+import gzip
+import itertools
+import json
+import os
+import time
+from multiprocessing import Pool
+
+import s3_utils
+from s3_utils import (get_s3_client, is_s3_uri, iter_objects, list_objects, object_uri, parse_s3_uri,
+                      read_json_records, strip_quotes)
+from settings import get_settings, reset_session
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The file extension and the COPY option of each supported compression
+COMPRESSIONS = {'gzip': ('.json.gz', 'GZIP'),
+                'zstd': ('.json.zst', 'ZSTD')}
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_copy_option(compression):
+    """
+    Returns the COPY option (e.g. 'GZIP') matching a compression name.
+    """
+    return COMPRESSIONS[compression][1]
+
+
+def _init_worker():
+    """
+    Makes each worker process create its own S3 client on first use.
+    """
+    s3_utils.s3 = None
+    reset_session()
+
+
+def read_records(uri):
+    """
+    Reads a source JSON file and re-serializes its records as JSON lines.
+
+    A source file may hold one JSON object, or several objects one after the
+    other (e.g. one per line).
+
+    Args:
+      uri (str): the S3 URI or the local path of the file.
+    Returns:
+      A 2-tuple (lines, count) where 'lines' are the UTF-8 encoded JSON lines
+      and 'count' is the number of records.
+    """
+    lines = [json.dumps(record, separators=(',', ':')) for record in read_json_records(uri)]
+    return (("\n".join(lines) + "\n").encode('utf-8') if lines else b"", len(lines))
+
+
+class BatchWriter:
+    """
+    Writes JSON lines into compressed batch files of a target size.
+
+    A new batch file is started once the current one holds 'target_bytes' of
+    uncompressed data. Batch files for S3 are written to a local temporary
+    file and uploaded when they are closed, so at most one batch is on disk.
+    """
+    def __init__(self, destination, compression='gzip', target_bytes=128 * 1024 * 1024, client=None):
+        if compression not in COMPRESSIONS:
+            raise ValueError("Unsupported compression \'{}\'".format(compression))
+        if compression == 'zstd' and zstandard is None:
+            raise ValueError("The \'zstandard\' package is required for zstd compression")
+        self.destination = strip_quotes(destination).rstrip("/")
+        self.compression = compression
+        self.target_bytes = target_bytes
+        self.client = client
+        self.outputs = []
+        self._index = 0
+        self._file = None
+        self._raw = None
+        self._path = None
+        self._written = 0
+
+    def _open(self):
+        name = "part-{:05d}{}".format(self._index, COMPRESSIONS[self.compression][0])
+        self._index += 1
+        if is_s3_uri(self.destination):
+            self._path = os.path.join(get_settings().get("ETL", "STATE_DIR", fallback=".etl_state"),
+                                      "compaction", name)
+        else:
+            self._path = os.path.join(self.destination, name)
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        if self.compression == 'gzip':
+            self._file = gzip.open(self._path, 'wb')
+        else:
+            self._raw = open(self._path, 'wb')
+            self._file = zstandard.ZstdCompressor(level=3).stream_writer(self._raw)
+        self._written = 0
+
+    def _close(self):
+        if self._file is None:
+            return
+        self._file.close()
+        if self._raw is not None:
+            self._raw.close()
+            self._raw = None
+        self._file = None
+        if is_s3_uri(self.destination):
+            (bucket, prefix) = parse_s3_uri(self.destination)
+            key = "{}/{}".format(prefix, os.path.basename(self._path)) if prefix else os.path.basename(self._path)
+            (self.client or get_s3_client()).upload_file(self._path, bucket, key)
+            os.remove(self._path)
+            self.outputs.append("s3://{}/{}".format(bucket, key))
+        else:
+            self.outputs.append(self._path)
+        if VERBOSE > 1:
+            print("\tWrote {} ({} bytes uncompressed)".format(self.outputs[-1], self._written))
+
+    def write(self, data):
+        """
+        Appends a block of JSON lines, starting a new batch file if needed.
+        """
+        if not data:
+            return
+        if self._file is None:
+            self._open()
+        self._file.write(data)
+        self._written += len(data)
+        if self._written >= self.target_bytes:
+            self._close()
+
+    def close(self):
+        """
+        Flushes and closes the current batch file.
+        """
+        self._close()
+
+
+def clear_destination(destination, client=None):
+    """
+    Deletes the 'part-' files left by a previous run in a destination (a
+    compaction or a Parquet conversion, see parquet_staging.py).
+    """
+    destination = strip_quotes(destination).rstrip("/")
+    if is_s3_uri(destination):
+        (bucket, _) = parse_s3_uri(destination)
+        client = client or get_s3_client()
+        # The trailing '/' keeps the sibling prefixes (e.g. '<table>_old/')
+        for obj in list_objects(destination + "/", client=client):
+            if os.path.basename(obj['Key']).startswith("part-"):
+                client.delete_object(Bucket=bucket, Key=obj['Key'])
+    elif os.path.isdir(destination):
+        for name in os.listdir(destination):
+            if name.startswith("part-"):
+                os.remove(os.path.join(destination, name))
+
+
+def compact(source, destination, compression='gzip', target_mb=128, workers=None,
+            chunk_files=1000, client=None):
+    """
+    Streams the small JSON files of a source prefix into a few large, compressed
+    JSON-lines files.
+
+    The files are read by a pool of worker processes and written in listing
+    order by the calling process. The listing is consumed page by page, in
+    chunks of 'chunk_files' files, so that the memory in use (the listing
+    and the file contents in flight) is bounded by the chunk size, not the
+    number of files.
+
+    Args:
+      source (str): the S3 URI or local directory of the small JSON files.
+      destination (str): the S3 URI or local directory of the batch files.
+      compression (str): 'gzip' or 'zstd'.
+      target_mb (float): the target uncompressed size of a batch file in MB.
+      workers (int): the number of worker processes (default=CPU count).
+      chunk_files (int): the number of files in flight per chunk.
+      client (boto3.client): the S3 client used to list and to upload.
+    Returns:
+      outputs (list): the URIs or paths of the batch files written.
+    """
+    start = time.perf_counter()
+    writer = BatchWriter(destination, compression, int(target_mb * 1024 * 1024), client=client)
+    clear_destination(destination, client=client)
+    uris = (object_uri(source, obj['Key']) for obj in iter_objects(source, client=client, suffix=".json"))
+    (files, records) = (0, 0)
+    with Pool(processes=workers, initializer=_init_worker) as pool:
+        for chunk in iter(lambda: list(itertools.islice(uris, chunk_files)), []):
+            files += len(chunk)
+            for (data, count) in pool.imap(read_records, chunk, chunksize=16):
+                writer.write(data)
+                records += count
+    writer.close()
+    if VERBOSE:
+        print("Compacted {} files ({} records) into {} {} files in {:.2f} s".format(
+            files, records, len(writer.outputs), compression, time.perf_counter() - start))
+    return writer.outputs
+
+
+def compact_song_data():
+    """
+    Compacts the song dataset as configured in the section '[ETL]' of
+    'myDWH.cfg' ('COMPACT_PREFIX', 'COMPACT_FORMAT', 'COMPACT_TARGET_MB' and
+    'COMPACT_WORKERS').
+    """
+    config = get_settings()
+    workers = config.getint("ETL", "COMPACT_WORKERS", fallback=0) or None
+    return compact(config.get("S3", "SONG_DATA"),
+                   config.get("ETL", "COMPACT_PREFIX"),
+                   compression=config.get("ETL", "COMPACT_FORMAT", fallback="gzip").strip().lower(),
+                   target_mb=config.getfloat("ETL", "COMPACT_TARGET_MB", fallback=128),
+                   workers=workers)
+
+
+if __name__ == "__main__":
+    compact_song_data()
@@ -1,11 +1,13 @@
-import boto3
-import configparser
-import pandas as pd
-import psycopg2
 from sql_queries import drop_table_queries
-from sql_queries import create_staging_table_queries, create_star_table_queries
-from create_cluster import get_cluster_role_arn, get_cluster_status, get_aws_region
-from create_cluster import get_db_connect_parms
+from sql_queries import create_star_table_queries
+from projection import create_staging_queries
+from create_cluster import connect_warehouse
+from settings import cluster_cache, print_api_calls, client_error
+from local_engine import get_backend, database_error
+from instrumentation import timed_execute, execute_stage, get_transaction_mode
+from publish import drop_shadow_table_queries
+from journal import RunJournal
+import instrumentation
 
 #  Set verbosity to 0|1|2 (default=0)
 VERBOSE = 2
@@ -22,8 +24,8 @@ def retrieve_endpoint_and_role_arn(cluster_client, cluster_name):
     """
     global VERBOSE
     try:
-        cluster_props = cluster_client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
-    except ClientError as ce:
+        cluster_props = cluster_cache.describe(cluster_client, cluster_name)
+    except client_error() as ce:
         if ce.response['Error']['Code'] == 'ClusterNotFound':
             print("ERROR: The cluster \'%s\' does not exist!" % cluster_name)
         else:
@@ -48,13 +50,17 @@ def drop_tables(cur, conn):
             with the database.
     """
     global VERBOSE
-    for query in drop_table_queries:
+    if get_transaction_mode() == "stage":
+        # All the tables are dropped in one transaction, or none is
+        if not execute_stage(cur, conn, drop_table_queries + drop_shadow_table_queries(), "drop"):
+            quit()
+        return
+    for query in drop_table_queries + drop_shadow_table_queries():
         if VERBOSE > 1:
             print("Execute query: {}".format(query))
         try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
+            timed_execute(cur, conn, query, "drop")
+        except database_error() as e:
             print("Error executing query: {}".format(e))
 
 
@@ -67,47 +73,60 @@ def create_tables(cur, conn):
             with the database.
     """
     global VERBOSE
-    for query in create_staging_table_queries:
+    if get_transaction_mode() == "stage":
+        # All the tables are created in one transaction, or none is
+        if not execute_stage(cur, conn, create_staging_queries() + create_star_table_queries, "create"):
+            quit()
+        return
+    for query in create_staging_queries():
         if VERBOSE > 1:
             print("Execute query: {}".format(query))
         try:    
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
+            timed_execute(cur, conn, query, "create")
+        except database_error() as e:
             print("Error executing query: {}".format(e))
             
     for query in create_star_table_queries:
         if VERBOSE > 1:
             print("Execute query: {}".format(query))
         try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
+            timed_execute(cur, conn, query, "create")
+        except database_error() as e:
             print("Error executing query: {}".format(e))
             quit()
 
-def main():
-    global VERBOSE
-    
-    # Create a connection object to interact with Redshift and a cursor object 
-    # to execute SQL commands on Redshift
-    (dbname, dbuser, dbpassword, dbhost, dbport) = get_db_connect_parms()
-    if get_cluster_status() != 'available':
-        print("You won't be able to connect to cluster because it is not available or it is not created.")
-        quit()
-    conn = psycopg2.connect("dbname={} user={} password={} host={} port={}".format(dbname, dbuser, dbpassword, dbhost, dbport))   
+def build_schema(conn):
+    """Drop and re-create all the tables on an open connection.
+    Parameters:
+        conn (psycopg2.extensions.connection): A ref to a connection object to interact
+            with the database (Redshift or the embedded engine).
+    """
     cur = conn.cursor()
-    
-    # Drop all the tables before starting over
+    instrumentation.start_run("create_tables")
+
+    # Drop all the tables before starting over. The run journal no longer
+    # describes any table.
     drop_tables(cur, conn)
+    RunJournal.discard()
 
     # Create the tables before running the ETL pipeline
     create_tables(cur, conn)
+    instrumentation.end_run()
+
+
+def main():
+    global VERBOSE
+    
+    # Create a connection object to interact with Redshift, or with the
+    # embedded engine if BACKEND = duckdb (see local_engine.py)
+    (conn, _) = connect_warehouse()
+    build_schema(conn)
 
     # Close the connection with the cluster
     conn.close()
+    if VERBOSE > 1 and get_backend() != "duckdb":
+        print_api_calls()
 
 
 if __name__ == "__main__":
     main()
-              
\ No newline at end of file
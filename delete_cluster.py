@@ -1,49 +1,42 @@
-import boto3
-import configparser
-import json
-import pandas as pd
-import time
+import argparse
 from create_cluster import get_cluster_endpoint, get_cluster_name
+from settings import get_settings, get_client
+from provisioning import Provisioner
 
 # #### Set verbosity to 0|1|2 (default=0)
 VERBOSE = 0
 
 
 ################## THIS IS A LINE OF 80 CHARACTERS ############################
-        
-def main():
+
+def teardown(snapshot=False, confirm=True):
+    """
+    Deletes the cluster of 'myDWH.cfg' and its IAM role.
+
+    Args:
+      snapshot (bool): if True, a final snapshot is taken (restorable with
+          'create_cluster.py --restore') and the old ones are pruned.
+      confirm (bool): if True, the deletion must be confirmed interactively.
+    """
     global VERBOSE
 
     # STEP-1:  Load cluster parameters from 'myDWH.cfg'
-    config = configparser.ConfigParser()
-    config.read_file(open('myDWH.cfg'))
-    
-    # Retrieve the USER-related  parameters
-    USR_KEY     = config.get('USR','USR_KEY')
-    USR_SECRET  = config.get('USR','USR_SECRET')
-
-    # Retrieve the AWS-related  parameters
-    AWS_REGION  = config.get('AWS','AWS_REGION')
+    config = get_settings()
 
     # Retrieve the IAM-related parameters
     AWS_ROLE_ARN = config.get("IAM_ROLE", "AWS_ROLE_ARN")
 
-    # STEP-2: Create a client for Redshift and IAM
+    # Retrieve the snapshot retention policy
+    SNAPSHOT_PREFIX       = config.get("CLUSTER", "SNAPSHOT_PREFIX", fallback="sparkify")
+    SNAPSHOT_RETENTION    = config.getint("CLUSTER", "SNAPSHOT_RETENTION", fallback=3)
+    SNAPSHOT_MAX_AGE_DAYS = config.getint("CLUSTER", "SNAPSHOT_MAX_AGE_DAYS", fallback=0)
+
+    # STEP-2: Create a client for Redshift and IAM (from the shared session)
     if VERBOSE > 0:
         print("Create clients for Redshift and IAM")
+    redshift = get_client('redshift')
+    iam      = get_client('iam')
 
-    redshift = boto3.client('redshift',
-                           region_name           = AWS_REGION,
-                           aws_access_key_id     = USR_KEY,
-                           aws_secret_access_key = USR_SECRET
-                           )
-
-    iam = boto3.client('iam',
-                       aws_access_key_id     = USR_KEY,
-                       aws_secret_access_key = USR_SECRET,
-                       region_name           = AWS_REGION
-                      )
-    
     # STEP-3: Clean up the running cluster
     try:
          # Check if cluster exists by trying to retrieve the endpoint address
@@ -51,37 +44,47 @@ def main():
     except Exception as e:
         print("Unexpected error: %s" % e)
         exit()
-    
+
     print("\nWARNING: This is going to delete the Redshift cluster \'{}\' which endpoint addres is \n\t \'{}\'. ".format(get_cluster_name(), dbhost))
-    
-    key = input("\nARE YOU SURE (Y,n): ")
-    if key != 'Y':
-        print("aborting here...")
+
+    if confirm:
+        key = input("\nARE YOU SURE (Y,n): ")
+        if key != 'Y':
+            print("aborting here...")
+            quit()
+
+    # STEP-4: Bye Bye - Here we go and get ride of the cluster, wait for it to
+    #         be deleted (with exponential backoff), then detach the IAM Role
+    #         and Policy (see provisioning.py).
+    #         With 'snapshot', a final snapshot is taken first and the log
+    #         watermark is saved along with it.
+    provisioner = Provisioner(iam, redshift, None, {'CLUSTER_NAME'   : get_cluster_name(),
+                                                    'AWS_ROLE_ARN'   : AWS_ROLE_ARN,
+                                                    'SNAPSHOT_PREFIX': SNAPSHOT_PREFIX})
+    snapshot_id = None
+    if snapshot:
+        from incremental import save_snapshot_watermark, discard_snapshot_watermark
+        snapshot_id = provisioner.new_snapshot_identifier()
+        save_snapshot_watermark(snapshot_id)
+    if not provisioner.teardown(snapshot_id, SNAPSHOT_RETENTION, SNAPSHOT_MAX_AGE_DAYS or None):
+        print("ERROR: The teardown of the cluster failed.")
         quit()
-   
-    # Bye Bye - Here we go and get ride of the cluster... 
-    redshift.delete_cluster( ClusterIdentifier=get_cluster_name(),  SkipFinalClusterSnapshot=True)
- 
-    # STEP-4: Wait for the cluster to be deleted
-    try:
-        while redshift.describe_clusters(ClusterIdentifier=get_cluster_name())['Clusters'][0]['ClusterStatus'] != 'available':
-            print("Cluster is being deleted...")
-            time.sleep(5)
-    except Exception as e:
-        print(e)
+    for pruned in provisioner.context.get('pruned', []):
+        discard_snapshot_watermark(pruned)
     print('Cluster is deleted')
-
-    # STEP-5: Detach the IAM Role and Policy
-    try:
-        iam.detach_role_policy(RoleName=AWS_ROLE_ARN, PolicyArn="arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess")
-        iam.delete_role(RoleName=AWS_ROLE_ARN)
-    except Exception as e:
-        print(e)
-    
+    if snapshot_id:
+        print("\tFinal snapshot \'{}\' taken (restore it with \'python create_cluster.py --restore\').".format(snapshot_id))
     print("DONE: \n\tIAM is detached and Role ARN i sdelete.")
-    
 
-if __name__ == "__main__":
-    main()
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Delete the Redshift cluster of myDWH.cfg.")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="take a final snapshot (restorable with 'create_cluster.py --restore') "
+                             "and prune the old ones")
+    args = parser.parse_args(argv)
+    teardown(args.snapshot)
 
 
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,444 @@
+import argparse
+import re
+import statistics
+import string
+import time
+import zlib
+from collections import Counter
+
+import schema
+from schema import create_table_query, with_distribution
+from encoding_advisor import get_source, sample_records, typed_value
+from manifest import get_slice_count
+from settings import get_settings
+from time_dimension import truncate
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# A dimension up to this many rows is copied on every node (DISTSTYLE ALL)
+ALL_MAX_ROWS = 1000000
+
+# A dist key is rejected when its fullest slice holds more than this times
+# the rows of an average slice
+MAX_SKEW = 1.2
+
+# The prefix of the temporary tables holding the slices of the benchmark
+SLICE_PREFIX = "slice__"
+
+# The characters that 'match_key' (see sql_queries.py) strips from the titles
+# and the artist names: the POSIX classes [:space:] and [:punct:]
+MATCH_KEY_STRIPPED = re.compile("[\\s{}]+".format(re.escape(string.punctuation)))
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def join_graph(tables=None):
+    """
+    Returns the joins of the star schema declared by the 'references' of the
+    columns of schema.py, as a list of (table, column, dimension, key) tuples,
+    e.g. ('factSongPlay', 'user_id', 'dimUser', 'user_id').
+    """
+    joins = []
+    for table in tables or schema.star_tables:
+        for spec in table['columns']:
+            if spec['references']:
+                (dimension, key) = spec['references'].split(".")
+                joins.append((table['name'], spec['name'], dimension, key))
+    return joins
+
+
+def slice_of(value, slices):
+    """
+    Returns the slice a dist key value is hashed to (NULLs all go to one slice).
+    """
+    if value is None:
+        return 0
+    return zlib.crc32(str(value).encode('utf-8')) % slices
+
+
+def slice_rows(frequencies, slices):
+    """
+    Returns the number of rows per slice of a table distributed on a column.
+
+    Args:
+      frequencies (Counter): the number of rows of each value of the column.
+      slices (int): the number of slices.
+    """
+    rows = [0] * slices
+    for (value, count) in frequencies.items():
+        rows[slice_of(value, slices)] += count
+    return rows
+
+
+def skew(rows):
+    """
+    Returns the rows of the fullest slice over the rows of an average slice
+    (1.0 is a perfect balance).
+    """
+    mean = sum(rows) / len(rows) if rows else 0
+    return max(rows) / mean if mean else 1.0
+
+
+def normalized_key(title, artist):
+    """
+    Returns the title and the artist name normalized as by 'match_key' (see
+    sql_queries.py), before hashing: lower-cased and stripped of spaces and
+    punctuation. Returns None if either is missing.
+    """
+    if title is None or artist is None:
+        return None
+    return (MATCH_KEY_STRIPPED.sub("", str(title).lower()), MATCH_KEY_STRIPPED.sub("", str(artist).lower()))
+
+
+def profile_staging(sample_rows=100000, max_files=200):
+    """
+    Derives the size of the star tables and the value frequencies of their
+    join columns from a sample of the staging JSON files. The songplays are
+    matched to the songs on the normalized title and artist name (see
+    'normalized_key()'), as 'songplay_table_insert' matches them on their
+    'match_key'. A key listed under several songs keeps the smallest song id.
+
+    Returns:
+      A 2-tuple (rows, frequencies) where 'rows' is a dict of {table: rows}
+      and 'frequencies' a dict of {(table, column): Counter}. The row counts
+      are extrapolated to the whole dataset.
+    """
+    (events, events_fraction) = sample_records(get_source('staging_events'), sample_rows, max_files)
+    # The songplays only match the sampled songs: the song catalog is read in
+    # full, up to 'sample_rows'
+    (songs, songs_fraction) = sample_records(get_source('staging_songs'), sample_rows)
+    types = {"{}.{}".format(table['name'], spec['name']): spec['type']
+             for table in schema.staging_tables for spec in table['columns']}
+
+    def value(record, source, grain=None):
+        (table, name) = source.split(".")
+        raw = record.get(name)
+        if raw is None:
+            raw = record.get(name.lower())
+        typed = typed_value(raw, types[source])
+        # A time key is the timestamp truncated to the grain of dimTime
+        return truncate(typed, grain) if grain is not None else typed
+
+    catalog = {}
+    for song in sorted(songs, key=lambda song: (song.get('song_id') is None, str(song.get('song_id')))):
+        key = normalized_key(song.get('title'), song.get('artist_name'))
+        if key is not None:
+            catalog.setdefault(key, song)
+    plays = []
+    for event in events:
+        key = normalized_key(event.get('song'), event.get('artist'))
+        if event.get('page') == 'NextSong' and key in catalog:
+            plays.append((event, catalog[key]))
+
+    rows = {}
+    frequencies = {}
+    for (table, column, dimension, key) in join_graph():
+        fact_spec = next(spec for spec in schema.tables[table]['columns'] if spec['name'] == column)
+        source = fact_spec['source']
+        record_index = 0 if source.startswith("staging_events") else 1
+        grain = schema.tables[dimension].get('grain')
+        frequencies[(table, column)] = Counter(value(play[record_index], source, grain) for play in plays)
+        rows[table] = int(len(plays) / events_fraction / songs_fraction)
+        # A dimension holds one row per distinct key of its source
+        dim_spec = next(spec for spec in schema.tables[dimension]['columns'] if spec['name'] == key)
+        records = events if dim_spec['source'].startswith("staging_events") else songs
+        fraction = events_fraction if records is events else songs_fraction
+        keys = Counter(value(record, dim_spec['source'], grain) for record in records)
+        keys.pop(None, None)
+        frequencies[(dimension, key)] = Counter(dict.fromkeys(keys, 1))
+        rows[dimension] = int(len(keys) / fraction)
+    return (rows, frequencies)
+
+
+def profile_warehouse(cur):
+    """
+    Reads the size of the star tables and the value frequencies of their join
+    columns from the loaded tables (Redshift or the local backend).
+
+    Returns:
+      The same 2-tuple (rows, frequencies) as 'profile_staging()'.
+    """
+    rows = {}
+    frequencies = {}
+    for (table, column, dimension, key) in join_graph():
+        for (name, col) in ((table, column), (dimension, key)):
+            if (name, col) in frequencies:
+                continue
+            cur.execute("SELECT {0}, COUNT(*) FROM {1} GROUP BY {0};".format(col, name))
+            frequencies[(name, col)] = Counter(dict(cur.fetchall()))
+            rows[name] = sum(frequencies[(name, col)].values())
+    return (rows, frequencies)
+
+
+def recommend(rows, frequencies, slices, all_max_rows=ALL_MAX_ROWS, max_skew=MAX_SKEW):
+    """
+    Recommends a distribution style for every table of the join graph.
+
+    - A dimension small enough is copied on every node (ALL): its joins then
+      never redistribute rows. A larger one is distributed on its key (KEY),
+      or evenly (EVEN) if the key is skewed.
+    - A fact table is distributed on the join column of its largest KEY
+      dimension, so that this join is collocated, unless the column is
+      skewed. Otherwise it is distributed evenly (EVEN): its joins to ALL
+      dimensions are local anyway.
+    - A table without data is left to Redshift (AUTO).
+
+    Args:
+      rows (dict): the number of rows of each table.
+      frequencies (dict): the Counter of the values of each join column.
+      slices (int): the number of slices of the cluster.
+      all_max_rows (int): the largest dimension distributed with ALL.
+      max_skew (float): the largest acceptable skew of a dist key.
+    Returns:
+      A 2-tuple (plan, skews) where 'plan' is a dict of {table: (diststyle,
+      distkey, reason)} and 'skews' a dict of {(table, column): skew}.
+    """
+    skews = {pair: skew(slice_rows(counts, slices)) for (pair, counts) in frequencies.items()}
+    joins = join_graph()
+    plan = {}
+    for dimension in sorted({join[2] for join in joins}):
+        key = next(join[3] for join in joins if join[2] == dimension)
+        if not rows.get(dimension):
+            plan[dimension] = ("AUTO", None, "no data")
+        elif rows[dimension] <= all_max_rows:
+            plan[dimension] = ("ALL", None, "{} rows <= {}".format(rows[dimension], all_max_rows))
+        elif skews[(dimension, key)] <= max_skew:
+            plan[dimension] = ("KEY", key, "{} rows, skew {:.2f}".format(rows[dimension], skews[(dimension, key)]))
+        else:
+            plan[dimension] = ("EVEN", None, "key \'{}\' skewed ({:.2f})".format(key, skews[(dimension, key)]))
+    for table in sorted({join[0] for join in joins}):
+        if not rows.get(table):
+            plan[table] = ("AUTO", None, "no data")
+            continue
+        candidates = [(rows[dimension], column) for (fact, column, dimension, key) in joins
+                      if fact == table and plan[dimension][:2] == ("KEY", key)]
+        accepted = sorted(candidate for candidate in candidates if skews[(table, candidate[1])] <= max_skew)
+        if accepted:
+            column = accepted[-1][1]
+            plan[table] = ("KEY", column, "collocated join, skew {:.2f}".format(skews[(table, column)]))
+        elif candidates:
+            plan[table] = ("EVEN", None, "join keys skewed")
+        else:
+            plan[table] = ("EVEN", None, "all its dimensions are ALL")
+    return (plan, skews)
+
+
+def current_plan():
+    """
+    Returns the distribution of the star tables declared in schema.py, in
+    the shape of the plan of 'recommend()'.
+    """
+    plan = {}
+    for table in schema.star_tables:
+        distkey = next((spec['name'] for spec in table['columns'] if spec['distkey']), None)
+        plan[table['name']] = (table.get('diststyle') or "AUTO", distkey, "schema.py")
+    return plan
+
+
+def planned_schema(plan):
+    """
+    Returns copies of the star table specs of schema.py distributed as planned.
+    """
+    return [with_distribution(table, *plan[table['name']][:2]) if table['name'] in plan else table
+            for table in schema.star_tables]
+
+
+def print_plan(rows, plan, skews, slices, max_skew=MAX_SKEW):
+    """
+    Prints the skew of every candidate dist key and the recommended
+    distribution of every table.
+    """
+    print("DIST KEY SKEW ({} slices, fullest slice / average slice):".format(slices))
+    for ((table, column), value) in sorted(skews.items()):
+        print("\t{:<14} {:<12} {:6.2f}{}".format(table, column, value, "  (skewed)" if value > max_skew else ""))
+    print("DISTRIBUTION PLAN:")
+    current = current_plan()
+    for (table, (diststyle, distkey, reason)) in sorted(plan.items()):
+        layout = "KEY({})".format(distkey) if diststyle == "KEY" else diststyle
+        (was_style, was_key, _) = current.get(table, ("AUTO", None, None))
+        was = "KEY({})".format(was_key) if was_style == "KEY" else was_style
+        print("\t{:<14} {:>10} rows  {:<18} (was {:<18}) {}".format(table, rows.get(table, 0), layout, was, reason))
+
+
+#===========================================================
+# LOCAL BENCHMARK
+#
+# DuckDB has no slices: each layout is simulated by splitting
+# the star tables into one table per slice (hashed on the dist
+# key, round-robin for EVEN, a single full copy for ALL). Each
+# star join then runs slice by slice as Redshift would: on the
+# local rows when the join is collocated, or after moving the
+# rows of a side to the slice of their join key otherwise. A
+# query lasts as long as its slowest slice.
+#===========================================================
+
+def _partition_predicate(diststyle, distkey, slices, index):
+    if diststyle == "KEY":
+        return "hash({}) % {} = {}".format(distkey, slices, index)
+    return "rowid % {} = {}".format(slices, index)
+
+
+def build_slices(conn, plan, rows, slices, all_max_rows=ALL_MAX_ROWS):
+    """
+    Splits the star tables into per-slice tables following a plan. AUTO is
+    taken as ALL for a small table and EVEN otherwise, as Redshift does.
+
+    Returns:
+      A dict of {table: diststyle, distkey} with AUTO resolved.
+    """
+    layout = {}
+    cur = conn.cursor()
+    for (table, (diststyle, distkey, _)) in plan.items():
+        if diststyle == "AUTO":
+            diststyle = "ALL" if rows.get(table, 0) <= all_max_rows else "EVEN"
+        layout[table] = (diststyle, distkey)
+        for index in range(slices):
+            cur.execute("DROP TABLE IF EXISTS {}{}_{};".format(SLICE_PREFIX, table, index))
+            if diststyle != "ALL":
+                cur.execute("CREATE TABLE {}{}_{} AS SELECT * FROM {} WHERE {};".format(
+                    SLICE_PREFIX, table, index, table, _partition_predicate(diststyle, distkey, slices, index)))
+    conn.commit()
+    return layout
+
+
+def drop_slices(conn, plan, slices):
+    cur = conn.cursor()
+    for table in plan:
+        for index in range(slices):
+            cur.execute("DROP TABLE IF EXISTS {}{}_{};".format(SLICE_PREFIX, table, index))
+    conn.commit()
+
+
+def slice_join_query(join, layout, slices, index):
+    """
+    Returns the query of a star join on one slice, and the side(s) whose rows
+    are moved to the slice of their join key ('none', 'fact', 'dimension' or
+    'both').
+    """
+    (table, column, dimension, key) = join
+    (fact_style, fact_key) = layout[table]
+    (dim_style, dim_key) = layout[dimension]
+    fact_local = "{}{}_{}".format(SLICE_PREFIX, table, index) if fact_style != "ALL" else table
+    dim_local = "{}{}_{}".format(SLICE_PREFIX, dimension, index) if dim_style != "ALL" else dimension
+    if dim_style == "ALL" or (fact_style == "KEY" and fact_key == column and dim_style == "KEY" and dim_key == key):
+        (fact_rows, dim_rows, moved) = (fact_local, dim_local, "none")
+    elif dim_style == "KEY" and dim_key == key:
+        (fact_rows, dim_rows, moved) = ("(SELECT * FROM {} WHERE hash({}) % {} = {})".format(
+            table, column, slices, index), dim_local, "fact")
+    elif fact_style == "KEY" and fact_key == column:
+        (fact_rows, dim_rows, moved) = (fact_local, "(SELECT * FROM {} WHERE hash({}) % {} = {})".format(
+            dimension, key, slices, index), "dimension")
+    else:
+        (fact_rows, dim_rows, moved) = (
+            "(SELECT * FROM {} WHERE hash({}) % {} = {})".format(table, column, slices, index),
+            "(SELECT * FROM {} WHERE hash({}) % {} = {})".format(dimension, key, slices, index), "both")
+    query = "SELECT COUNT(*), COUNT(DISTINCT f.{}) FROM {} f JOIN {} d ON f.{} = d.{};".format(
+        column, fact_rows, dim_rows, column, key)
+    return (query, moved)
+
+
+def benchmark_layouts(conn, layouts, rows, slices, repeat=3):
+    """
+    Times the star joins under each layout on the local backend.
+
+    Args:
+      conn (local_engine.LocalConnection): the local database with the star
+          tables loaded.
+      layouts (dict): a dict of {name: plan} (see 'recommend()').
+      rows (dict): the number of rows of each table.
+      slices (int): the number of simulated slices.
+      repeat (int): the number of runs of each query (the median is kept).
+    Returns:
+      A dict of {layout: {join: {'slowest_s', 'total_s', 'moved'}}}.
+    """
+    results = {}
+    cur = conn.cursor()
+    nodes = get_settings().getint("CLUSTER", "CLUSTER_NODE_COUNT", fallback=1)
+    for (name, plan) in layouts.items():
+        layout = build_slices(conn, plan, rows, slices)
+        stored = sum(rows.get(table, 0) * (nodes if diststyle == "ALL" else 1)
+                     for (table, (diststyle, _)) in layout.items())
+        results[name] = {'stored_rows': stored, 'joins': {}}
+        for join in join_graph():
+            runs = []
+            for _ in range(repeat):
+                times = []
+                for index in range(slices):
+                    (query, moved) = slice_join_query(join, layout, slices, index)
+                    start = time.perf_counter()
+                    cur.execute(query)
+                    cur.fetchall()
+                    times.append(time.perf_counter() - start)
+                runs.append((max(times), sum(times)))
+            moved_rows = {'none': 0, 'fact': rows.get(join[0], 0), 'dimension': rows.get(join[2], 0),
+                          'both': rows.get(join[0], 0) + rows.get(join[2], 0)}[moved]
+            results[name]['joins']["{}.{}".format(join[0], join[1])] = {
+                'slowest_s': statistics.median(run[0] for run in runs),
+                'total_s': statistics.median(run[1] for run in runs),
+                'moved': moved, 'moved_rows': moved_rows}
+        drop_slices(conn, plan, slices)
+    return results
+
+
+def print_benchmark(results, slices):
+    print("STAR JOIN BENCHMARK ({} simulated slices, local backend):".format(slices))
+    for (name, result) in results.items():
+        print("\n\t{} (stored rows incl. ALL copies: {}):".format(name, result['stored_rows']))
+        print("\t\t{:<24} {:>10} {:>10} {:>10} {:>10}".format("join", "slowest s", "total s", "moved", "moved rows"))
+        for (join, timing) in result['joins'].items():
+            print("\t\t{:<24} {:10.4f} {:10.4f} {:>10} {:>10}".format(
+                join, timing['slowest_s'], timing['total_s'], timing['moved'], timing['moved_rows']))
+        print("\t\t{:<24} {:10.4f}".format("all joins", sum(t['slowest_s'] for t in result['joins'].values())))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Plan the distribution styles of the star tables.")
+    parser.add_argument("command", choices=["plan", "benchmark"],
+                        help="recommend a distribution per table, or time the star joins under each layout locally")
+    parser.add_argument("--source", choices=["staging", "warehouse"], default="staging",
+                        help="profile the staging JSON files or the loaded star tables (default=staging)")
+    parser.add_argument("--slices", type=int, default=None,
+                        help="number of slices (default=derived from the node type and count of myDWH.cfg)")
+    parser.add_argument("--sample", type=int, default=100000, help="rows sampled per staging table")
+    parser.add_argument("--all-max-rows", type=int, default=ALL_MAX_ROWS,
+                        help="largest dimension distributed with ALL (default={})".format(ALL_MAX_ROWS))
+    parser.add_argument("--max-skew", type=float, default=MAX_SKEW,
+                        help="largest acceptable dist key skew (default={})".format(MAX_SKEW))
+    parser.add_argument("--ddl", action="store_true", help="plan: print the CREATE TABLE statements of the plan")
+    parser.add_argument("--repeat", type=int, default=3, help="benchmark: runs per query (median kept)")
+    args = parser.parse_args(argv)
+    slices = args.slices or get_slice_count()
+
+    if args.command == "benchmark":
+        # The local database loaded by 'create_tables.py' and 'etl.py'
+        import local_engine
+        conn = local_engine.connect()
+        (rows, frequencies) = profile_warehouse(conn.cursor())
+        (plan, _) = recommend(rows, frequencies, slices, args.all_max_rows, args.max_skew)
+        # Every table on its join key regardless of size and skew
+        (keys, _) = recommend(rows, frequencies, slices, 0, float("inf"))
+        layouts = {'schema.py': current_plan(), 'recommended': plan, 'all KEY': keys,
+                   'all EVEN': {table: ("EVEN", None, None) for table in plan}}
+        results = benchmark_layouts(conn, layouts, rows, slices, args.repeat)
+        conn.close()
+        print_benchmark(results, slices)
+        return
+
+    if args.source == "warehouse":
+        from create_cluster import connect_warehouse
+        (conn, _) = connect_warehouse()
+        (rows, frequencies) = profile_warehouse(conn.cursor())
+        conn.close()
+    else:
+        (rows, frequencies) = profile_staging(args.sample)
+    (plan, skews) = recommend(rows, frequencies, slices, args.all_max_rows, args.max_skew)
+    print_plan(rows, plan, skews, slices, args.max_skew)
+    if args.ddl:
+        print()
+        for table in planned_schema(plan):
+            print(create_table_query(table))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,416 @@
+import argparse
+import re
+import zlib
+from datetime import datetime, timezone
+from decimal import Decimal
+
+import schema
+from schema import create_table_query
+from s3_utils import list_objects, object_uri, read_json_records
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The source of each staging table: the [S3] option of its JSON files
+STAGING_SOURCES = {'staging_events': 'LOG_DATA',
+                   'staging_songs' : 'SONG_DATA'}
+
+# The candidate encodings of the strings, and of the numbers and timestamps
+# (AZ64 is designed for the latter and is preferred to ZSTD for them)
+STRING_ENCODINGS = ["BYTEDICT", "RUNLENGTH", "ZSTD"]
+NUMBER_ENCODINGS = ["AZ64", "RUNLENGTH"]
+
+# At most this many distinct values fit in a BYTEDICT dictionary
+BYTEDICT_MAX_VALUES = 256
+
+# The stored width in bytes of the fixed-size types
+FIXED_WIDTHS = {'SMALLINT': 2, 'INTEGER': 4, 'BIGINT': 8, 'DECIMAL': 8,
+                'TIMESTAMP': 8, 'DATE': 4, 'REAL': 4, 'DOUBLE': 8, 'BOOLEAN': 1}
+
+# A VARCHAR is sized to the longest sampled value times this headroom,
+# rounded up to a power of 2
+VARCHAR_HEADROOM = 1.5
+VARCHAR_MAX      = 65535
+VARCHAR_DEFAULT  = 256   # The length of a VARCHAR declared without one
+
+# A Redshift block, the unit of STV_BLOCKLIST
+BLOCK_BYTES = 1024 * 1024
+
+TYPE_PATTERN = re.compile(r"^(\w+)(?:\((\d+)(?:,\s*(\d+))?\))?$")
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def parse_type(sql_type):
+    """
+    Splits a SQL type into its base type and its length or precision, e.g.
+    'VARCHAR(18)' becomes ('VARCHAR', 18) and 'VARCHAR' becomes ('VARCHAR', None).
+    """
+    match = TYPE_PATTERN.match(sql_type.strip().upper())
+    return (match.group(1), int(match.group(2)) if match.group(2) else None)
+
+
+def is_string(sql_type):
+    return parse_type(sql_type)[0] in ("VARCHAR", "CHAR", "TEXT")
+
+
+def varchar_length(max_bytes, declared=None):
+    """
+    Returns the right-sized length of a VARCHAR column: the longest sampled
+    value with some headroom, rounded up to a power of 2. A declared length
+    that already fits the sample is kept if it is smaller.
+    """
+    length = 16
+    while length < max_bytes * VARCHAR_HEADROOM and length < VARCHAR_MAX:
+        length *= 2
+    length = min(length, VARCHAR_MAX)
+    if declared is not None and max_bytes <= declared:
+        return min(length, declared)
+    return length
+
+
+class ColumnProfile:
+    """
+    The statistics of the sampled values of a column, in load order, and the
+    estimated storage of each candidate encoding.
+
+    The estimates are approximations computed in Python: zlib stands in for
+    ZSTD, and AZ64 is approximated by compressing the deltas of the values
+    packed on their minimal width.
+    """
+    def __init__(self, sql_type):
+        (self.base_type, self.length) = parse_type(sql_type)
+        self.values = []
+
+    def add(self, value):
+        self.values.append(value)
+
+    @property
+    def count(self):
+        return len(self.values)
+
+    @property
+    def distinct(self):
+        return len(set(self.values))
+
+    @property
+    def runs(self):
+        return sum(1 for (i, value) in enumerate(self.values) if i == 0 or value != self.values[i - 1])
+
+    @property
+    def max_bytes(self):
+        return max((len(self._encode(value)) for value in self.values if value is not None), default=0)
+
+    def _encode(self, value):
+        if value is None:
+            return b""
+        if isinstance(value, str):
+            return value.encode('utf-8')
+        return str(value).encode('utf-8')
+
+    def _width(self, value):
+        """
+        The stored size of a value without compression.
+        """
+        if self.base_type == "VARCHAR" or self.base_type == "TEXT":
+            return len(self._encode(value)) + 4
+        if self.base_type == "CHAR":
+            return self.length or 1
+        return FIXED_WIDTHS.get(self.base_type, 8)
+
+    def _as_integer(self, value):
+        if value is None:
+            return 0
+        if isinstance(value, datetime):
+            return int(value.timestamp() * 1000000)
+        if isinstance(value, Decimal) or isinstance(value, float):
+            return int(Decimal(str(value)) * 1000000)
+        return int(value)
+
+    def estimate(self, encoding):
+        """
+        Returns the estimated bytes of the sampled values stored with an
+        encoding, or None if the encoding does not apply to the column.
+        """
+        if not self.values:
+            return 0
+        raw = sum(self._width(value) for value in self.values)
+        if encoding == "RAW":
+            return raw
+        if encoding == "ZSTD":
+            return len(zlib.compress(b"\x00".join(self._encode(value) for value in self.values), 6))
+        if encoding == "BYTEDICT":
+            if is_string(self.base_type) and self.distinct <= BYTEDICT_MAX_VALUES:
+                return self.count + sum(self._width(value) for value in set(self.values))
+            return None
+        if encoding == "RUNLENGTH":
+            return self.runs * (raw // self.count + 1)
+        if encoding == "AZ64":
+            if is_string(self.base_type):
+                return None
+            integers = [self._as_integer(value) for value in self.values]
+            deltas = [integers[0]] + [b - a for (a, b) in zip(integers, integers[1:])]
+            width = max(1, (max(abs(delta) for delta in deltas).bit_length() + 8) // 8)
+            packed = b"".join(delta.to_bytes(width, 'little', signed=True) for delta in deltas)
+            return len(zlib.compress(packed, 1))
+        raise ValueError("Unknown encoding \'{}\'".format(encoding))
+
+    def advise(self, sortkey=False):
+        """
+        Returns a 2-tuple (encoding, bytes) with the smallest estimated
+        encoding among the candidates of the column type. A sort key column
+        stays RAW.
+        """
+        if sortkey:
+            return ("RAW", self.estimate("RAW"))
+        candidates = STRING_ENCODINGS if is_string(self.base_type) else NUMBER_ENCODINGS
+        estimates = [(self.estimate(encoding), encoding) for encoding in candidates]
+        (size, encoding) = min(estimate for estimate in estimates if estimate[0] is not None)
+        return (encoding, size)
+
+
+def typed_value(value, sql_type):
+    """
+    Types a JSON value as COPY loads it into a column (e.g. '' becomes NULL
+    and the 'ts' epoch in milliseconds becomes a TIMESTAMP).
+    """
+    if value is None or value == "":
+        return None
+    base_type = parse_type(sql_type)[0]
+    try:
+        if base_type in ("INTEGER", "SMALLINT", "BIGINT"):
+            return int(value)
+        if base_type in ("DECIMAL", "REAL", "DOUBLE"):
+            return Decimal(str(value))
+        if base_type == "TIMESTAMP":
+            return datetime.fromtimestamp(int(value) / 1000, tz=timezone.utc)
+    except (TypeError, ValueError, ArithmeticError):
+        return None
+    return str(value)
+
+
+def get_source(table):
+    """
+    Returns the location of the JSON files of a staging table: the local
+    mirror of the bucket on the local backend, the S3 prefix otherwise.
+    """
+    uri = get_settings().get("S3", STAGING_SOURCES[table])
+    from local_engine import get_backend
+    if get_backend() == "duckdb":
+        from local_engine import LocalEngine
+        return LocalEngine(get_settings().get("LOCAL", "DATA_DIR", fallback="data")).local_path(uri)
+    return uri
+
+
+def sample_records(source, sample_rows, max_files=None):
+    """
+    Reads the JSON records of a sample of files spread evenly over a source
+    prefix.
+
+    Returns:
+      A 2-tuple (records, fraction) where 'fraction' is the share of the
+      files that were read (used to extrapolate to the whole dataset).
+    """
+    objects = list_objects(source, suffix=".json")
+    if not objects:
+        return ([], 1.0)
+    # Read every n-th file so that the sample covers the whole key range
+    step = max(1, len(objects) // max_files) if max_files else 1
+    records = []
+    read = 0
+    for obj in objects[::step]:
+        records.extend(read_json_records(object_uri(source, obj['Key'])))
+        read += 1
+        if len(records) >= sample_rows:
+            break
+    return (records[:sample_rows], read / len(objects))
+
+
+def profile_staging(sample_rows=100000, max_files=200):
+    """
+    Profiles a sample of the JSON files of each staging table.
+
+    Returns:
+      A 2-tuple (profiles, scale) where 'profiles' is a dict of
+      {'table.column': ColumnProfile} and 'scale' a dict of {table: factor}
+      that extrapolates the sampled rows to the whole dataset.
+    """
+    profiles = {}
+    scale = {}
+    for table in schema.staging_tables:
+        (records, fraction) = sample_records(get_source(table['name']), sample_rows, max_files)
+        scale[table['name']] = 1 / fraction
+        for spec in table['columns']:
+            profile = ColumnProfile(spec['type'])
+            for record in records:
+                value = record.get(spec['name'])
+                if value is None:
+                    value = record.get(spec['name'].lower())
+                profile.add(typed_value(value, spec['type']))
+            profiles["{}.{}".format(table['name'], spec['name'])] = profile
+        if VERBOSE:
+            print("Sampled {} rows of \'{}\' ({:.1%} of the files)".format(len(records), table['name'], fraction))
+    return (profiles, scale)
+
+
+def advise_local(sample_rows=100000, max_files=200):
+    """
+    Proposes an encoding and a type for every column from a sample of the
+    JSON files. A star column is profiled through the staging column it is
+    loaded from ('source' in schema.py); a derived column (e.g. 'dimTime.hour')
+    keeps its declared encoding.
+
+    Returns:
+      A dict of {table: [proposal]} where a proposal is a dict with the keys
+      'column', 'type', 'proposed_type', 'encode', 'proposed_encode',
+      'raw_bytes' and 'encoded_bytes' (None when not estimated). The bytes
+      are extrapolated to the whole dataset.
+    """
+    (profiles, scale) = profile_staging(sample_rows, max_files)
+    advice = {}
+    for table in schema.staging_tables + schema.star_tables:
+        proposals = []
+        for spec in table['columns']:
+            source = "{}.{}".format(table['name'], spec['name']) if table in schema.staging_tables else spec['source']
+            proposal = {'column': spec['name'], 'type': spec['type'], 'proposed_type': spec['type'],
+                        'encode': spec['encode'], 'proposed_encode': spec['encode'],
+                        'raw_bytes': None, 'encoded_bytes': None}
+            profile = profiles.get(source)
+            if profile is not None:
+                factor = scale[source.split(".")[0]]
+                (encoding, size) = profile.advise(spec['sortkey'])
+                proposal['proposed_encode'] = encoding
+                proposal['raw_bytes'] = int(profile.estimate("RAW") * factor)
+                proposal['encoded_bytes'] = int(size * factor)
+                (base_type, length) = parse_type(spec['type'])
+                if base_type == "VARCHAR":
+                    proposal['proposed_type'] = "VARCHAR({})".format(
+                        varchar_length(profile.max_bytes, length or VARCHAR_DEFAULT))
+            proposals.append(proposal)
+        advice[table['name']] = proposals
+    return advice
+
+
+def advise_cluster(cur, conn):
+    """
+    Proposes an encoding and a type for every column from the tables loaded
+    on the cluster: the encodings and the estimated reductions of
+    'ANALYZE COMPRESSION', the column sizes of STV_BLOCKLIST and the longest
+    values of the VARCHAR columns.
+
+    Returns:
+      The same dict as 'advise_local()'. The bytes are those of the blocks
+      currently stored.
+    """
+    advice = {}
+    autocommit = conn.autocommit
+    # ANALYZE COMPRESSION cannot run inside a transaction block
+    conn.autocommit = True
+    try:
+        for table in schema.staging_tables + schema.star_tables:
+            cur.execute("ANALYZE COMPRESSION {};".format(table['name']))
+            analyzed = {row[1].lower(): (row[2].upper(), float(row[3] or 0)) for row in cur.fetchall()}
+            cur.execute("SELECT b.col, COUNT(*) FROM stv_blocklist b JOIN stv_tbl_perm p "
+                        "ON b.tbl = p.id AND b.slice = p.slice WHERE p.name = %s GROUP BY b.col;",
+                        (table['name'].lower(),))
+            blocks = dict(cur.fetchall())
+            varchars = [spec['name'] for spec in table['columns'] if parse_type(spec['type'])[0] == "VARCHAR"]
+            lengths = {}
+            if varchars:
+                cur.execute("SELECT {} FROM {};".format(
+                    ", ".join("MAX(OCTET_LENGTH({}))".format(name) for name in varchars), table['name']))
+                lengths = dict(zip(varchars, cur.fetchone()))
+            proposals = []
+            for (position, spec) in enumerate(table['columns']):
+                (encoding, reduction) = analyzed.get(spec['name'].lower(), (spec['encode'], 0.0))
+                if spec['sortkey']:
+                    (encoding, reduction) = ("RAW", 0.0)
+                stored = blocks.get(position, 0) * BLOCK_BYTES
+                (base_type, length) = parse_type(spec['type'])
+                proposed_type = spec['type']
+                if base_type == "VARCHAR" and lengths.get(spec['name']) is not None:
+                    proposed_type = "VARCHAR({})".format(
+                        varchar_length(lengths[spec['name']], length or VARCHAR_DEFAULT))
+                proposals.append({'column': spec['name'], 'type': spec['type'], 'proposed_type': proposed_type,
+                                  'encode': spec['encode'], 'proposed_encode': encoding,
+                                  'raw_bytes': stored, 'encoded_bytes': int(stored * (1 - reduction / 100))})
+            advice[table['name']] = proposals
+    finally:
+        conn.autocommit = autocommit
+    return advice
+
+
+def print_report(advice):
+    """
+    Prints the proposal of every column and the bytes saved per table.
+    """
+    total_saved = 0
+    for (table, proposals) in advice.items():
+        print("\n{}:".format(table))
+        print("\t{:<18} {:<14} {:<14} {:<9} {:<9} {:>12} {:>12}".format(
+            "column", "type", "proposed", "encode", "proposed", "raw MB", "encoded MB"))
+        (raw, encoded) = (0, 0)
+        for proposal in proposals:
+            estimated = proposal['raw_bytes'] is not None
+            if estimated:
+                raw += proposal['raw_bytes']
+                encoded += proposal['encoded_bytes']
+            print("\t{:<18} {:<14} {:<14} {:<9} {:<9} {:>12} {:>12}".format(
+                proposal['column'], proposal['type'], proposal['proposed_type'],
+                proposal['encode'], proposal['proposed_encode'],
+                "{:.2f}".format(proposal['raw_bytes'] / 1e6) if estimated else "-",
+                "{:.2f}".format(proposal['encoded_bytes'] / 1e6) if estimated else "-"))
+        total_saved += raw - encoded
+        print("\t=> {:.2f} MB saved of {:.2f} MB ({:.0%})".format(
+            (raw - encoded) / 1e6, raw / 1e6, (raw - encoded) / raw if raw else 0))
+    print("\nTOTAL: {:.2f} MB saved".format(total_saved / 1e6))
+
+
+def proposed_schema(advice):
+    """
+    Returns copies of the table specs of schema.py with the proposed types
+    and encodings applied.
+    """
+    tables = []
+    for table in schema.staging_tables + schema.star_tables:
+        proposals = {proposal['column']: proposal for proposal in advice.get(table['name'], [])}
+        columns = []
+        for spec in table['columns']:
+            proposal = proposals.get(spec['name'])
+            if proposal is not None:
+                spec = dict(spec, type=proposal['proposed_type'], encode=proposal['proposed_encode'])
+            columns.append(spec)
+        tables.append(dict(table, columns=columns))
+    return tables
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Propose the column encodings and VARCHAR lengths of the tables.")
+    parser.add_argument("--cluster", action="store_true",
+                        help="use ANALYZE COMPRESSION on the loaded tables instead of profiling the JSON files")
+    parser.add_argument("--sample", type=int, default=100000, help="rows sampled per staging table")
+    parser.add_argument("--max-files", type=int, default=200, help="files sampled per staging table")
+    parser.add_argument("--ddl", action="store_true", help="print the CREATE TABLE statements with the proposals")
+    args = parser.parse_args(argv)
+
+    if args.cluster:
+        from create_cluster import connect_warehouse
+        (conn, dsn) = connect_warehouse()
+        if dsn is None:
+            print("ERROR: ANALYZE COMPRESSION is not supported by the local backend.")
+            conn.close()
+            quit()
+        advice = advise_cluster(conn.cursor(), conn)
+        conn.close()
+    else:
+        advice = advise_local(args.sample, args.max_files)
+    print_report(advice)
+    if args.ddl:
+        print()
+        for table in proposed_schema(advice):
+            print(create_table_query(table))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,42 +1,200 @@
-import configparser
-import psycopg2
-from sql_queries import copy_table_queries, insert_table_queries
-from create_cluster import get_cluster_role_arn, get_cluster_status, get_aws_region
+import argparse
+import time
+from concurrent.futures import ThreadPoolExecutor
+from sql_queries import copy_table_queries, copy_manifest_queries, insert_table_graph
+from sql_queries import staging_songs_copy_compacted, copy_parquet_queries, create_star_table_queries
+from create_cluster import get_cluster_role_arn, get_aws_region
 
-from create_cluster import get_db_connect_parms
+from create_cluster import connect_warehouse
+from scheduler import run_dag, print_plan, build_dag, topological_waves
+from settings import get_settings, print_api_calls
+from incremental import load_incremental, list_log_files, record_full_load
+from manifest import prepare_manifests
+from compaction import get_copy_option
+from local_engine import get_backend, LocalEngine, database_error
+from instrumentation import timed_execute, execute_stage, get_transaction_mode
+from publish import get_publish_mode, prepare_shadow_tables, shadow_graph, publish
+from maintenance import get_maintenance, maintain
+from s3_utils import strip_quotes
+from projection import get_log_jsonpath
+from inventory import use_inventory, get_listing, record_loaded, source_uri
+from journal import RunJournal, fingerprint, config_fingerprint, listing_fingerprint, get_target
+import journal
+import instrumentation
 
 #  Set verbosity to 0|1|2 (default=0)
 VERBOSE = 2
 
+# The settings that change what the COPY commands load (see the run journal)
+COPY_OPTIONS = [("S3", "LOG_DATA"), ("S3", "SONG_DATA"), ("S3", "LOG_JSONPATH"),
+                ("ETL", "BACKEND"), ("ETL", "USE_MANIFEST"), ("ETL", "COMPACT_SONGS"),
+                ("ETL", "COMPACT_PREFIX"), ("ETL", "COMPACT_FORMAT"), ("ETL", "PARQUET_STAGING"),
+                ("ETL", "PARQUET_PREFIX"), ("ETL", "PROJECT_STAGING"), ("ETL", "PROJECTION_PREFIX")]
+
 def get_log_data_path():
     """
     Returns the path to the LOG data set as a string.
     """
-    config = configparser.ConfigParser()
-    config.read('myDWH.cfg')
-    return config.get("S3","LOG_DATA")
+    return get_settings().get("S3","LOG_DATA")
 
 def get_song_data_path():
     """
     Returns the path to the SONG data set as a string.
     """
-    config = configparser.ConfigParser()
-    config.read('myDWH.cfg')
-    return config.get("S3","SONG_DATA")
+    return get_settings().get("S3","SONG_DATA")
 
 def get_log_json_path():
     """
-    Returns the path to the LOG JSON metadata as a string.
+    Returns the path to the LOG JSON metadata as a string: the generated
+    jsonpaths file of the trimmed 'staging_events' (see projection.py) if
+    'PROJECT_STAGING' is set, 'LOG_JSONPATH' otherwise.
+    """
+    return get_log_jsonpath()
+
+def get_parallel_copy():
+    """
+    Returns True if the staging COPY commands must run in parallel.
+    """
+    return get_settings().getboolean("ETL","PARALLEL_COPY", fallback=False)
+
+def get_copy_concurrency():
+    """
+    Returns the maximum number of COPY commands to run at the same time.
+    """
+    return max(1, get_settings().getint("ETL","COPY_CONCURRENCY", fallback=1))
+
+def get_parallel_insert():
+    """
+    Returns True if the INSERT queries must be scheduled as a parallel DAG.
+    """
+    return get_settings().getboolean("ETL","PARALLEL_INSERT", fallback=False)
+
+def get_insert_concurrency():
+    """
+    Returns the maximum number of INSERT queries to run at the same time.
+    """
+    return max(1, get_settings().getint("ETL","INSERT_CONCURRENCY", fallback=1))
+
+def get_use_manifest():
+    """
+    Returns True if the staging COPY commands must load from manifests.
+    """
+    return get_settings().getboolean("ETL","USE_MANIFEST", fallback=False)
+
+def get_compact_songs():
+    """
+    Returns True if the song dataset must be loaded from its compacted copy.
+    """
+    return get_settings().getboolean("ETL","COMPACT_SONGS", fallback=False)
+
+def get_parquet_staging():
     """
-    config = configparser.ConfigParser()
-    config.read('myDWH.cfg')
-    return config.get("S3","LOG_JSONPATH")
+    Returns True if the staging tables must be loaded from Parquet files.
+    """
+    return get_settings().getboolean("ETL","PARQUET_STAGING", fallback=False)
+
+def get_load_mode():
+    """
+    Returns the default load mode as a string: 'full' or 'incremental'.
+    """
+    return get_settings().get("ETL","LOAD_MODE", fallback="full").strip().lower()
 
 
-def load_staging_tables(cur, conn):
+def get_role_arn():
+    """
+    Returns the IAM role ARN used by the COPY queries. The local backend
+    does not use any role.
+    """
+    if get_backend() == "duckdb":
+        return "local"
+    return get_cluster_role_arn()
+
+
+def get_staging_table_name(query):
+    """
+    Returns the name of the staging table targeted by a COPY query or None.
+    """
+    for table in ("staging_events", "staging_songs"):
+        if table in query:
+            return table
+    return None
+
+
+def format_copy_query(query, manifests=None):
+    """
+    Fills in a COPY query template with the S3 paths, the cluster role ARN
+    and the AWS region (see myDWH.cfg).
+    
+    Args:
+      query (str): one of the templates defined in 'copy_table_queries'.
+      manifests (dict): optional map of staging table names to manifest URIs
+          (see manifest.py). When set, the 'MANIFEST' variant of the template
+          is used and the data is loaded from the files of the manifest.
+          When 'PARQUET_STAGING' is set, both datasets are loaded from their
+          Parquet copies (see parquet_staging.py). Otherwise, when
+          'COMPACT_SONGS' is set, the song dataset is loaded from its
+          compacted copy (see compaction.py).
+    Returns:
+      query (str): the COPY query ready to be executed.
+    """
+    table = get_staging_table_name(query)
+    if table is None:
+        print("ERROR: Badly formatted query: \'{}\' ".format(query))
+        print("\tExpecting the query to contain the sting \'staging_events\' or \'staging_songs\'!")
+        quit()
+    if get_parquet_staging():
+        prefix = get_settings().get("ETL","PARQUET_PREFIX").strip().strip("\'").rstrip("/")
+        return copy_parquet_queries[table].format("\'{}/{}/\'".format(prefix, table), get_role_arn())
+    if table == "staging_songs" and get_compact_songs():
+        config = get_settings()
+        compression = config.get("ETL","COMPACT_FORMAT", fallback="gzip").strip().lower()
+        return staging_songs_copy_compacted.format(config.get("ETL","COMPACT_PREFIX"), get_role_arn(),
+                                                   get_aws_region(), get_copy_option(compression))
+    if manifests is not None:
+        query = copy_manifest_queries[table]
+        source = "\'{}\'".format(manifests[table])
+    elif table == "staging_events":
+        source = get_log_data_path()
+    else:
+        source = get_song_data_path()
+    if table == "staging_events":
+        query = query.format(source, get_role_arn(), get_aws_region(), get_log_json_path())
+    else:
+        query = query.format(source, get_role_arn(), get_aws_region())
+    return query
+
+
+def get_copy_source(table):
+    """
+    Returns the S3 prefix (or local directory) of the files loaded into a
+    staging table, following the same settings as 'format_copy_query()'.
+    """
+    config = get_settings()
+    if get_parquet_staging():
+        uri = "{}/{}/".format(strip_quotes(config.get("ETL","PARQUET_PREFIX")).rstrip("/"), table)
+    elif table == "staging_songs" and get_compact_songs():
+        uri = strip_quotes(config.get("ETL","COMPACT_PREFIX"))
+    else:
+        uri = strip_quotes(get_log_data_path() if table == "staging_events" else get_song_data_path())
+    if get_backend() == "duckdb":
+        # The local backend loads the local mirror of the bucket
+        return LocalEngine(strip_quotes(config.get("LOCAL","DATA_DIR", fallback="data"))).local_path(uri)
+    return uri
+
+
+def copy_jobs(manifests=None):
+    """
+    Returns the COPY commands of the staging tables as a list of
+    (table, query) tuples (see 'format_copy_query()').
+    """
+    return [(get_staging_table_name(query), format_copy_query(query, manifests)) for query in copy_table_queries]
+
+
+def load_staging_tables(cur, conn, jobs=None, journal=None):
     """
     Loads the stagging tables by copying the data from a specified S3 bucket
-    into the stagging tables defined by the 'copy_table_queries' list.
+    into the stagging tables defined by the 'copy_table_queries' list. Each
+    table is emptied before its COPY, so that a COPY can be run again.
     
     Args:
       cur (psycopg2.extensions.cursor): 
@@ -44,28 +202,125 @@ def load_staging_tables(cur, conn):
           database.
       conn (psycopg2.extensions.connection):
           A ref to a connection object to interact with the database.
+      jobs (list): the (table, query) COPY commands to run (see 'copy_jobs()').
+          Defaults to all of them.
+      journal (journal.RunJournal): if set, each completed COPY is recorded
+          as the step 'copy.<table>'.
+    Returns:
+      True if all the COPY commands succeeded, False otherwise.
     """
-    for query in copy_table_queries:
-        if "staging_events" in query:
-            query = query.format(get_log_data_path(), get_cluster_role_arn(), get_aws_region(), get_log_json_path())
-        elif "staging_songs" in query:
-            query = query.format(get_song_data_path(), get_cluster_role_arn(), get_aws_region())
-        else:
-            print("ERROR: Badly formatted query: \'{}\' ".format(query))
-            print("\tExpecting the query to contain the sting \'staging_events\' or \'staging_songs\'!")
-            quit()
+    if jobs is None:
+        jobs = copy_jobs(prepare_manifests() if get_use_manifest() else None)
+    if get_transaction_mode() == "stage":
+        queries = ["DELETE FROM {};".format(table) for (table, _) in jobs] + [query for (_, query) in jobs]
+        ok = execute_stage(cur, conn, queries, "copy")
+        if ok and journal is not None:
+            for (table, _) in jobs:
+                journal.mark_done("copy." + table)
+        return ok
+    ok = True
+    for (table, query) in jobs:
         if VERBOSE:
             print("The following COPY query is going to be issued:" + query)
         try:  
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
+            timed_execute(cur, conn, "DELETE FROM {};".format(table), "copy")
+            timed_execute(cur, conn, query, "copy")
+        except database_error() as e:
+            # End the aborted transaction, so that the next COPY can run
+            conn.rollback()
             print("Error executing query: {}".format(e))
+            ok = False
+            continue
+        if journal is not None:
+            journal.mark_done("copy." + table)
+    return ok
+
+
+def _run_query(pool, table, query, stage, clear=()):
+    """
+    Executes and commits a single query on a connection borrowed from a pool.
+    
+    Args:
+      pool (psycopg2.pool.ThreadedConnectionPool): the pool to borrow from.
+      table (str): the name of the table being loaded.
+      query (str): the query to execute.
+      stage (str): the stage of the pipeline the query belongs to.
+      clear (list): the tables to empty before the query.
+    Returns:
+      A 3-tuple (table, elapsed, error) where 'elapsed' is the duration of
+      the query in seconds and 'error' is None or the raised database error.
+    """
+    conn = pool.getconn()
+    start = time.perf_counter()
+    try:
+        with conn.cursor() as cur:
+            for name in clear:
+                timed_execute(cur, conn, "DELETE FROM {};".format(name), stage)
+            timed_execute(cur, conn, query, stage)
+    except database_error() as e:
+        conn.rollback()
+        return (table, time.perf_counter() - start, e)
+    finally:
+        pool.putconn(conn)
+    return (table, time.perf_counter() - start, None)
+
+
+def load_staging_tables_parallel(dsn, max_workers, jobs=None, journal=None):
+    """
+    Loads the stagging tables by running the COPY queries of the
+    'copy_table_queries' list concurrently, each one on its own connection.
+    Each table is emptied before its COPY.
+    
+    Args:
+      dsn (str): the connection string of the Redshift database.
+      max_workers (int): the maximum number of COPY queries running at the
+          same time (see 'COPY_CONCURRENCY' in myDWH.cfg).
+      jobs (list): the (table, query) COPY commands to run (see 'copy_jobs()').
+          Defaults to all of them.
+      journal (journal.RunJournal): if set, each completed COPY is recorded
+          as the step 'copy.<table>'.
+    Returns:
+      True if all the COPY queries succeeded, False otherwise.
+    """
+    # Format the queries up-front; this talks to the Redshift API and is
+    # better kept out of the worker threads.
+    if jobs is None:
+        jobs = copy_jobs(prepare_manifests() if get_use_manifest() else None)
+    max_workers = max(1, min(max_workers, len(jobs)))
+    if VERBOSE:
+        print("Running {} COPY queries with a concurrency of {}".format(len(jobs), max_workers))
+        
+    import psycopg2.pool
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers, dsn)
+    start = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(_run_query, pool, table, query, "copy", [table]) for (table, query) in jobs]
+            results = [f.result() for f in futures]
+    finally:
+        pool.closeall()
+    elapsed = time.perf_counter() - start
+    
+    failed = False
+    for (table, duration, error) in results:
+        if error is None:
+            print("\tCOPY {:<16} {:8.2f} s".format(table, duration))
+            if journal is not None:
+                journal.mark_done("copy." + table)
+        else:
+            failed = True
+            print("\tCOPY {:<16} FAILED after {:.2f} s: {}".format(table, duration, error))
+    print("Staging stage completed in {:.2f} s".format(elapsed))
+    if failed:
+        print("ERROR: At least one COPY query failed. The staging tables are incomplete!")
+    return not failed
         
         
-def insert_tables(cur, conn):
+def insert_tables(cur, conn, nodes=insert_table_graph, journal=None):
     """
     Loads the analytics star tables by inserting data from the staging tables.
+    The nodes run serially in the order of the graph. Each table is emptied
+    before its INSERT, and the nodes downstream of a failed node are skipped.
     
     Args:
       cur (psycopg2.extensions.cursor): 
@@ -73,37 +328,322 @@ def insert_tables(cur, conn):
           database.
       conn (psycopg2.extensions.connection):
           A ref to a connection object to interact with the database.
+      nodes (list): the nodes of the INSERT graph (default='insert_table_graph').
+      journal (journal.RunJournal): if set, each completed node is recorded
+          as the step 'insert.<name>'.
+    Returns:
+      True if all the INSERT queries succeeded, False otherwise.
     """
-    for query in insert_table_queries:
+    if get_transaction_mode() == "stage":
+        queries = ["DELETE FROM {};".format(table) for node in nodes for table in node['writes']]
+        ok = execute_stage(cur, conn, queries + [node['query'] for node in nodes], "insert")
+        if ok and journal is not None:
+            for node in nodes:
+                journal.mark_done("insert." + node['name'])
+        return ok
+    deps = build_dag(nodes)
+    failed = set()
+    for node in nodes:
+        if deps[node['name']] & failed:
+            print("WARNING: Skipped because of a failed upstream query: {}".format(node['name']))
+            failed.add(node['name'])
+            continue
         if VERBOSE:
-            print("The following INSERT query is going to be issued:" + query)
+            print("The following INSERT query is going to be issued:" + node['query'])
         try:
-            cur.execute(query)
-            conn.commit()
-        except psycopg2.Error as e:
+            for table in node['writes']:
+                timed_execute(cur, conn, "DELETE FROM {};".format(table), "insert")
+            timed_execute(cur, conn, node['query'], "insert")
+        except database_error() as e:
+            # End the aborted transaction, so that the next nodes can run
+            conn.rollback()
             print("Error executing query: {}".format(e))
+            failed.add(node['name'])
+            continue
+        if journal is not None:
+            journal.mark_done("insert." + node['name'])
+    return not failed
+
+
+def insert_tables_parallel(dsn, max_workers, dry_run=False, graph=insert_table_graph, journal=None):
+    """
+    Loads the analytics star tables by scheduling the queries declared in
+    'insert_table_graph' as a DAG. Independent queries run concurrently on
+    separate connections and a query starts as soon as its inputs are loaded.
+    
+    Args:
+      dsn (str): the connection string of the Redshift database.
+      max_workers (int): the maximum number of INSERT queries running at the
+          same time (see 'INSERT_CONCURRENCY' in myDWH.cfg).
+      dry_run (bool): if True, only print the plan and the critical path.
+      graph (list): the query graph (default='insert_table_graph').
+      journal (journal.RunJournal): if set, each completed node is recorded
+          as the step 'insert.<name>'.
+    Returns:
+      True if all the INSERT queries succeeded, False otherwise.
+    """
+    if VERBOSE or dry_run:
+        print_plan(graph, max_workers)
+    if dry_run:
+        return True
+    
+    import psycopg2.pool
+    pool = psycopg2.pool.ThreadedConnectionPool(1, max_workers, dsn)
+    
+    def execute(node):
+        if VERBOSE > 1:
+            print("The following INSERT query is going to be issued:" + node['query'])
+        (_, _, error) = _run_query(pool, node['name'], node['query'], "insert", node['writes'])
+        if error is not None:
+            raise error
+        if journal is not None:
+            journal.mark_done("insert." + node['name'])
+        
+    start = time.perf_counter()
+    try:
+        (ok, _) = run_dag(graph, execute, max_workers)
+    finally:
+        pool.closeall()
+    print("Insert stage completed in {:.2f} s".format(time.perf_counter() - start))
+    if not ok:
+        print("ERROR: At least one INSERT query failed. The star tables are incomplete!")
+    return ok
             
 
+def source_listing(table, listings):
+    """
+    Returns the listing of the JSON dataset of a staging table. Each dataset
+    is listed once per run: the fingerprints of the run journal, the COPY
+    manifests and the watermark share its listing.
+
+    Args:
+      table (str): 'staging_events' or 'staging_songs'.
+      listings (dict): the listings of the run, by staging table name.
+    Returns:
+      objects (list): the listing (see 'inventory.get_listing()').
+    """
+    if table not in listings:
+        if table == "staging_events":
+            listings[table] = list_log_files()
+        else:
+            listings[table] = get_listing(source_uri("SONG_DATA"), suffix=".json")
+    return listings[table]
+
+
+def full_load_steps(jobs, graph, shadow, listings=None):
+    """
+    Lists the steps of a full load with the fingerprint of their inputs (see
+    journal.py), in execution order:
+      - 'copy.<table>': the settings of the COPY, its SQL text and the
+        listing of the files it loads (keys, ETags and sizes),
+      - 'shadow.prepare': the DDL of the shadow tables (shadow mode only),
+      - 'insert.<name>': the SQL text of the node and the fingerprints of
+        its upstream steps, so that a changed input invalidates every step
+        downstream of it,
+      - 'publish': the fingerprints of the INSERT steps (shadow mode only).
+
+    Args:
+      jobs (list): the (table, query) COPY commands (see 'copy_jobs()').
+      graph (list): the INSERT graph.
+      shadow (bool): True if the star tables are built as shadow copies.
+      listings (dict): the listings of the run (see 'source_listing()').
+    Returns:
+      steps (list): dicts with the keys 'name', 'fingerprint' and 'upstream'.
+    """
+    listings = {} if listings is None else listings
+    steps = []
+    config = config_fingerprint(COPY_OPTIONS)
+    writers = {}
+    for (table, query) in jobs:
+        # The Parquet and the compacted copies are not listings of the dataset
+        prepared = get_parquet_staging() or (table == "staging_songs" and get_compact_songs())
+        objects = None if prepared else source_listing(table, listings)
+        steps.append({'name': "copy." + table, 'upstream': [],
+                      'fingerprint': fingerprint(config, query, listing_fingerprint(get_copy_source(table), objects))})
+        writers[table.lower()] = "copy." + table
+    if shadow:
+        steps.append({'name': "shadow.prepare", 'upstream': [], 'fingerprint': fingerprint(create_star_table_queries)})
+    fingerprints = {step['name']: step['fingerprint'] for step in steps}
+    deps = build_dag(graph)
+    nodes = {node['name']: node for node in graph}
+    for wave in topological_waves(deps):
+        for name in wave:
+            node = nodes[name]
+            upstream = sorted({writers[table.lower()] for table in node['reads'] if table.lower() in writers} |
+                              {"insert." + other for other in deps[name]})
+            if shadow:
+                upstream.append("shadow.prepare")
+            step = {'name': "insert." + name, 'upstream': upstream,
+                    'fingerprint': fingerprint(node['query'], [fingerprints[other] for other in upstream])}
+            fingerprints[step['name']] = step['fingerprint']
+            steps.append(step)
+    if shadow:
+        upstream = ["insert." + node['name'] for node in graph]
+        steps.append({'name': "publish", 'upstream': upstream,
+                      'fingerprint': fingerprint([fingerprints[other] for other in upstream])})
+    return steps
+
+
+def load_full(dsn, cur, conn, resume=False, listings=None):
+    """
+    Loads the whole datasets into the staging tables and then inserts them
+    into the star tables (full rebuild).
+
+    With 'TRANSACTION_MODE = stage', each stage runs in a single transaction
+    on 'conn' (the parallel COPY and INSERT modes are then not used).
+
+    With 'PUBLISH_MODE = shadow', the star tables are built into shadow
+    copies while the live tables stay readable, and are then swapped in all
+    at once (see publish.py).
+
+    Each step (a COPY, an INSERT) empties the table it loads first, so that
+    'create_tables.py' need not be run before each load, and is recorded in
+    the run journal with the fingerprint of its inputs (see journal.py). With
+    'resume', the steps that completed with unchanged inputs are skipped, so
+    that the load restarts at its first incomplete step.
+    
+    Args:
+      dsn (str): the connection string of the Redshift database or None for
+          the local backend, in which case the stages run serially.
+      cur (psycopg2.extensions.cursor): a cursor on the connection 'conn'.
+      conn (psycopg2.extensions.connection): a connection to the database.
+      resume (bool): if True, resume the last full load.
+      listings (dict): the listings of the run (see 'source_listing()').
+    Returns:
+      False if a failure was detected, True otherwise.
+    """
+    listings = {} if listings is None else listings
+    shadow = get_publish_mode() == "shadow"
+    graph = shadow_graph() if shadow else insert_table_graph
+    manifests = None
+    if get_use_manifest():
+        manifests = prepare_manifests(listings={table: source_listing(table, listings)
+                                                for table in ("staging_events", "staging_songs")})
+    jobs = copy_jobs(manifests)
+    steps = full_load_steps(jobs, graph, shadow, listings)
+    run_journal = RunJournal.load() if resume else RunJournal.start()
+    run = run_journal.plan(steps, resume)
+    if resume and VERBOSE:
+        journal.print_plan(steps, run)
+    if not run:
+        print("Nothing to resume: every step completed with unchanged inputs.")
+        run_journal.finish(True)
+        return True
+
+    if shadow and "shadow.prepare" in run:
+        if not prepare_shadow_tables(cur, conn):
+            run_journal.finish(False)
+            return False
+        run_journal.mark_done("shadow.prepare")
+    # A stage can only be a single transaction on a single connection
+    parallel = dsn is not None and get_transaction_mode() != "stage"
+    jobs = [(table, query) for (table, query) in jobs if "copy." + table in run]
+    if jobs:
+        if parallel and get_parallel_copy():
+            ok = load_staging_tables_parallel(dsn, get_copy_concurrency(), jobs, run_journal)
+        else:
+            ok = load_staging_tables(cur, conn, jobs, run_journal)
+        if not ok:
+            run_journal.finish(False)
+            return False
+    # The skipped nodes are left out of the graph, along with the logical
+    # dependencies on them
+    nodes = [dict(node, after=[name for name in node.get('after', []) if "insert." + name in run])
+             for node in graph if "insert." + node['name'] in run]
+    ok = True
+    if nodes and parallel and get_parallel_insert():
+        ok = insert_tables_parallel(dsn, get_insert_concurrency(), graph=nodes, journal=run_journal)
+    elif nodes:
+        ok = insert_tables(cur, conn, nodes, run_journal)
+    if shadow and not ok:
+        print("ERROR: The shadow tables are incomplete and were not published. The live tables are unchanged.")
+    elif shadow and "publish" in run:
+        ok = publish(cur, conn)
+        if ok:
+            # The shadow tables are now the live ones: the next load rebuilds
+            # them from the staging tables
+            run_journal.forget([step['name'] for step in steps if not step['name'].startswith("copy.")])
+    run_journal.finish(ok)
+    return ok
+
+
 ################## THIS IS A LINE OF 80 CHARACTERS ############################
         
-def main():
-    global VERBOSE
-       
-    # Create a connection object to interact with Redshift and a cursor object 
-    # to execute SQL commands on Redshift
-    (dbname, dbuser, dbpassword, dbhost, dbport) = get_db_connect_parms()
-    if get_cluster_status() != 'available':
-        print("You won't be able to connect to cluster because it is not available or it is not created.")
-        quit()
-    conn = psycopg2.connect("dbname={} user={} password={} host={} port={}".format(dbname, dbuser, dbpassword, dbhost, dbport))   
+def run(conn, dsn, load_mode, resume=False):
+    """
+    Loads the star tables on an open connection.
+
+    Args:
+      conn (psycopg2.extensions.connection): a connection to the warehouse.
+      dsn (str): the connection string used by the parallel stages, or None
+          on the local backend (the whole load then runs on 'conn').
+      load_mode (str): 'full' or 'incremental'.
+      resume (bool): if True, a full load resumes the last one (see
+          'load_full()'). An incremental load always resumes from its
+          watermark.
+    Returns:
+      True if the load succeeded, False otherwise.
+    """
+    if resume and load_mode == "full" and get_target() is None:
+        print("ERROR: A load into an in-memory database cannot be resumed.")
+        return False
     cur = conn.cursor()
-    
-    load_staging_tables(cur, conn)
-    insert_tables(cur, conn)
+    instrumentation.start_run("etl")
+    if load_mode == "incremental":
+        ok = load_incremental(cur, conn)
+    else:
+        listings = {}
+        if get_parquet_staging():
+            # The Parquet copies hold the files listed when they were built,
+            # not the ones in 'LOG_DATA' now (see parquet_staging.py)
+            import parquet_staging
+            log_files = parquet_staging.read_source_listing("staging_events")
+            song_files = parquet_staging.read_source_listing("staging_songs") if use_inventory() else None
+            if log_files is None:
+                print("WARNING: The Parquet copy of the log files has no listing, the watermark won't be updated.")
+        else:
+            # List the log files before the COPY so that the watermark never
+            # covers a file that arrived during the load.
+            try:
+                log_files = source_listing("staging_events", listings)
+            except Exception as e:
+                print("WARNING: Cannot list the log files, the watermark won't be updated: {}".format(e))
+                log_files = None
+            song_files = source_listing("staging_songs", listings) if use_inventory() else None
+        ok = load_full(dsn, cur, conn, resume, listings)
+        if ok and log_files is not None:
+            record_full_load(log_files)
+        if ok:
+            record_loaded(source_uri("SONG_DATA"), song_files)
+    # Keep the sort order and the statistics fresh after each load
+    if ok and dsn is not None and get_maintenance():
+        maintain(cur, conn)
+    instrumentation.end_run()
+    return ok
+
 
-    # Close connection
+def main(argv=None):
+    global VERBOSE
+    
+    parser = argparse.ArgumentParser(description="Load the Sparkify star tables from S3.")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--full", dest="mode", action="store_const", const="full",
+                      help="reload the whole log and song datasets (full rebuild)")
+    mode.add_argument("--incremental", dest="mode", action="store_const", const="incremental",
+                      help="only load the log files arrived since the last run")
+    parser.add_argument("--resume", action="store_true",
+                        help="resume the last full load: skip the steps completed with unchanged inputs")
+    args = parser.parse_args(argv)
+    load_mode = args.mode or get_load_mode()
+    
+    (conn, dsn) = connect_warehouse()
+    ok = run(conn, dsn, load_mode, args.resume)
     conn.close()
+    if VERBOSE > 1 and dsn is not None:
+        print_api_calls()
+    if not ok:
+        quit()
 
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()
@@ -0,0 +1,317 @@
+import hashlib
+import json
+import os
+import re
+import time
+from datetime import datetime, timezone
+
+from sql_queries import staging_events_copy, staging_events_copy_manifest, staging_events_clear
+from sql_queries import staging_event_keys_clear, merge_table_queries
+from create_cluster import get_cluster_role_arn, get_aws_region
+from s3_utils import object_uri, strip_quotes
+from settings import get_settings
+from instrumentation import execute_stage
+from local_engine import get_backend
+from inventory import get_listing, record_loaded, source_uri
+from projection import get_log_jsonpath
+from manifest import build_manifest, get_slice_count, plan_slices, write_manifest
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The log files are partitioned as 'log_data/YYYY/MM/YYYY-MM-DD-events.json'
+LOG_FILE_PATTERN = re.compile(r"(\d{4})/(\d{2})/\d{4}-\d{2}-\d{2}-events\.json$")
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_state_dir():
+    """
+    Returns the directory where the ETL state files are persisted.
+    """
+    return get_settings().get("ETL", "STATE_DIR", fallback=".etl_state")
+
+
+def get_watermark_path():
+    """
+    Returns the path of the current log watermark.
+    """
+    return os.path.join(get_state_dir(), "log_watermark.json")
+
+
+def get_partition(key):
+    """
+    Returns the 'YYYY/MM' partition of a log file key or None.
+    """
+    match = LOG_FILE_PATTERN.search(key)
+    if match is None:
+        return None
+    return "{}/{}".format(match.group(1), match.group(2))
+
+
+class LogWatermark:
+    """
+    The persistent high-water mark of the log files loaded into the star tables.
+
+    The state keeps the ETag and the size of every loaded file so that new and
+    re-written files are both detected, and the highest loaded key per month
+    partition.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.files = {}
+        self.partitions = {}
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Loads the watermark from disk, or returns an empty one if none exists.
+
+        Args:
+          path (str): the state file. Defaults to '<STATE_DIR>/log_watermark.json'.
+        Returns:
+          watermark (LogWatermark): the loaded watermark.
+        """
+        if path is None:
+            path = get_watermark_path()
+        watermark = cls(path)
+        if os.path.exists(path):
+            with open(path) as f:
+                state = json.load(f)
+            watermark.files = state.get("files", {})
+            watermark.partitions = state.get("partitions", {})
+        return watermark
+
+    @property
+    def high_water_mark(self):
+        """
+        Returns the highest loaded log file key or None.
+        """
+        return max(self.files) if self.files else None
+
+    def new_objects(self, objects):
+        """
+        Filters a listing down to the log files not loaded yet or changed since.
+
+        Args:
+          objects (list): a listing as returned by 's3_utils.list_objects()'.
+        Returns:
+          objects (list): the new or changed log files.
+        """
+        new = []
+        for obj in objects:
+            if get_partition(obj['Key']) is None:
+                continue
+            loaded = self.files.get(obj['Key'])
+            if loaded is None or loaded['etag'] != obj['ETag'] or loaded['size'] != obj['Size']:
+                new.append(obj)
+        return new
+
+    def mark_loaded(self, objects):
+        """
+        Records a list of log files as loaded.
+        """
+        loaded_at = datetime.now(timezone.utc).isoformat()
+        for obj in objects:
+            partition = get_partition(obj['Key'])
+            if partition is None:
+                continue
+            self.files[obj['Key']] = {'etag': obj['ETag'], 'size': obj['Size'], 'loaded_at': loaded_at}
+            if obj['Key'] > self.partitions.get(partition, ''):
+                self.partitions[partition] = obj['Key']
+
+    def reset(self):
+        """
+        Forgets all the loaded files (e.g. before a full rebuild).
+        """
+        self.files = {}
+        self.partitions = {}
+
+    def save(self):
+        """
+        Writes the watermark to disk atomically.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"high_water_mark": self.high_water_mark,
+                       "partitions": self.partitions,
+                       "files": self.files}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def get_snapshot_watermark_path(snapshot):
+    """
+    Returns the path of the watermark saved along with a cluster snapshot.
+    """
+    return os.path.join(get_state_dir(), "snapshots", snapshot + ".json")
+
+
+def save_snapshot_watermark(snapshot):
+    """
+    Saves a copy of the current watermark along with a cluster snapshot, so
+    that a cluster restored from that snapshot resumes the incremental load
+    from the log files it actually holds.
+    """
+    watermark = LogWatermark.load()
+    watermark.path = get_snapshot_watermark_path(snapshot)
+    watermark.save()
+
+
+def restore_snapshot_watermark(snapshot):
+    """
+    Makes the watermark saved along with a snapshot the current watermark.
+
+    If no watermark was saved with the snapshot, the current watermark is
+    reset: the next incremental load then merges all the log files, which is
+    slower but safe since the merge skips the rows already loaded.
+
+    Returns:
+      True if the watermark of the snapshot was found, False otherwise.
+    """
+    path = get_snapshot_watermark_path(snapshot)
+    found = os.path.exists(path)
+    watermark = LogWatermark.load(path if found else None)
+    watermark.path = get_watermark_path()
+    if not found:
+        print("WARNING: No watermark saved with the snapshot \'{}\', the next incremental "
+              "load merges all the log files.".format(snapshot))
+        watermark.reset()
+    watermark.save()
+    return found
+
+
+def discard_snapshot_watermark(snapshot):
+    """
+    Deletes the watermark saved along with a (pruned) snapshot.
+    """
+    path = get_snapshot_watermark_path(snapshot)
+    if os.path.exists(path):
+        os.remove(path)
+
+
+def get_log_source():
+    """
+    Returns the location of the log files: 'LOG_DATA' (see myDWH.cfg), or its
+    local mirror on the local backend.
+    """
+    return source_uri("LOG_DATA")
+
+
+def list_log_files():
+    """
+    Returns the listing of the log files found under 'LOG_DATA' (see myDWH.cfg).
+    If the inventory is used (see inventory.py), it is refreshed first, since
+    the new log files must be seen as soon as they arrive.
+    """
+    return get_listing(get_log_source(), suffix=".json", max_age=0)
+
+
+def record_full_load(objects):
+    """
+    Resets the watermark to a listing of log files loaded by a full rebuild.
+
+    Args:
+      objects (list): the log files listed before the full COPY was issued.
+    """
+    watermark = LogWatermark.load()
+    watermark.reset()
+    watermark.mark_loaded(objects)
+    watermark.save()
+    record_loaded(get_log_source(), objects)
+    if VERBOSE:
+        print("Watermark reset to {} log files (high-water mark = {})".format(
+            len(watermark.files), watermark.high_water_mark))
+
+
+def get_batch_manifest_uri(objects):
+    """
+    Returns the URI of the COPY manifest of a set of log files, under
+    'MANIFEST_PREFIX'. It is named after the keys and the ETags of the files,
+    so a retried batch rewrites its own manifest.
+    """
+    digest = hashlib.sha1("".join(obj['Key'] + obj['ETag'] for obj in objects).encode('utf-8')).hexdigest()
+    prefix = strip_quotes(get_settings().get("ETL", "MANIFEST_PREFIX")).rstrip("/")
+    return "{}/batches/staging_events-{}.manifest".format(prefix, digest[:16])
+
+
+def merge_log_files(cur, conn, objects, stage="incremental"):
+    """
+    Loads a set of log files into 'staging_events' and merges the affected
+    rows into 'dimTime', 'dimUser' and 'factSongPlay', in a single
+    transaction. The watermark is not updated.
+
+    On Redshift, the files are loaded by a single COPY of a manifest that
+    lists them (see 'get_batch_manifest_uri()'). The local backend copies
+    them one by one.
+
+    Args:
+      cur (psycopg2.extensions.cursor): a cursor on the connection 'conn'.
+      conn (psycopg2.extensions.connection): a connection to the warehouse.
+      objects (list): the log files, as listed by 'list_log_files()'.
+      stage (str): the stage the statements are recorded under.
+    Returns:
+      True if the transaction was committed, False if it was rolled back.
+    """
+    log_source = get_log_source()
+    role_arn = "local" if get_backend() == "duckdb" else get_cluster_role_arn()
+    queries = [staging_events_clear, staging_event_keys_clear]
+    if get_backend() == "duckdb":
+        for obj in objects:
+            queries.append(staging_events_copy.format("\'{}\'".format(object_uri(log_source, obj['Key'])),
+                                                      role_arn, get_aws_region(),
+                                                      get_log_jsonpath()))
+    else:
+        manifest = build_manifest(log_source, plan_slices(objects, get_slice_count()))
+        destination = write_manifest(manifest, get_batch_manifest_uri(objects))
+        queries.append(staging_events_copy_manifest.format("\'{}\'".format(destination),
+                                                           role_arn, get_aws_region(),
+                                                           get_log_jsonpath()))
+    queries += merge_table_queries
+    if VERBOSE > 1:
+        print("The following queries are going to be issued:" + "".join(queries))
+    return execute_stage(cur, conn, queries, stage)
+
+
+def load_incremental(cur, conn):
+    """
+    Loads the log files arrived since the last run and merges the affected
+    rows into 'dimTime', 'dimUser' and 'factSongPlay'.
+
+    The staging table 'staging_events' is refilled with the new log files only
+    and the merge runs in a single transaction. The watermark is advanced only
+    once that transaction is committed. The table 'staging_songs' is expected
+    to hold the song dataset from a previous full load.
+
+    Args:
+      cur (psycopg2.extensions.cursor):
+          A ref to a cursor object for executing SQL commands on the Redshift
+          database.
+      conn (psycopg2.extensions.connection):
+          A ref to a connection object to interact with the database.
+    Returns:
+      True if the load succeeded (or if there was nothing to load), False
+      otherwise.
+    """
+    watermark = LogWatermark.load()
+    new_files = watermark.new_objects(list_log_files())
+    if VERBOSE:
+        print("Incremental load: {} new log files since \'{}\'".format(
+            len(new_files), watermark.high_water_mark))
+    if not new_files:
+        return True
+
+    start = time.perf_counter()
+    if not merge_log_files(cur, conn, new_files):
+        print("ERROR: The incremental load was rolled back. The watermark is unchanged.")
+        return False
+
+    watermark.mark_loaded(new_files)
+    watermark.save()
+    record_loaded(get_log_source(), new_files)
+    if VERBOSE:
+        print("Incremental load completed in {:.2f} s (high-water mark = {})".format(
+            time.perf_counter() - start, watermark.high_water_mark))
+    return True
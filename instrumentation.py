@@ -0,0 +1,392 @@
+import argparse
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+import time
+import uuid
+from datetime import datetime, timezone
+
+from local_engine import get_backend, database_error
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 0
+
+# GLOBAL VARIABLES
+recorder = None  # The StatementRecorder of the current run
+
+LABEL_PATTERN = re.compile(
+    r"^\s*(DROP|CREATE|COPY|INSERT|DELETE|UPDATE|TRUNCATE|VACUUM|ANALYZE|ALTER)\b"
+    r"(?:\s+TABLE)?(?:\s+IF(?:\s+NOT)?\s+EXISTS)?(?:\s+INTO|\s+FROM)?\s+(\w+)", re.IGNORECASE)
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run_id      TEXT PRIMARY KEY,
+    script      TEXT,
+    backend     TEXT,
+    started_at  TEXT,
+    ended_at    TEXT
+);
+CREATE TABLE IF NOT EXISTS statements (
+    run_id      TEXT,
+    seq         INTEGER,
+    stage       TEXT,
+    name        TEXT,
+    sql_hash    TEXT,
+    executed_at TEXT,
+    wall_s      REAL,
+    commit_s    REAL,
+    rowcount    INTEGER,
+    query_id    INTEGER,
+    load_files  INTEGER,
+    load_lines  INTEGER,
+    error       TEXT
+);
+CREATE INDEX IF NOT EXISTS statements_name ON statements (name, run_id);
+"""
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def statement_label(query):
+    """
+    Returns a short label for a statement, e.g. 'INSERT dimUser'.
+    """
+    match = LABEL_PATTERN.search(query)
+    if match is None:
+        return query.strip().split("\n")[0][:40]
+    return "{} {}".format(match.group(1).upper(), match.group(2))
+
+
+def get_history_path():
+    """
+    Returns the path of the SQLite run-history store.
+    """
+    config = get_settings()
+    default = os.path.join(config.get("ETL", "STATE_DIR", fallback=".etl_state"), "run_history.sqlite")
+    return config.get("ETL", "HISTORY_DB", fallback=default)
+
+
+class StatementRecorder:
+    """
+    Records the wall time, the commit time, the row count and, on Redshift,
+    the query ID and the load statistics of every statement of a run.
+    """
+    def __init__(self, script):
+        self.run_id = uuid.uuid4().hex
+        self.script = script
+        self.backend = get_backend()
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.records = []
+        self._lock = threading.Lock()
+
+    def execute(self, cur, conn, query, stage, name=None, commit=True):
+        """
+        Executes (and commits) a statement and records its statistics.
+
+        Any database error is recorded and then raised again, so the callers
+        keep their own error handling.
+
+        Args:
+          cur (psycopg2.extensions.cursor): the cursor to execute with.
+          conn (psycopg2.extensions.connection): the connection of 'cur'.
+          query (str): the statement to execute.
+          stage (str): the stage of the pipeline (e.g. 'insert').
+          name (str): the statement label. Defaults to 'statement_label()'.
+          commit (bool): if True, the statement is committed on its own.
+        Returns:
+          record (dict): the recorded statistics.
+        """
+        record = {'stage': stage,
+                  'name': name or statement_label(query),
+                  'sql_hash': hashlib.sha1(query.encode('utf-8')).hexdigest()[:16],
+                  'executed_at': datetime.now(timezone.utc).isoformat(),
+                  'wall_s': None, 'commit_s': None, 'rowcount': None,
+                  'query_id': None, 'load_files': None, 'load_lines': None,
+                  'error': None}
+        start = time.perf_counter()
+        try:
+            cur.execute(query)
+            record['wall_s'] = time.perf_counter() - start
+            record['rowcount'] = cur.rowcount
+            if self.backend == "redshift":
+                self._collect_query_id(cur, record)
+            if commit:
+                start = time.perf_counter()
+                conn.commit()
+                record['commit_s'] = time.perf_counter() - start
+            if self.backend == "redshift" and record['name'].startswith("COPY") and commit:
+                self._collect_load_stats(cur, record)
+        except Exception as e:
+            if record['wall_s'] is None:
+                record['wall_s'] = time.perf_counter() - start
+            record['error'] = str(e).strip()[:500]
+            raise
+        finally:
+            with self._lock:
+                record['seq'] = len(self.records)
+                self.records.append(record)
+            if VERBOSE:
+                print("\t[{}] {:<28} {:8.3f} s rows={}".format(
+                    stage, record['name'], record['wall_s'] or 0, record['rowcount']))
+        return record
+
+    def commit(self, conn, stage):
+        """
+        Commits the current transaction of a stage and records the commit.
+        """
+        record = {'stage': stage, 'name': 'COMMIT', 'sql_hash': None,
+                  'executed_at': datetime.now(timezone.utc).isoformat(),
+                  'wall_s': None, 'commit_s': None, 'rowcount': None,
+                  'query_id': None, 'load_files': None, 'load_lines': None,
+                  'error': None}
+        start = time.perf_counter()
+        try:
+            conn.commit()
+        except Exception as e:
+            record['error'] = str(e).strip()[:500]
+            raise
+        finally:
+            record['wall_s'] = record['commit_s'] = time.perf_counter() - start
+            with self._lock:
+                record['seq'] = len(self.records)
+                self.records.append(record)
+        return record
+
+    def commit_stats(self):
+        """
+        Returns a 2-tuple (count, seconds) with the number of commits of the
+        run and their total latency.
+        """
+        with self._lock:
+            commits = [record['commit_s'] for record in self.records if record['commit_s'] is not None]
+        return (len(commits), sum(commits))
+
+    def _collect_query_id(self, cur, record):
+        cur.execute("SELECT pg_last_query_id();")
+        record['query_id'] = cur.fetchone()[0]
+
+    def _collect_load_stats(self, cur, record):
+        cur.execute("SELECT COUNT(*), SUM(lines_scanned) FROM stl_load_commits "
+                    "WHERE query = pg_last_copy_id();")
+        (record['load_files'], record['load_lines']) = cur.fetchone()
+
+    def save(self, path=None):
+        """
+        Appends the run and its statements to the SQLite run-history store.
+        """
+        path = path or get_history_path()
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(path)
+        try:
+            db.executescript(HISTORY_SCHEMA)
+            db.execute("INSERT INTO runs VALUES (?, ?, ?, ?, ?)",
+                       (self.run_id, self.script, self.backend, self.started_at,
+                        datetime.now(timezone.utc).isoformat()))
+            db.executemany(
+                "INSERT INTO statements VALUES (:run_id, :seq, :stage, :name, :sql_hash, :executed_at, "
+                ":wall_s, :commit_s, :rowcount, :query_id, :load_files, :load_lines, :error)",
+                [dict(record, run_id=self.run_id) for record in self.records])
+            db.commit()
+        finally:
+            db.close()
+
+
+def start_run(script):
+    """
+    Starts recording a new run of a script (e.g. 'etl').
+    """
+    global recorder
+    recorder = StatementRecorder(script)
+    return recorder
+
+
+def end_run():
+    """
+    Saves the current run to the run-history store and stops recording.
+    """
+    global recorder
+    if recorder is not None and recorder.records:
+        recorder.save()
+        if VERBOSE:
+            print("Run {} saved to \'{}\'".format(recorder.run_id, get_history_path()))
+    recorder = None
+
+
+def timed_execute(cur, conn, query, stage, name=None, commit=True):
+    """
+    Executes a statement through the recorder of the current run. A run is
+    started on first use if none was started explicitly.
+    """
+    global recorder
+    if recorder is None:
+        start_run("adhoc")
+    return recorder.execute(cur, conn, query, stage, name, commit)
+
+
+def get_transaction_mode():
+    """
+    Returns how the statements of a stage are committed: 'statement' (one
+    commit per statement) or 'stage' (one transaction per stage), see
+    'TRANSACTION_MODE' in myDWH.cfg.
+    """
+    return get_settings().get("ETL", "TRANSACTION_MODE", fallback="statement")
+
+
+def execute_stage(cur, conn, queries, stage):
+    """
+    Executes the statements of a stage in a single transaction and commits
+    once.
+
+    Neither Redshift nor DuckDB supports SAVEPOINT, so each statement is
+    recorded as a checkpoint instead: if a statement fails, the whole stage is
+    rolled back and the failed statement is reported along with the ones that
+    were undone.
+
+    Args:
+      cur (psycopg2.extensions.cursor): the cursor to execute with.
+      conn (psycopg2.extensions.connection): the connection of 'cur'.
+      queries (list): the statements of the stage, in order.
+      stage (str): the stage of the pipeline (e.g. 'insert').
+    Returns:
+      True if the stage was committed, False if it was rolled back.
+    """
+    global recorder
+    if recorder is None:
+        start_run("adhoc")
+    checkpoints = []
+    try:
+        for query in queries:
+            timed_execute(cur, conn, query, stage, commit=False)
+            checkpoints.append(statement_label(query))
+        recorder.commit(conn, stage)
+    except database_error() as e:
+        conn.rollback()
+        print("Error executing query: {}".format(e))
+        failed = statement_label(queries[len(checkpoints)]) if len(checkpoints) < len(queries) else "COMMIT"
+        print("ERROR: The stage \'{}\' was rolled back at statement {}/{} ({}).".format(
+            stage, len(checkpoints) + 1, len(queries), failed))
+        if checkpoints:
+            print("\tUndone: {}".format(", ".join(checkpoints)))
+        return False
+    if VERBOSE:
+        print("\tStage \'{}\' committed ({} statements)".format(stage, len(queries)))
+    return True
+
+
+def percentile(values, fraction):
+    """
+    Returns the percentile of a list of values (linear interpolation).
+    """
+    values = sorted(values)
+    if not values:
+        return None
+    position = (len(values) - 1) * fraction
+    (low, high) = (int(position), min(int(position) + 1, len(values) - 1))
+    return values[low] + (values[high] - values[low]) * (position - low)
+
+
+def typical_duration(name, path=None, last=10):
+    """
+    Returns the median wall time in seconds of the successful executions of
+    a statement over its last recorded runs, or None if it never ran.
+
+    Args:
+      name (str): the statement label (e.g. 'VACUUM SORT ONLY factSongPlay').
+      path (str): the run-history store. Defaults to 'get_history_path()'.
+      last (int): the number of most recent executions to consider.
+    """
+    path = path or get_history_path()
+    if not os.path.exists(path):
+        return None
+    db = sqlite3.connect(path)
+    try:
+        db.executescript(HISTORY_SCHEMA)
+        times = [row[0] for row in db.execute(
+            "SELECT wall_s FROM statements WHERE name = ? AND error IS NULL AND wall_s IS NOT NULL "
+            "ORDER BY executed_at DESC LIMIT ?", (name, last))]
+    finally:
+        db.close()
+    return percentile(times, 0.5)
+
+
+def report(path=None, last=20, stage=None):
+    """
+    Prints the per-statement trends and percentiles across the recorded runs.
+
+    Args:
+      path (str): the run-history store. Defaults to 'get_history_path()'.
+      last (int): the number of most recent runs to consider.
+      stage (str): if set, only the statements of this stage are reported.
+    """
+    path = path or get_history_path()
+    if not os.path.exists(path):
+        print("No run history in \'{}\'".format(path))
+        return
+    db = sqlite3.connect(path)
+    try:
+        runs = [row[0] for row in db.execute(
+            "SELECT run_id FROM runs ORDER BY started_at DESC LIMIT ?", (last,))]
+        if not runs:
+            print("No run history in \'{}\'".format(path))
+            return
+        placeholders = ",".join("?" * len(runs))
+        query = ("SELECT s.stage, s.name, s.wall_s, s.rowcount, s.error FROM statements s "
+                 "JOIN runs r ON r.run_id = s.run_id WHERE s.run_id IN ({}) ".format(placeholders))
+        params = list(runs)
+        if stage is not None:
+            query += "AND s.stage = ? "
+            params.append(stage)
+        rows = db.execute(query + "ORDER BY r.started_at, s.seq", params).fetchall()
+        commits = db.execute(
+            "SELECT r.started_at, r.script, COUNT(s.commit_s), COALESCE(SUM(s.commit_s), 0) FROM runs r "
+            "LEFT JOIN statements s ON s.run_id = r.run_id WHERE r.run_id IN ({}) "
+            "GROUP BY r.run_id ORDER BY r.started_at".format(placeholders), runs).fetchall()
+    finally:
+        db.close()
+
+    statements = {}
+    for (stage_name, name, wall_s, rowcount, error) in rows:
+        entry = statements.setdefault((stage_name, name), {'times': [], 'rows': None, 'errors': 0})
+        if error:
+            entry['errors'] += 1
+        elif wall_s is not None:
+            entry['times'].append(wall_s)
+            entry['rows'] = rowcount
+    print("STATEMENT REPORT (last {} runs):".format(len(runs)))
+    print("  {:<10} {:<28} {:>4} {:>9} {:>9} {:>9} {:>9} {:>8} {:>10}".format(
+        "stage", "statement", "n", "p50 s", "p90 s", "max s", "last s", "trend", "rows"))
+    for ((stage_name, name), entry) in statements.items():
+        times = entry['times']
+        if not times:
+            print("  {:<10} {:<28} {:>4} (failed {} times)".format(stage_name, name, 0, entry['errors']))
+            continue
+        previous = percentile(times[:-1], 0.5)
+        trend = "{:+7.1%}".format(times[-1] / previous - 1) if previous else "      -"
+        print("  {:<10} {:<28} {:>4} {:9.3f} {:9.3f} {:9.3f} {:9.3f} {:>8} {:>10}{}".format(
+            stage_name, name, len(times), percentile(times, 0.5), percentile(times, 0.9),
+            max(times), times[-1], trend, entry['rows'] if entry['rows'] is not None else "-",
+            "  ({} errors)".format(entry['errors']) if entry['errors'] else ""))
+    print("COMMITS PER RUN:")
+    print("  {:<34} {:<14} {:>8} {:>10}".format("started at", "script", "commits", "commit s"))
+    for (started_at, script, count, seconds) in commits:
+        print("  {:<34} {:<14} {:>8} {:10.3f}".format(started_at, script, count, seconds))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report the per-statement run history.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="print the trends and percentiles")
+    report_parser.add_argument("--last", type=int, default=20, help="number of recent runs")
+    report_parser.add_argument("--stage", default=None, help="only report one stage")
+    report_parser.add_argument("--db", default=None, help="path of the run-history store")
+    args = parser.parse_args(argv)
+    report(args.db, args.last, args.stage)
+
+
+if __name__ == "__main__":
+    main()
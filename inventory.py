@@ -0,0 +1,348 @@
+import argparse
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
+
+from local_engine import backend_uri
+from s3_utils import get_s3_client, is_s3_uri, parse_s3_uri, list_objects, object_record, file_record, strip_quotes
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+INVENTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS sources (
+    source       TEXT PRIMARY KEY,
+    refreshed_at TEXT,
+    list_s       REAL,
+    shards       INTEGER
+);
+CREATE TABLE IF NOT EXISTS objects (
+    source        TEXT,
+    key           TEXT,
+    size          INTEGER,
+    etag          TEXT,
+    last_modified TEXT,
+    seen_at       TEXT,
+    loaded_at     TEXT,
+    loaded_etag   TEXT,
+    PRIMARY KEY (source, key)
+);
+"""
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_inventory_path():
+    """
+    Returns the path of the SQLite inventory of the source prefixes.
+    """
+    config = get_settings()
+    default = os.path.join(config.get("ETL", "STATE_DIR", fallback=".etl_state"), "inventory.sqlite")
+    return config.get("ETL", "INVENTORY_DB", fallback=default)
+
+
+def use_inventory():
+    """
+    Returns True if the source listings are served by the inventory
+    ('USE_INVENTORY = 1' in myDWH.cfg).
+    """
+    return get_settings().getboolean("ETL", "USE_INVENTORY", fallback=False)
+
+
+def source_uri(option):
+    """
+    Returns the location of a source dataset of the section '[S3]' (e.g.
+    'LOG_DATA'), or its local mirror on the local backend.
+    """
+    return backend_uri(get_settings().get("S3", option))
+
+
+def _source_key(uri):
+    return strip_quotes(uri).rstrip("/")
+
+
+def _list_level(uri, shard, client):
+    """
+    Returns the sub-prefixes of a shard and the records of the objects found
+    directly in it.
+    """
+    (found, objects) = ([], [])
+    if is_s3_uri(uri):
+        (bucket, _) = parse_s3_uri(uri)
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=shard, Delimiter="/"):
+            found += [common['Prefix'] for common in page.get('CommonPrefixes', [])]
+            objects += [object_record(obj) for obj in page.get('Contents', [])]
+    else:
+        for entry in sorted(os.scandir(shard), key=lambda entry: entry.name):
+            if entry.is_dir():
+                found.append(os.path.join(shard, entry.name))
+            elif entry.is_file():
+                objects.append(file_record(os.path.join(shard, entry.name)))
+    return (found, objects)
+
+
+def list_shards(uri, depth, client=None, workers=1):
+    """
+    Splits a prefix into the sub-prefixes found 'depth' levels below it, e.g.
+    'song_data/A/A/' for the song dataset with a depth of 2. The prefixes of
+    each level are listed in parallel.
+
+    Args:
+      uri (str): an S3 URI or the path of a local directory.
+      depth (int): the number of levels to descend.
+      client (boto3.client): an S3 client. Defaults to 'get_s3_client()'.
+      workers (int): the parallel listings.
+    Returns:
+      A 2-tuple (shards, objects): the URIs of the shards, and the records of
+      the objects found above them (shaped like 's3_utils.list_objects()').
+      A prefix without sub-prefixes is fully listed on its way down: its
+      objects are returned and it is not a shard.
+    """
+    objects = []
+    if is_s3_uri(uri):
+        (bucket, prefix) = parse_s3_uri(uri)
+        client = client or get_s3_client()
+        level = [prefix.rstrip("/") + "/" if prefix else ""]
+    else:
+        level = [strip_quotes(uri)]
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for _ in range(depth):
+            below = []
+            for (found, found_objects) in executor.map(lambda shard: _list_level(uri, shard, client), level):
+                objects += found_objects
+                below += found
+            level = below
+    if is_s3_uri(uri):
+        level = ["s3://{}/{}".format(bucket, shard) for shard in level]
+    return (level, objects)
+
+
+def list_objects_sharded(uri, client=None, suffix=None, depth=None, workers=None):
+    """
+    Lists the objects under a prefix like 's3_utils.list_objects()', by
+    listing its shards (see 'list_shards()') in parallel. Each shard listing
+    is paginated.
+
+    Args:
+      uri (str): an S3 URI or the path of a local directory.
+      client (boto3.client): an S3 client (e.g. a local S3 stand-in).
+      suffix (str): if set, only the keys ending with this suffix are listed.
+      depth (int): the shard depth. Defaults to 'INVENTORY_SHARD_DEPTH'.
+      workers (int): the parallel listings. Defaults to 'INVENTORY_LIST_WORKERS'.
+    Returns:
+      A 2-tuple (objects, shards): the records sorted by key, and the number
+      of shards listed.
+    """
+    config = get_settings()
+    depth = config.getint("ETL", "INVENTORY_SHARD_DEPTH", fallback=2) if depth is None else depth
+    workers = workers or config.getint("ETL", "INVENTORY_LIST_WORKERS", fallback=8)
+    if is_s3_uri(uri):
+        # boto3 clients are thread-safe: the shards share one
+        client = client or get_s3_client()
+    (shards, objects) = list_shards(uri, depth, client, workers)
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+        for listing in executor.map(lambda shard: list_objects(shard, client=client), shards):
+            objects += listing
+    # Each key is counted once by 'refresh()'
+    objects = {obj['Key']: obj for obj in objects}.values()
+    if suffix is not None:
+        objects = [obj for obj in objects if obj['Key'].endswith(suffix)]
+    return (sorted(objects, key=lambda obj: obj['Key']), len(shards))
+
+
+class Inventory:
+    """
+    The SQLite inventory of the objects of the source prefixes: key, size,
+    ETag and last-modified time of each object, as of the last listing, and
+    the ETag it had when it was last loaded.
+
+    An object is new or changed since the last load if it was never loaded,
+    or if its ETag differs from the loaded one.
+    """
+    def __init__(self, path=None):
+        self.path = path or get_inventory_path()
+
+    def _connect(self):
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(self.path)
+        db.executescript(INVENTORY_SCHEMA)
+        return db
+
+    def refresh(self, uri, client=None):
+        """
+        Lists a source prefix (see 'list_objects_sharded()') and stores the
+        listing. The objects that disappeared are removed, and the load state
+        of the others is kept.
+
+        Returns:
+          A dict with the counts 'objects', 'added', 'changed' and 'removed',
+          the number of 'shards' and the listing time 'list_s'.
+        """
+        source = _source_key(uri)
+        start = time.perf_counter()
+        (objects, shards) = list_objects_sharded(uri, client=client)
+        list_s = time.perf_counter() - start
+        now = datetime.now(timezone.utc).isoformat()
+        db = self._connect()
+        try:
+            known = dict(db.execute("SELECT key, etag FROM objects WHERE source = ?", (source,)))
+            keys = set(obj['Key'] for obj in objects)
+            stats = {'objects': len(objects),
+                     'added': sum(1 for obj in objects if obj['Key'] not in known),
+                     'changed': sum(1 for obj in objects if obj['Key'] in known and known[obj['Key']] != obj['ETag']),
+                     'removed': sum(1 for key in known if key not in keys),
+                     'shards': shards, 'list_s': list_s}
+            db.executemany("DELETE FROM objects WHERE source = ? AND key = ?",
+                           [(source, key) for key in known if key not in keys])
+            db.executemany(
+                "INSERT INTO objects (source, key, size, etag, last_modified, seen_at) VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (source, key) DO UPDATE SET size = excluded.size, etag = excluded.etag, "
+                "last_modified = excluded.last_modified, seen_at = excluded.seen_at",
+                [(source, obj['Key'], obj['Size'], obj['ETag'],
+                  obj['LastModified'].isoformat() if obj['LastModified'] else None, now) for obj in objects])
+            db.execute("INSERT OR REPLACE INTO sources VALUES (?, ?, ?, ?)", (source, now, list_s, shards))
+            db.commit()
+        finally:
+            db.close()
+        if VERBOSE:
+            print("Inventory of \'{}\': {} objects ({} added, {} changed, {} removed) listed in {:.2f} s "
+                  "from {} shards".format(source, stats['objects'], stats['added'], stats['changed'],
+                                          stats['removed'], list_s, shards))
+        return stats
+
+    def refreshed_at(self, uri):
+        """
+        Returns when a source was last listed (a datetime), or None.
+        """
+        db = self._connect()
+        try:
+            row = db.execute("SELECT refreshed_at FROM sources WHERE source = ?", (_source_key(uri),)).fetchone()
+        finally:
+            db.close()
+        return datetime.fromisoformat(row[0]) if row else None
+
+    def _select(self, uri, suffix, where=""):
+        db = self._connect()
+        try:
+            rows = db.execute("SELECT key, size, etag, last_modified FROM objects WHERE source = ?{} "
+                              "ORDER BY key".format(where), (_source_key(uri),)).fetchall()
+        finally:
+            db.close()
+        return [{'Key': key, 'Size': size, 'ETag': etag,
+                 'LastModified': datetime.fromisoformat(last_modified) if last_modified else None}
+                for (key, size, etag, last_modified) in rows
+                if suffix is None or key.endswith(suffix)]
+
+    def objects(self, uri, suffix=None):
+        """
+        Returns the objects of a source as of its last refresh, shaped and
+        sorted like 's3_utils.list_objects()'.
+        """
+        return self._select(uri, suffix)
+
+    def changed(self, uri, suffix=None):
+        """
+        Returns the objects of a source that are new or changed since they
+        were last loaded (see 'mark_loaded()').
+        """
+        return self._select(uri, suffix, " AND (loaded_etag IS NULL OR loaded_etag <> etag)")
+
+    def mark_loaded(self, uri, objects):
+        """
+        Records a set of objects of a source as loaded, with their ETag.
+        """
+        now = datetime.now(timezone.utc).isoformat()
+        db = self._connect()
+        try:
+            db.executemany("UPDATE objects SET loaded_at = ?, loaded_etag = ? WHERE source = ? AND key = ?",
+                           [(now, obj['ETag'], _source_key(uri), obj['Key']) for obj in objects])
+            db.commit()
+        finally:
+            db.close()
+
+    def status(self):
+        """
+        Returns the state of each source: a list of tuples (source,
+        refreshed_at, list_s, shards, objects, bytes, pending) where
+        'pending' counts the objects new or changed since the last load.
+        """
+        db = self._connect()
+        try:
+            return db.execute(
+                "SELECT s.source, s.refreshed_at, s.list_s, s.shards, COUNT(o.key), COALESCE(SUM(o.size), 0), "
+                "COALESCE(SUM(CASE WHEN o.loaded_etag IS NULL OR o.loaded_etag <> o.etag THEN 1 ELSE 0 END), 0) "
+                "FROM sources s LEFT JOIN objects o ON o.source = s.source "
+                "GROUP BY s.source, s.refreshed_at, s.list_s, s.shards ORDER BY s.source").fetchall()
+        finally:
+            db.close()
+
+
+def get_listing(uri, suffix=None, client=None, max_age=None):
+    """
+    Returns the objects under a prefix, shaped like 's3_utils.list_objects()'.
+
+    With 'USE_INVENTORY = 1', the listing is served by the inventory, which is
+    refreshed first if it is older than 'max_age' seconds (default:
+    'INVENTORY_MAX_AGE_SECONDS'). Otherwise the prefix is listed directly.
+    """
+    if not use_inventory():
+        return list_objects(uri, client=client, suffix=suffix)
+    inventory = Inventory()
+    if max_age is None:
+        max_age = get_settings().getfloat("ETL", "INVENTORY_MAX_AGE_SECONDS", fallback=300)
+    refreshed_at = inventory.refreshed_at(uri)
+    if refreshed_at is None or (datetime.now(timezone.utc) - refreshed_at).total_seconds() >= max_age:
+        inventory.refresh(uri, client=client)
+    return inventory.objects(uri, suffix)
+
+
+def record_loaded(uri, objects):
+    """
+    Records objects as loaded in the inventory, if it is used.
+    """
+    if use_inventory() and objects:
+        Inventory().mark_loaded(uri, objects)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Maintain the inventory of the source prefixes.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    for (command, help) in [("refresh", "list the sources again (in parallel, by shard)"),
+                            ("changed", "print the objects new or changed since the last load"),
+                            ("status", "print the objects, bytes and pending objects of each source")]:
+        subparser = subparsers.add_parser(command, help=help)
+        subparser.add_argument("--source", choices=["log", "song", "all"], default="all",
+                               help="the dataset(s) (default=all)")
+        subparser.add_argument("--db", default=None, help="path of the inventory")
+    args = parser.parse_args(argv)
+
+    inventory = Inventory(args.db)
+    options = {"log": ["LOG_DATA"], "song": ["SONG_DATA"], "all": ["LOG_DATA", "SONG_DATA"]}[args.source]
+    if args.command == "refresh":
+        for option in options:
+            inventory.refresh(source_uri(option))
+    elif args.command == "changed":
+        for option in options:
+            start = time.perf_counter()
+            objects = inventory.changed(source_uri(option), suffix=".json")
+            elapsed = time.perf_counter() - start
+            for obj in objects:
+                print(obj['Key'])
+            print("{} objects of \'{}\' new or changed since the last load (looked up in {:.1f} ms)".format(
+                len(objects), source_uri(option), 1000 * elapsed))
+    else:
+        print("\t{:<40} {:<32} {:>8} {:>7} {:>9} {:>14} {:>9}".format(
+            "source", "refreshed_at", "list", "shards", "objects", "bytes", "pending"))
+        for (source, refreshed_at, list_s, shards, objects, size, pending) in inventory.status():
+            print("\t{:<40} {:<32} {:6.2f} s {:>7} {:>9} {:>14} {:>9}".format(
+                source, refreshed_at, list_s, shards, objects, size, pending))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,202 @@
+import hashlib
+import json
+import os
+import threading
+from datetime import datetime, timezone
+
+from incremental import get_state_dir
+from inventory import get_listing
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_journal_path():
+    """
+    Returns the path of the journal of the last full load.
+    """
+    return os.path.join(get_state_dir(), "run_journal.json")
+
+
+def get_target():
+    """
+    Returns the identity of the database the tables are loaded into, e.g.
+    'redshift:dwhCluster/dwh' or 'duckdb:/path/to/sparkify.duckdb', or None
+    for an in-memory database (which does not outlive its run).
+    """
+    config = get_settings()
+    if config.get("ETL", "BACKEND", fallback="redshift").strip().lower() == "duckdb":
+        database = config.get("LOCAL", "DATABASE", fallback=":memory:").strip().strip("\'")
+        return None if database == ":memory:" else "duckdb:" + os.path.abspath(database)
+    return "redshift:{}/{}".format(config.get("CLUSTER", "CLUSTER_NAME"), config.get("CLUSTER", "CLUSTER_DB_NAME"))
+
+
+def fingerprint(*parts):
+    """
+    Returns a short hash of JSON-serializable values (e.g. a SQL text, a list
+    of settings or of other fingerprints).
+    """
+    digest = hashlib.sha256()
+    for part in parts:
+        digest.update(json.dumps(part, sort_keys=True, default=str).encode('utf-8'))
+        digest.update(b"\0")
+    return digest.hexdigest()[:16]
+
+
+def config_fingerprint(options):
+    """
+    Returns the fingerprint of a list of (section, option) settings of
+    myDWH.cfg. A missing option counts as None.
+    """
+    config = get_settings()
+    return fingerprint([(section, option, config.get(section, option, fallback=None))
+                        for (section, option) in options])
+
+
+def listing_fingerprint(uri, objects=None):
+    """
+    Returns the fingerprint of the objects under an S3 prefix or a local
+    directory: their keys, ETags and sizes (from the inventory if it is used).
+
+    Args:
+      uri (str): the S3 prefix or the local directory.
+      objects (list): its listing, if it was already listed by the run.
+    """
+    if objects is None:
+        objects = get_listing(uri)
+    return fingerprint([(obj['Key'], obj['ETag'], obj['Size']) for obj in objects])
+
+
+class RunJournal:
+    """
+    The persistent journal of the steps of a full load (e.g. 'copy.staging_events',
+    'insert.dimSong'), each with the fingerprint of its inputs when it
+    completed.
+
+    A step is skipped by a resumed load if it completed with the same
+    fingerprint and none of its upstream steps runs again. The journal is
+    saved after each step, so that it survives a failure or a crash.
+    """
+    def __init__(self, path, target):
+        self.path = path
+        self.target = target
+        self.started_at = datetime.now(timezone.utc).isoformat()
+        self.status = "running"
+        self.steps = {}
+        self.fingerprints = {}
+        self._lock = threading.Lock()
+
+    @classmethod
+    def load(cls, path=None):
+        """
+        Loads the journal of the last full load. A journal of another database
+        is ignored.
+
+        Args:
+          path (str): the journal file. Defaults to '<STATE_DIR>/run_journal.json'.
+        Returns:
+          journal (RunJournal): the loaded journal, or an empty one.
+        """
+        journal = cls(path or get_journal_path(), get_target())
+        if os.path.exists(journal.path):
+            with open(journal.path) as f:
+                state = json.load(f)
+            if state.get("target") != journal.target:
+                print("WARNING: The run journal is for \'{}\', not \'{}\'. Nothing will be skipped.".format(
+                    state.get("target"), journal.target))
+            else:
+                journal.started_at = state.get("started_at", journal.started_at)
+                journal.status = state.get("status", journal.status)
+                journal.steps = state.get("steps", {})
+        return journal
+
+    @classmethod
+    def start(cls, path=None):
+        """
+        Starts the journal of a new full load, replacing the previous one.
+        """
+        journal = cls(path or get_journal_path(), get_target())
+        journal.save()
+        return journal
+
+    @staticmethod
+    def discard(path=None):
+        """
+        Deletes the journal (e.g. once the tables it describes are dropped).
+        """
+        path = path or get_journal_path()
+        if os.path.exists(path):
+            os.remove(path)
+
+    def plan(self, steps, resume=True):
+        """
+        Selects the steps to run.
+
+        Args:
+          steps (list): the steps in execution order, as dicts with the keys
+              'name', 'fingerprint' and 'upstream' (the names of the steps
+              whose output it reads).
+          resume (bool): if False, every step runs.
+        Returns:
+          run (list): the names of the steps to run, in execution order.
+        """
+        run = []
+        for step in steps:
+            self.fingerprints[step['name']] = step['fingerprint']
+            done = self.steps.get(step['name'], {}).get('fingerprint') == step['fingerprint']
+            if not resume or not done or any(name in run for name in step['upstream']):
+                run.append(step['name'])
+        return run
+
+    def mark_done(self, name):
+        """
+        Records a step of the plan as completed (thread-safe).
+        """
+        with self._lock:
+            self.steps[name] = {'fingerprint': self.fingerprints[name],
+                                'completed_at': datetime.now(timezone.utc).isoformat()}
+            self.save()
+
+    def forget(self, names):
+        """
+        Removes steps from the journal, so that they run again.
+        """
+        with self._lock:
+            for name in names:
+                self.steps.pop(name, None)
+            self.save()
+
+    def finish(self, ok):
+        """
+        Records the outcome of the load: 'completed' or 'failed'.
+        """
+        with self._lock:
+            self.status = "completed" if ok else "failed"
+            self.save()
+
+    def save(self):
+        """
+        Writes the journal to disk atomically.
+        """
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = self.path + ".tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"target": self.target,
+                       "started_at": self.started_at,
+                       "status": self.status,
+                       "steps": self.steps}, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, self.path)
+
+
+def print_plan(steps, run):
+    """
+    Prints which steps of a full load run and which are skipped.
+    """
+    print("RESUME PLAN:")
+    for step in steps:
+        print("\t{:<28} {}".format(step['name'], "run" if step['name'] in run else "skip (unchanged)"))
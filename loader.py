@@ -0,0 +1,299 @@
+import argparse
+import os
+import signal
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timezone
+
+from settings import get_settings, get_client
+from incremental import LogWatermark, list_log_files, merge_log_files, get_log_source, get_state_dir
+from inventory import record_loaded
+import instrumentation
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_loader_settings():
+    """
+    Returns the settings of the micro-batch loader (see the section '[ETL]'
+    of myDWH.cfg) as a dict.
+    """
+    config = get_settings()
+    return {'poll_s'      : config.getfloat("ETL", "LOADER_POLL_SECONDS", fallback=30),
+            'batch_bytes' : config.getfloat("ETL", "LOADER_BATCH_MB", fallback=64) * 1024 * 1024,
+            'batch_files' : config.getint("ETL", "LOADER_BATCH_FILES", fallback=100),
+            'batch_age_s' : config.getfloat("ETL", "LOADER_BATCH_AGE_SECONDS", fallback=300),
+            'max_in_flight': max(1, config.getint("ETL", "LOADER_MAX_IN_FLIGHT", fallback=2)),
+            'metrics_file': config.get("ETL", "LOADER_METRICS_FILE",
+                                       fallback=os.path.join(get_state_dir(), "loader_metrics.prom")),
+            'namespace'   : config.get("ETL", "LOADER_CLOUDWATCH_NAMESPACE", fallback="").strip()}
+
+
+def form_batches(pending, now, batch_bytes, batch_files, batch_age_s, drain=False):
+    """
+    Groups the pending log files into micro-batches.
+
+    A batch is closed once it holds 'batch_bytes' or 'batch_files'. The
+    remaining files only make a batch once the oldest of them has waited
+    'batch_age_s' seconds (or with 'drain'), so that a trickle of small files
+    is still loaded in bounded time.
+
+    Args:
+      pending (list): the log files not loaded yet, sorted by key.
+      now (datetime): the current time (timezone-aware).
+      batch_bytes (float): the size that closes a batch.
+      batch_files (int): the number of files that closes a batch.
+      batch_age_s (float): the age of the oldest file that flushes a batch.
+      drain (bool): if True, the last batch is flushed whatever its age.
+    Returns:
+      batches (list): the batches, as lists of log files, oldest first.
+    """
+    batches = []
+    batch = []
+    size = 0
+    for obj in pending:
+        batch.append(obj)
+        size += obj['Size']
+        if size >= batch_bytes or len(batch) >= batch_files:
+            batches.append(batch)
+            (batch, size) = ([], 0)
+    if batch:
+        oldest = min(obj['LastModified'] for obj in batch)
+        if drain or (now - oldest).total_seconds() >= batch_age_s:
+            batches.append(batch)
+    return batches
+
+
+class MicroBatchLoader:
+    """
+    Watches 'LOG_DATA' for new log files and merges them into the star tables
+    in micro-batches.
+
+    The batches run one at a time on a warm connection, because they share
+    the staging tables and merge into the same star tables. Up to
+    'max_in_flight' batches are formed ahead of time. Once that many are
+    queued or running, no new batch is formed and the prefix is not listed
+    again until one completes (backpressure): the files that keep arriving
+    wait, and make bigger batches that cost fewer commits.
+
+    The watermark is advanced after each committed batch. A failed batch is
+    rolled back and its files are retried at the next poll.
+    """
+    def __init__(self, conn, dsn, settings=None):
+        self.settings = settings or get_loader_settings()
+        self.dsn = dsn
+        # The connection of the local backend is used as it is. On Redshift,
+        # the pool reconnects with the resolved connection string, without
+        # looking the cluster endpoint up again.
+        self.conn = conn
+        self.pool = None
+        if dsn is not None:
+            import psycopg2.pool
+            conn.close()
+            self.pool = psycopg2.pool.ThreadedConnectionPool(1, 1, dsn)
+        self.watermark = LogWatermark.load()
+        self.claimed = {}
+        self.lock = threading.Lock()
+        self.stopping = False
+        self.pending = []
+        self.metrics = {'batches_total': 0, 'files_total': 0, 'bytes_total': 0, 'failures_total': 0,
+                        'last_batch_seconds': 0.0, 'last_batch_latency_seconds': 0.0}
+
+    def _borrow(self):
+        """
+        Returns the warm connection (from the pool on Redshift).
+        """
+        return self.conn if self.pool is None else self.pool.getconn()
+
+    def _release(self, conn, broken=False):
+        if self.pool is not None:
+            self.pool.putconn(conn, close=broken)
+
+    def poll(self):
+        """
+        Lists the log files not loaded yet and not part of a queued batch.
+
+        Returns:
+          pending (list): the log files, sorted by key.
+        """
+        objects = list_log_files()
+        with self.lock:
+            new = self.watermark.new_objects(objects)
+            return [obj for obj in new if obj['Key'] not in self.claimed]
+
+    def load_batch(self, batch):
+        """
+        Merges a batch of log files into the star tables (run by the worker
+        thread) and advances the watermark once it is committed.
+
+        Returns:
+          True if the batch was committed, False otherwise.
+        """
+        start = time.perf_counter()
+        conn = self._borrow()
+        instrumentation.start_run("loader")
+        try:
+            ok = merge_log_files(conn.cursor(), conn, batch, "loader")
+        except Exception as e:
+            print("Error executing query: {}".format(e))
+            ok = False
+        finally:
+            instrumentation.end_run()
+            # A connection closed by the failure is replaced at the next batch
+            self._release(conn, broken=bool(getattr(conn, 'closed', 0)))
+        elapsed = time.perf_counter() - start
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            if ok:
+                self.watermark.mark_loaded(batch)
+                self.watermark.save()
+                record_loaded(get_log_source(), batch)
+                self.metrics['batches_total'] += 1
+                self.metrics['files_total'] += len(batch)
+                self.metrics['bytes_total'] += sum(obj['Size'] for obj in batch)
+                self.metrics['last_batch_seconds'] = elapsed
+                self.metrics['last_batch_latency_seconds'] = max(
+                    (now - obj['LastModified']).total_seconds() for obj in batch)
+            else:
+                self.metrics['failures_total'] += 1
+            for obj in batch:
+                self.claimed.pop(obj['Key'], None)
+        if VERBOSE:
+            print("{} batch of {} files ({:.1f} MB) in {:.2f} s".format(
+                "Merged" if ok else "FAILED", len(batch), sum(obj['Size'] for obj in batch) / 1e6, elapsed))
+        return ok
+
+    def freshness_lag(self, now):
+        """
+        Returns the age in seconds of the oldest log file not merged yet
+        (queued, running or still pending), or 0 when the loader is caught up.
+        """
+        with self.lock:
+            waiting = list(self.claimed.values()) + [obj for obj in self.pending if obj['Key'] not in self.claimed]
+        if not waiting:
+            return 0.0
+        return max(0.0, (now - min(obj['LastModified'] for obj in waiting)).total_seconds())
+
+    def export_metrics(self, in_flight):
+        """
+        Writes the metrics of the loader to 'LOADER_METRICS_FILE' in the
+        Prometheus text format (e.g. for the textfile collector of the node
+        exporter), and to CloudWatch if 'LOADER_CLOUDWATCH_NAMESPACE' is set.
+        """
+        now = datetime.now(timezone.utc)
+        with self.lock:
+            gauges = dict(self.metrics, pending_files=len(self.pending), in_flight_batches=in_flight)
+        gauges['freshness_lag_seconds'] = self.freshness_lag(now)
+        path = self.settings['metrics_file']
+        if path:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            tmp_path = path + ".tmp"
+            with open(tmp_path, "w") as f:
+                for (name, value) in sorted(gauges.items()):
+                    kind = "counter" if name.endswith("_total") else "gauge"
+                    f.write("# TYPE sparkify_loader_{} {}\n".format(name, kind))
+                    f.write("sparkify_loader_{} {}\n".format(name, value))
+            os.replace(tmp_path, path)
+        if self.settings['namespace']:
+            try:
+                get_client('cloudwatch').put_metric_data(
+                    Namespace=self.settings['namespace'],
+                    MetricData=[{'MetricName': 'FreshnessLag', 'Value': gauges['freshness_lag_seconds'],
+                                 'Unit': 'Seconds', 'Timestamp': now},
+                                {'MetricName': 'PendingFiles', 'Value': gauges['pending_files'],
+                                 'Unit': 'Count', 'Timestamp': now}])
+            except Exception as e:
+                print("WARNING: Cannot publish the loader metrics to CloudWatch: {}".format(e))
+        return gauges
+
+    def run(self, once=False):
+        """
+        Polls and loads until stopped (SIGINT or SIGTERM), or, with 'once',
+        until no log file is left to merge (or a batch fails).
+
+        Returns:
+          True if no batch failed, False otherwise.
+        """
+        settings = self.settings
+        in_flight = set()
+        failed = False
+        drained = False
+        with ThreadPoolExecutor(max_workers=1) as executor:
+            while True:
+                if not self.stopping and not (once and failed) and len(in_flight) < settings['max_in_flight']:
+                    try:
+                        pending = self.poll()
+                    except Exception as e:
+                        print("WARNING: Cannot list the log files: {}".format(e))
+                        pending = []
+                    now = datetime.now(timezone.utc)
+                    batches = form_batches(pending, now, settings['batch_bytes'], settings['batch_files'],
+                                           settings['batch_age_s'], drain=once)
+                    for batch in batches[:settings['max_in_flight'] - len(in_flight)]:
+                        with self.lock:
+                            for obj in batch:
+                                self.claimed[obj['Key']] = obj
+                        in_flight.add(executor.submit(self.load_batch, batch))
+                    with self.lock:
+                        self.pending = pending
+                    drained = not batches
+                elif VERBOSE > 1 and len(in_flight) >= settings['max_in_flight']:
+                    print("Backpressure: {} batches in flight, not listing the log files".format(len(in_flight)))
+                gauges = self.export_metrics(len(in_flight))
+                if VERBOSE:
+                    print("Loader: {} pending files, {} batches in flight, freshness lag {:.0f} s".format(
+                        gauges['pending_files'], gauges['in_flight_batches'], gauges['freshness_lag_seconds']))
+                # With 'once', a failed batch is not retried
+                if not in_flight and (self.stopping or (once and (drained or failed))):
+                    break
+                if in_flight:
+                    # Wake up when a batch completes, or at the next poll
+                    (done, in_flight) = wait(in_flight, timeout=settings['poll_s'], return_when=FIRST_COMPLETED)
+                    for future in done:
+                        failed |= not future.result()
+                else:
+                    self._sleep(settings['poll_s'])
+        if self.pool is not None:
+            self.pool.closeall()
+        return not failed
+
+    def _sleep(self, seconds):
+        deadline = time.monotonic() + seconds
+        while not self.stopping and time.monotonic() < deadline:
+            time.sleep(min(1.0, deadline - time.monotonic()))
+
+    def stop(self, *args):
+        """
+        Stops polling. The batches in flight are completed first.
+        """
+        if VERBOSE:
+            print("Stopping the loader after the batches in flight...")
+        self.stopping = True
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Merge the new log files into the star tables in micro-batches.")
+    parser.add_argument("--once", action="store_true",
+                        help="merge every pending log file (whatever its age) and exit")
+    args = parser.parse_args(argv)
+
+    from create_cluster import connect_warehouse
+    (conn, dsn) = connect_warehouse()
+    loader = MicroBatchLoader(conn, dsn)
+    signal.signal(signal.SIGINT, loader.stop)
+    signal.signal(signal.SIGTERM, loader.stop)
+    ok = loader.run(args.once)
+    if dsn is None:
+        conn.close()
+    if not ok:
+        quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,336 @@
+import json
+import os
+import re
+
+from s3_utils import is_s3_uri, parse_s3_uri, strip_quotes
+from settings import get_settings
+
+# The duckdb module, imported on first use (see load_duckdb())
+duckdb = None
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 0
+
+# Redshift-only table and column attributes removed from the DDL
+REDSHIFT_ATTRIBUTES = [
+    re.compile(r"\bDISTSTYLE\s+\w+", re.IGNORECASE),
+    re.compile(r"\b(?:COMPOUND\s+|INTERLEAVED\s+)?SORTKEY\s*\([^)]*\)", re.IGNORECASE),
+    re.compile(r"\bDISTKEY\s*\([^)]*\)", re.IGNORECASE),
+    re.compile(r"\bSORTKEY\b", re.IGNORECASE),
+    re.compile(r"\bDISTKEY\b", re.IGNORECASE),
+    re.compile(r"\bENCODE\s+\w+", re.IGNORECASE),
+]
+IDENTITY_PATTERN = re.compile(r"\bIDENTITY\s*\(\s*(-?\d+)\s*,\s*(-?\d+)\s*\)", re.IGNORECASE)
+DECIMAL_PATTERN  = re.compile(r"\b(DECIMAL|NUMERIC)\b(?!\s*\()", re.IGNORECASE)
+CREATE_PATTERN   = re.compile(r"CREATE\s+TABLE\s+(?:IF\s+NOT\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+DROP_PATTERN     = re.compile(r"DROP\s+TABLE\s+(?:IF\s+EXISTS\s+)?(\w+)", re.IGNORECASE)
+COPY_PATTERN     = re.compile(r"^\s*COPY\s+(\w+)\s+FROM\s+'([^']*)'(.*)$", re.IGNORECASE | re.DOTALL)
+JSON_PATTERN     = re.compile(r"\bJSON\s+'([^']*)'", re.IGNORECASE)
+TIMEFORMAT_PATTERN = re.compile(r"\bTIMEFORMAT\s+(?:AS\s+)?'([^']*)'", re.IGNORECASE)
+JSONPATH_PATTERN = re.compile(r"^\$(?:\['([^']+)'\]|\.(\w+))$")
+DML_PATTERN      = re.compile(r"^\s*(INSERT|UPDATE|DELETE)\b", re.IGNORECASE)
+REGEXP_REPLACE_PATTERN = re.compile(r"\bREGEXP_REPLACE\s*\(", re.IGNORECASE)
+
+# The Redshift functions missing from DuckDB, defined on each connection.
+# FNV_HASH returns a BIGINT (DuckDB's hash() is unsigned) and REGEXP_REPLACE
+# replaces every occurrence (DuckDB's only replaces the first by default).
+REDSHIFT_MACROS = [
+    "CREATE OR REPLACE TEMP MACRO fnv_hash(value) AS CAST(hash(value) >> 1 AS BIGINT)",
+    "CREATE OR REPLACE TEMP MACRO regexp_replace_all(string, pattern, replacement) AS "
+    "regexp_replace(string, pattern, replacement, 'g')",
+]
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def load_duckdb():
+    """
+    Imports and returns the duckdb module. It is only imported when the local
+    backend is actually used, so the Redshift runs do not pay for its import.
+    """
+    global duckdb
+    if duckdb is None:
+        try:
+            import duckdb as module
+        except ImportError:
+            raise ImportError("The \'duckdb\' package is required for the local backend")
+        duckdb = module
+    return duckdb
+
+
+def get_backend():
+    """
+    Returns the execution backend as a string: 'redshift' or 'duckdb'.
+    """
+    return get_settings().get("ETL", "BACKEND", fallback="redshift").strip().lower()
+
+
+def backend_uri(uri):
+    """
+    Returns where an S3 URI is read or written on the configured backend: the
+    URI itself on Redshift, its path in the local mirror of the bucket
+    ('DATA_DIR' of the section '[LOCAL]') on the local backend.
+    """
+    if get_backend() == "duckdb":
+        return LocalEngine(strip_quotes(get_settings().get("LOCAL", "DATA_DIR", fallback="data"))).local_path(uri)
+    return strip_quotes(uri)
+
+
+class LocalError(Exception):
+    """
+    The error raised by a failed statement on the local backend, the
+    counterpart of psycopg2.Error.
+    """
+
+
+def database_error():
+    """
+    Returns the exception class(es) of a failed statement on the configured
+    backend, e.g. 'except database_error() as e:'. psycopg2 is only imported
+    by the Redshift runs.
+    """
+    if get_backend() == "duckdb":
+        return LocalError
+    import psycopg2
+    return (psycopg2.Error, LocalError)
+
+
+def _split_statements(query):
+    """
+    Splits a string into its SQL statements (the queries hold no ';' in literals).
+    """
+    return [statement.strip() for statement in query.split(";") if statement.strip()]
+
+
+class LocalEngine:
+    """
+    Translates the Redshift SQL of 'sql_queries.py' into DuckDB SQL.
+
+    The S3 URIs are mapped to a local directory that mirrors the bucket,
+    e.g. 's3://udacity-dend/log_data' becomes '<data_dir>/log_data' and
+    's3://udacity-dend/log_json_path.json' becomes
+    '<data_dir>/log_json_path.json'. Local paths are used as they are.
+    """
+    def __init__(self, data_dir):
+        self.data_dir = data_dir
+
+    def local_path(self, uri):
+        """
+        Returns the local path mirroring an S3 URI.
+        """
+        uri = strip_quotes(uri)
+        if is_s3_uri(uri):
+            (_, key) = parse_s3_uri(uri)
+            return os.path.join(self.data_dir, key)
+        return uri
+
+    def translate(self, statement, conn):
+        """
+        Translates a single Redshift statement into DuckDB statements.
+
+        Args:
+          statement (str): a Redshift SQL statement.
+          conn (duckdb.DuckDBPyConnection): the database, used to look up the
+              columns of the table loaded by a COPY.
+        Returns:
+          statements (list): the DuckDB SQL statements to execute in order.
+        """
+        if COPY_PATTERN.match(statement):
+            (table, source, options) = COPY_PATTERN.match(statement).groups()
+            return [self.copy_sql(conn, table, source, options)]
+        if CREATE_PATTERN.match(statement):
+            return self._translate_create(statement, conn)
+        if DROP_PATTERN.match(statement):
+            table = DROP_PATTERN.match(statement).group(1)
+            return [statement] + ["DROP SEQUENCE IF EXISTS {}".format(sequence)
+                                  for sequence in self.table_sequences(conn, table)]
+        return [REGEXP_REPLACE_PATTERN.sub("regexp_replace_all(", statement)]
+
+    def table_sequences(self, conn, table):
+        """
+        Returns the sequences that generate the IDENTITY columns of a table.
+        A renamed table keeps the sequence it was created with.
+        """
+        rows = conn.execute("SELECT column_default FROM information_schema.columns "
+                            "WHERE lower(table_name) = lower(?)", [table]).fetchall()
+        return [match.group(1) for (default,) in rows
+                for match in [re.match(r"nextval\('([^']+)'\)", default or "")] if match]
+
+    def _translate_create(self, statement, conn):
+        table = CREATE_PATTERN.match(statement).group(1).lower()
+        for pattern in REDSHIFT_ATTRIBUTES:
+            statement = pattern.sub("", statement)
+        statement = DECIMAL_PATTERN.sub(r"\1(18,0)", statement)
+        statements = []
+        match = IDENTITY_PATTERN.search(statement)
+        if match is not None:
+            (seed, step) = (int(match.group(1)), int(match.group(2)))
+            # A table renamed by a publish swap (see publish.py) may still
+            # own the sequence named after this table
+            existing = {name for (name,) in conn.execute("SELECT sequence_name FROM duckdb_sequences()").fetchall()}
+            sequence = "{}_identity".format(table)
+            suffix = 1
+            while sequence in existing:
+                suffix += 1
+                sequence = "{}_identity_{}".format(table, suffix)
+            statements.append("CREATE SEQUENCE IF NOT EXISTS {} START {} INCREMENT {} MINVALUE {}".format(
+                sequence, seed, step, min(seed, 0)))
+            statement = IDENTITY_PATTERN.sub("DEFAULT nextval('{}')".format(sequence), statement)
+        statements.append(statement)
+        return statements
+
+    def table_columns(self, conn, table):
+        """
+        Returns the list of (name, type) of a table, in column order.
+        """
+        rows = conn.execute("SELECT column_name, data_type FROM information_schema.columns "
+                            "WHERE lower(table_name) = lower(?) ORDER BY ordinal_position", [table]).fetchall()
+        return [(name, data_type) for (name, data_type) in rows]
+
+    def _source_files(self, source, options):
+        path = self.local_path(source)
+        if re.search(r"\bMANIFEST\b", options, re.IGNORECASE):
+            with open(path) as f:
+                return [self.local_path(entry['url']) for entry in json.load(f)['entries']]
+        if os.path.isdir(path):
+            return [os.path.join(path, "**", "*")]
+        # A COPY prefix matches every key starting with it
+        return [path + "*"]
+
+    def copy_sql(self, conn, table, source, options):
+        """
+        Builds the INSERT ... SELECT that loads local files into a table.
+        """
+        columns = self.table_columns(conn, table)
+        files = self._source_files(source, options)
+        file_list = "[{}]".format(", ".join("'{}'".format(f) for f in files))
+        column_names = ", ".join(name for (name, _) in columns)
+        if re.search(r"\bFORMAT\s+AS\s+PARQUET\b", options, re.IGNORECASE):
+            return "INSERT INTO {} ({}) SELECT * FROM read_parquet({})".format(table, column_names, file_list)
+
+        # Map each table column to its JSON key (by position with a jsonpaths
+        # file, by name with 'auto')
+        json_option = JSON_PATTERN.search(options)
+        json_option = json_option.group(1) if json_option else 'auto'
+        if json_option.lower() in ('auto', 'auto ignorecase'):
+            keys = [name.lower() for (name, _) in columns]
+        else:
+            with open(self.local_path(json_option)) as f:
+                paths = json.load(f)['jsonpaths']
+            keys = []
+            for path in paths:
+                match = JSONPATH_PATTERN.match(path)
+                keys.append(match.group(1) or match.group(2))
+        timeformat = TIMEFORMAT_PATTERN.search(options)
+        timeformat = timeformat.group(1).lower() if timeformat else 'auto'
+
+        selects = []
+        for ((name, data_type), key) in zip(columns, keys):
+            value = "NULLIF(\"{}\", '')".format(key)
+            if data_type.upper().startswith("TIMESTAMP") and timeformat == 'epochmillisecs':
+                selects.append("epoch_ms(TRY_CAST({} AS BIGINT))".format(value))
+            else:
+                selects.append("TRY_CAST({} AS {})".format(value, data_type))
+        json_columns = ", ".join("'{}': 'VARCHAR'".format(key) for key in keys)
+        return "INSERT INTO {} ({}) SELECT {} FROM read_json({}, columns={{{}}}, format='auto', union_by_name=true)".format(
+            table, ", ".join(name for (name, _) in columns[:len(keys)]), ", ".join(selects), file_list, json_columns)
+
+
+class LocalCursor:
+    """
+    A psycopg2-like cursor that runs translated Redshift SQL on DuckDB.
+    """
+    def __init__(self, connection):
+        self.connection = connection
+        self.rowcount = -1
+        self._result = None
+
+    def execute(self, query, params=None):
+        self.rowcount = -1
+        self._result = None
+        engine = self.connection.engine
+        db = self.connection.db
+        try:
+            self.connection._begin()
+            for redshift_statement in _split_statements(query):
+                for statement in engine.translate(redshift_statement, db):
+                    if VERBOSE > 1:
+                        print("DUCKDB: " + statement)
+                    self._result = db.execute(statement, params) if params else db.execute(statement)
+                    if DML_PATTERN.match(statement):
+                        row = self._result.fetchone()
+                        self.rowcount = row[0] if row else 0
+                        self._result = None
+        except duckdb.Error as e:
+            raise LocalError(str(e))
+
+    def fetchone(self):
+        return self._result.fetchone() if self._result is not None else None
+
+    def fetchall(self):
+        return self._result.fetchall() if self._result is not None else []
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+class LocalConnection:
+    """
+    A psycopg2-like connection to an embedded DuckDB database.
+
+    As with psycopg2, a transaction is opened by the first statement and
+    lasts until 'commit()' or 'rollback()' is called.
+    """
+    def __init__(self, data_dir, database=":memory:"):
+        self.db = load_duckdb().connect(database)
+        self.engine = LocalEngine(data_dir)
+        self._in_transaction = False
+        for macro in REDSHIFT_MACROS:
+            self.db.execute(macro)
+
+    def _begin(self):
+        if not self._in_transaction:
+            self.db.execute("BEGIN TRANSACTION")
+            self._in_transaction = True
+
+    def cursor(self):
+        return LocalCursor(self)
+
+    def commit(self):
+        if self._in_transaction:
+            self.db.execute("COMMIT")
+            self._in_transaction = False
+
+    def rollback(self):
+        if self._in_transaction:
+            self.db.execute("ROLLBACK")
+            self._in_transaction = False
+
+    def close(self):
+        self.rollback()
+        self.db.close()
+
+
+def connect(data_dir=None, database=None):
+    """
+    Opens a connection to the local DuckDB backend (see the section '[LOCAL]'
+    of 'myDWH.cfg').
+
+    Args:
+      data_dir (str): the local mirror of the S3 bucket. Defaults to 'DATA_DIR'.
+      database (str): the DuckDB database file. Defaults to 'DATABASE'.
+    Returns:
+      conn (LocalConnection): a psycopg2-like connection.
+    """
+    config = get_settings()
+    if data_dir is None:
+        data_dir = config.get("LOCAL", "DATA_DIR", fallback="data")
+    if database is None:
+        database = config.get("LOCAL", "DATABASE", fallback=":memory:")
+    return LocalConnection(strip_quotes(data_dir), strip_quotes(database))
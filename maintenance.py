@@ -0,0 +1,216 @@
+import argparse
+import time
+
+from settings import get_settings
+from local_engine import database_error
+from publish import STAR_TABLES
+from instrumentation import timed_execute, typical_duration
+import instrumentation
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The health of the star tables. 'unsorted' is NULL for a table without a
+# sort key, and the rows marked for deletion are the difference between
+# 'tbl_rows' and 'estimated_visible_rows'.
+TABLE_HEALTH_QUERY = """
+SELECT "table", tbl_rows, estimated_visible_rows, unsorted, stats_off
+FROM svv_table_info
+WHERE "schema" = current_schema() AND "table" IN ({});
+"""
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_maintenance():
+    """
+    Returns True if the tables are maintained after each load (see myDWH.cfg).
+    """
+    return get_settings().getboolean("ETL", "MAINTENANCE", fallback=False)
+
+
+def get_thresholds():
+    """
+    Returns the maintenance thresholds of 'myDWH.cfg' as a dict of
+    percentages: 'unsorted', 'deleted' and 'stats_off'.
+    """
+    config = get_settings()
+    return {'unsorted' : config.getfloat("ETL", "VACUUM_UNSORTED_PCT", fallback=10),
+            'deleted'  : config.getfloat("ETL", "VACUUM_DELETED_PCT", fallback=10),
+            'stats_off': config.getfloat("ETL", "ANALYZE_STATS_OFF_PCT", fallback=10)}
+
+
+def get_budget():
+    """
+    Returns the time budget of a maintenance run in seconds.
+    """
+    return get_settings().getfloat("ETL", "MAINTENANCE_BUDGET", fallback=600)
+
+
+def table_health(cur):
+    """
+    Reads the health of the star tables from SVV_TABLE_INFO.
+
+    Returns:
+      A dict of {table: health} where 'health' is a dict with the keys 'rows',
+      'unsorted', 'deleted' and 'stats_off' (the last three in percent). An
+      empty table is not listed by SVV_TABLE_INFO.
+    """
+    names = {name.lower(): name for name in STAR_TABLES}
+    cur.execute(TABLE_HEALTH_QUERY.format(", ".join("\'{}\'".format(name) for name in names)))
+    health = {}
+    for (table, tbl_rows, visible_rows, unsorted, stats_off) in cur.fetchall():
+        tbl_rows = tbl_rows or 0
+        deleted = 100.0 * max(tbl_rows - (visible_rows or 0), 0) / tbl_rows if tbl_rows else 0.0
+        health[names[table.strip().lower()]] = {'rows'     : tbl_rows,
+                                                'unsorted' : float(unsorted or 0),
+                                                'deleted'  : deleted,
+                                                'stats_off': float(stats_off or 0)}
+    return health
+
+
+def plan_maintenance(health, thresholds):
+    """
+    Selects the maintenance statements of the tables whose health exceeds a
+    threshold.
+
+    A table with both unsorted and deleted rows gets a single 'VACUUM FULL'
+    rather than two passes. The VACUUM statements come first, ordered by the
+    number of rows they fix, then the ANALYZE statements (the statistics are
+    best collected on vacuumed tables).
+
+    Args:
+      health (dict): the health of each table (see 'table_health()').
+      thresholds (dict): the thresholds in percent (see 'get_thresholds()').
+    Returns:
+      A list of (table, statement, reason) tuples in execution order.
+    """
+    vacuums = []
+    analyzes = []
+    for (table, state) in health.items():
+        unsorted = state['unsorted'] > thresholds['unsorted']
+        deleted = state['deleted'] > thresholds['deleted']
+        if unsorted and deleted:
+            vacuum = "VACUUM FULL"
+        elif unsorted:
+            vacuum = "VACUUM SORT ONLY"
+        elif deleted:
+            vacuum = "VACUUM DELETE ONLY"
+        else:
+            vacuum = None
+        if vacuum is not None:
+            reason = "unsorted {:.1f}%, deleted {:.1f}%".format(state['unsorted'], state['deleted'])
+            impact = state['rows'] * max(state['unsorted'], state['deleted'])
+            vacuums.append((impact, table, vacuum, reason))
+        if state['stats_off'] > thresholds['stats_off']:
+            reason = "stats_off {:.1f}%".format(state['stats_off'])
+            analyzes.append((state['rows'] * state['stats_off'], table, "ANALYZE", reason))
+    ordered = sorted(vacuums, reverse=True) + sorted(analyzes, reverse=True)
+    return [(table, statement, reason) for (_, table, statement, reason) in ordered]
+
+
+def maintain(cur, conn, budget=None, dry_run=False):
+    """
+    Runs VACUUM and ANALYZE on the star tables whose health exceeds the
+    thresholds of 'myDWH.cfg', within a time budget.
+
+    A statement is deferred to the next run when its typical duration (from
+    the run history) no longer fits in the remaining budget, or when the
+    budget is spent. VACUUM cannot run inside a transaction block, so the
+    statements run in autocommit mode.
+
+    Args:
+      cur (psycopg2.extensions.cursor): a cursor on the connection 'conn'.
+      conn (psycopg2.extensions.connection): a connection to the cluster.
+      budget (float): the time budget in seconds. Defaults to 'get_budget()'.
+      dry_run (bool): if True, the plan is printed but not executed.
+    Returns:
+      True if no statement failed, False otherwise.
+    """
+    budget = get_budget() if budget is None else budget
+    try:
+        health = table_health(cur)
+    except database_error() as e:
+        print("Error executing query: {}".format(e))
+        conn.rollback()
+        return False
+    conn.commit()
+    plan = plan_maintenance(health, get_thresholds())
+    if VERBOSE:
+        print("TABLE HEALTH:")
+        print("\t{:<14} {:>12} {:>10} {:>10} {:>10}".format("table", "rows", "unsorted %", "deleted %", "stats_off"))
+        for (table, state) in health.items():
+            print("\t{:<14} {:>12} {:10.1f} {:10.1f} {:10.1f}".format(
+                table, state['rows'], state['unsorted'], state['deleted'], state['stats_off']))
+    if not plan:
+        if VERBOSE:
+            print("No maintenance needed.")
+        return True
+
+    ok = True
+    log = []
+    start = time.perf_counter()
+    autocommit = conn.autocommit
+    conn.autocommit = True
+    try:
+        for (table, statement, reason) in plan:
+            name = "{} {}".format(statement, table)
+            remaining = budget - (time.perf_counter() - start)
+            expected = typical_duration(name)
+            if dry_run:
+                log.append((name, reason, "planned", expected))
+            elif remaining <= 0 or (expected is not None and expected > remaining):
+                log.append((name, reason, "deferred", expected))
+            else:
+                try:
+                    record = timed_execute(cur, conn, "{} {};".format(statement, table), "maintenance", name)
+                    log.append((name, reason, "done", record['wall_s']))
+                except database_error() as e:
+                    print("Error executing query: {}".format(e))
+                    log.append((name, reason, "failed", None))
+                    ok = False
+    finally:
+        conn.autocommit = autocommit
+
+    if VERBOSE:
+        print("MAINTENANCE (budget {:.0f} s, spent {:.1f} s):".format(budget, time.perf_counter() - start))
+        for (name, reason, outcome, seconds) in log:
+            print("\t{:<32} {:<30} {:<9} {}".format(
+                name, reason, outcome, "{:.1f} s".format(seconds) if seconds is not None else "-"))
+    return ok
+
+
+def run(conn, dsn, budget=None, dry_run=False):
+    """
+    Maintains the star tables on an open connection (see 'maintain()').
+
+    Returns:
+      True if no statement failed, False otherwise.
+    """
+    if dsn is None:
+        print("ERROR: The maintenance is not supported by the local backend.")
+        return False
+    instrumentation.start_run("maintenance")
+    ok = maintain(conn.cursor(), conn, budget, dry_run)
+    instrumentation.end_run()
+    return ok
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Vacuum and analyze the star tables that need it.")
+    parser.add_argument("--budget", type=float, default=None,
+                        help="time budget in seconds (default=MAINTENANCE_BUDGET)")
+    parser.add_argument("--dry-run", action="store_true",
+                        help="print the table health and the plan without executing it")
+    args = parser.parse_args(argv)
+
+    from create_cluster import connect_warehouse
+    (conn, dsn) = connect_warehouse()
+    ok = run(conn, dsn, args.budget, args.dry_run)
+    conn.close()
+    if not ok:
+        quit()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,191 @@
+import heapq
+import json
+import os
+
+from inventory import get_listing, source_uri
+from local_engine import backend_uri
+from s3_utils import get_s3_client, is_s3_uri, object_uri, parse_s3_uri, strip_quotes
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# Number of slices per node for each Redshift node type
+NODE_SLICES = {
+    'dc2.large'   : 2,
+    'dc2.8xlarge' : 16,
+    'ds2.xlarge'  : 2,
+    'ds2.8xlarge' : 16,
+    'ra3.xlplus'  : 2,
+    'ra3.4xlarge' : 4,
+    'ra3.16xlarge': 16,
+}
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_slice_count(cur=None):
+    """
+    Returns the number of slices of the cluster.
+
+    Args:
+      cur (psycopg2.extensions.cursor): if set, the count is queried from the
+          system table 'STV_SLICES'. Otherwise, it is derived from the
+          'CLUSTER_NODE_TYPE' and 'CLUSTER_NODE_COUNT' of 'myDWH.cfg'.
+    Returns:
+      slices (int): the number of slices (at least 1).
+    """
+    if cur is not None:
+        cur.execute("SELECT COUNT(*) FROM stv_slices;")
+        return max(1, cur.fetchone()[0])
+    config = get_settings()
+    node_type = config.get("CLUSTER", "CLUSTER_NODE_TYPE").strip()
+    node_count = config.getint("CLUSTER", "CLUSTER_NODE_COUNT")
+    if node_type not in NODE_SLICES:
+        print("WARNING: Unknown node type \'{}\', assuming 2 slices per node.".format(node_type))
+    return max(1, NODE_SLICES.get(node_type, 2) * node_count)
+
+
+def plan_slices(objects, slices):
+    """
+    Balances a list of objects into N sets of roughly equal size in bytes.
+
+    The objects are assigned from the largest to the smallest to the set with
+    the fewest bytes so far (longest-processing-time first).
+
+    Args:
+      objects (list): a listing as returned by 's3_utils.list_objects()'.
+      slices (int): the number of sets to build.
+    Returns:
+      groups (list): a list of 'slices' dicts with the keys 'objects' and
+          'bytes'.
+    """
+    groups = [{'objects': [], 'bytes': 0} for _ in range(max(1, slices))]
+    heap = [(0, i) for i in range(len(groups))]
+    for obj in sorted(objects, key=lambda obj: obj['Size'], reverse=True):
+        (size, i) = heapq.heappop(heap)
+        groups[i]['objects'].append(obj)
+        groups[i]['bytes'] += obj['Size']
+        heapq.heappush(heap, (groups[i]['bytes'], i))
+    return groups
+
+
+def print_plan(groups):
+    """
+    Prints the planned bytes per slice and the resulting skew.
+    """
+    sizes = [group['bytes'] for group in groups]
+    mean = sum(sizes) / len(sizes) if sizes else 0
+    print("COPY PLAN ({} files, {} bytes, {} slices):".format(
+        sum(len(group['objects']) for group in groups), sum(sizes), len(groups)))
+    for (i, group) in enumerate(groups):
+        print("\tslice {:>3}: {:>6} files {:>14} bytes".format(i, len(group['objects']), group['bytes']))
+    if mean > 0:
+        print("\tskew (max/mean) = {:.3f}".format(max(sizes) / mean))
+
+
+def build_manifest(uri, groups):
+    """
+    Builds a COPY manifest from the planned sets of objects.
+
+    The entries are interleaved across the sets so that consecutive entries
+    belong to different slices.
+
+    Args:
+      uri (str): the S3 URI the objects were listed from.
+      groups (list): the sets returned by 'plan_slices()'.
+    Returns:
+      manifest (dict): the manifest, ready to be serialized as JSON.
+    """
+    entries = []
+    depth = max((len(group['objects']) for group in groups), default=0)
+    for rank in range(depth):
+        for group in groups:
+            if rank < len(group['objects']):
+                obj = group['objects'][rank]
+                entries.append({'url': object_uri(uri, obj['Key']),
+                                'mandatory': True,
+                                'meta': {'content_length': obj['Size']}})
+    return {'entries': entries}
+
+
+def write_manifest(manifest, destination, client=None):
+    """
+    Writes a manifest to S3 or to a local file.
+
+    Args:
+      manifest (dict): the manifest returned by 'build_manifest()'.
+      destination (str): an S3 URI or a local file path.
+      client (boto3.client): an S3 client. Defaults to 'get_s3_client()'.
+    Returns:
+      destination (str): the URI or path the manifest was written to.
+    """
+    body = json.dumps(manifest, indent=2)
+    if is_s3_uri(destination):
+        (bucket, key) = parse_s3_uri(destination)
+        (client or get_s3_client()).put_object(Bucket=bucket, Key=key, Body=body.encode('utf-8'))
+        return strip_quotes(destination)
+    destination = strip_quotes(destination)
+    directory = os.path.dirname(destination)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    with open(destination, "w") as f:
+        f.write(body)
+    return destination
+
+
+def generate_manifest(uri, destination, slices, client=None, suffix=".json", objects=None):
+    """
+    Lists a source prefix (from the inventory if it is used, see
+    inventory.py), balances its objects across the slices and writes the COPY
+    manifest.
+
+    Args:
+      uri (str): the S3 URI (or local directory) of the source data.
+      destination (str): where to write the manifest (S3 URI or local path).
+      slices (int): the number of slices of the cluster.
+      client (boto3.client): an S3 client (e.g. a local S3 stand-in).
+      suffix (str): only the keys ending with this suffix are listed.
+      objects (list): the listing of 'uri', if it was already listed.
+    Returns:
+      destination (str): the URI or path the manifest was written to.
+    """
+    if objects is None:
+        objects = get_listing(uri, suffix=suffix, client=client)
+    groups = plan_slices(objects, slices)
+    if VERBOSE:
+        print("Manifest for \'{}\' -> \'{}\'".format(strip_quotes(uri), strip_quotes(destination)))
+        print_plan(groups)
+    return write_manifest(build_manifest(uri, groups), destination, client=client)
+
+
+def prepare_manifests(cur=None, client=None, listings=None):
+    """
+    Writes the COPY manifests of the log and song datasets (see myDWH.cfg).
+
+    Args:
+      cur (psycopg2.extensions.cursor): optional cursor to query the slices.
+      client (boto3.client): an S3 client. Defaults to 'get_s3_client()'.
+      listings (dict): the listings of the datasets already listed by the
+          run, by staging table name. The others are listed here.
+    Returns:
+      manifests (dict): maps the staging table names to their manifest URIs.
+    """
+    config = get_settings()
+    prefix = backend_uri(config.get("ETL", "MANIFEST_PREFIX")).rstrip("/")
+    slices = get_slice_count(cur)
+    listings = listings or {}
+    return {
+        'staging_events': generate_manifest(source_uri("LOG_DATA"),
+                                            prefix + "/staging_events.manifest",
+                                            slices, client=client,
+                                            objects=listings.get('staging_events')),
+        'staging_songs':  generate_manifest(source_uri("SONG_DATA"),
+                                            prefix + "/staging_songs.manifest",
+                                            slices, client=client,
+                                            objects=listings.get('staging_songs')),
+    }
+
+
+if __name__ == "__main__":
+    prepare_manifests()
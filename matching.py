@@ -0,0 +1,127 @@
+import argparse
+
+from sql_queries import match_key
+from local_engine import database_error
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The NextSong events that can be matched to a song (the others have no title
+# or no artist and are dropped by both joins)
+EVENTS_QUERY = """
+SELECT COUNT(*) FROM staging_events
+WHERE page = 'NextSong' AND song IS NOT NULL AND artist IS NOT NULL;
+"""
+
+# The events matched by the exact join on the raw strings
+EXACT_MATCH_QUERY = """
+SELECT COUNT(*) FROM staging_events
+WHERE page = 'NextSong'
+  AND EXISTS (SELECT 1 FROM staging_songs
+              WHERE staging_events.song   = staging_songs.title
+                AND staging_events.artist = staging_songs.artist_name);
+"""
+
+# The rows produced by the exact join before its DISTINCT, i.e. including the
+# duplicates caused by a title listed under several song ids
+EXACT_JOIN_ROWS_QUERY = """
+SELECT COUNT(*) FROM staging_events
+JOIN staging_songs
+    ON staging_events.song   = staging_songs.title AND
+       staging_events.artist = staging_songs.artist_name
+WHERE staging_events.page = 'NextSong';
+"""
+
+# The events matched on the normalized match key
+KEY_MATCH_QUERY = """
+SELECT COUNT(*) FROM staging_event_keys
+WHERE EXISTS (SELECT 1 FROM staging_song_keys
+              WHERE staging_song_keys.match_key = staging_event_keys.match_key);
+"""
+
+# Events matched on the key but dropped by the exact join, with the song they
+# were matched to
+RECOVERED_EXAMPLES_QUERY = """
+SELECT DISTINCT staging_events.song, staging_events.artist, staging_songs.title, staging_songs.artist_name
+FROM staging_events
+JOIN staging_songs
+    ON {} = {}
+WHERE staging_events.page = 'NextSong'
+  AND NOT EXISTS (SELECT 1 FROM staging_songs AS exact
+                  WHERE staging_events.song   = exact.title
+                    AND staging_events.artist = exact.artist_name)
+LIMIT {};
+"""
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def match_rate(cur, examples=10):
+    """
+    Compares the songplays found by the exact string join with those found on
+    the normalized match key, on the content of the staging tables.
+
+    Args:
+      cur (psycopg2.extensions.cursor): a cursor on the warehouse, after a
+          load (the key tables are filled by the normalize queries).
+      examples (int): the number of recovered matches to return.
+    Returns:
+      A dict with the keys 'events', 'exact', 'exact_rows', 'key' (the counts)
+      and 'examples', a list of (song, artist, title, artist_name) tuples.
+    """
+    report = {}
+    for (name, query) in [('events', EVENTS_QUERY),
+                          ('exact', EXACT_MATCH_QUERY),
+                          ('exact_rows', EXACT_JOIN_ROWS_QUERY),
+                          ('key', KEY_MATCH_QUERY)]:
+        cur.execute(query)
+        report[name] = cur.fetchone()[0]
+    cur.execute(RECOVERED_EXAMPLES_QUERY.format(
+        match_key.format("staging_events.song", "staging_events.artist"),
+        match_key.format("staging_songs.title", "staging_songs.artist_name"),
+        int(examples)))
+    report['examples'] = cur.fetchall()
+    return report
+
+
+def print_report(report):
+    """
+    Prints a match-rate report (see 'match_rate()').
+    """
+    events = report['events']
+
+    def rate(count):
+        return "{:>10} {:6.1f}%".format(count, 100.0 * count / events if events else 0.0)
+
+    print("MATCH RATE ({} NextSong events with a title and an artist):".format(events))
+    print("\t{:<36} {}".format("exact join (song, artist)", rate(report['exact'])))
+    print("\t{:<36} {}".format("normalized match key", rate(report['key'])))
+    print("\t{:<36} {}".format("dropped by the exact join", rate(report['key'] - report['exact'])))
+    print("\t{:<36} {}".format("unmatched by both", rate(events - report['key'])))
+    print("\t{:<36} {:>10}".format("exact join rows before DISTINCT", report['exact_rows']))
+    if report['examples']:
+        print("RECOVERED MATCHES (event -> song):")
+        for (song, artist, title, artist_name) in report['examples']:
+            print("\t\'{}\' by \'{}\' -> \'{}\' by \'{}\'".format(song, artist, title, artist_name))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Report how many events the exact songplay join drops.")
+    parser.add_argument("--examples", type=int, default=10,
+                        help="the number of recovered matches to print (default=10)")
+    args = parser.parse_args(argv)
+
+    from create_cluster import connect_warehouse
+    (conn, _) = connect_warehouse()
+    try:
+        report = match_rate(conn.cursor(), args.examples)
+    except database_error() as e:
+        print("Error executing query: {}".format(e))
+        conn.close()
+        quit()
+    conn.close()
+    print_report(report)
+
+
+if __name__ == "__main__":
+    main()
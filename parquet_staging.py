@@ -0,0 +1,318 @@
+import argparse
+import os
+import re
+import shutil
+import tempfile
+import time
+from datetime import datetime, timezone
+
+from compaction import clear_destination
+from inventory import source_uri
+from local_engine import backend_uri
+from manifest import write_manifest
+from projection import staging_table_create
+from s3_utils import get_s3_client, is_s3_uri, list_objects, object_uri, parse_s3_uri, read_json_records, strip_quotes
+from settings import get_settings
+import synthetic_data
+
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# A column definition of a CREATE TABLE statement (e.g. 'song_id VARCHAR(18)')
+COLUMN_PATTERN = re.compile(r"^\s*(\w+)\s+([A-Za-z]+)(?:\((\d+)(?:,\s*(\d+))?\))?", re.MULTILINE)
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def _require_pyarrow():
+    if pa is None:
+        raise ImportError("The \'pyarrow\' package is required for the Parquet staging path")
+
+
+def parse_columns(create_query):
+    """
+    Extracts the column names and SQL types of a CREATE TABLE statement.
+
+    Args:
+      create_query (str): a statement such as 'staging_events_table_create'.
+    Returns:
+      columns (list): a list of 4-tuples (name, type, precision, scale) in
+          table order. The precision and the scale are None if not declared.
+    """
+    body = create_query[create_query.index("(") + 1:create_query.rindex(")")]
+    columns = []
+    for match in COLUMN_PATTERN.finditer(body):
+        (name, sql_type, precision, scale) = match.groups()
+        columns.append((name, sql_type.upper(),
+                        int(precision) if precision else None,
+                        int(scale) if scale else None))
+    return columns
+
+
+def arrow_type(sql_type, precision, scale):
+    """
+    Returns the Arrow type that COPY loads into a given Redshift column type.
+    """
+    _require_pyarrow()
+    if sql_type in ("VARCHAR", "CHAR", "TEXT"):
+        return pa.string()
+    if sql_type in ("INTEGER", "INT", "INT4"):
+        return pa.int32()
+    if sql_type in ("BIGINT", "INT8"):
+        return pa.int64()
+    if sql_type in ("DECIMAL", "NUMERIC"):
+        # Redshift defaults to DECIMAL(18,0)
+        return pa.decimal128(precision or 18, scale or 0)
+    if sql_type == "TIMESTAMP":
+        return pa.timestamp('ms')
+    if sql_type in ("FLOAT", "DOUBLE", "REAL"):
+        return pa.float64()
+    if sql_type == "BOOLEAN":
+        return pa.bool_()
+    raise ValueError("Unsupported column type \'{}\'".format(sql_type))
+
+
+def get_schema(table):
+    """
+    Returns the Arrow schema of a staging table, in table column order.
+    """
+    return pa.schema([(name, arrow_type(sql_type, precision, scale))
+                      for (name, sql_type, precision, scale) in parse_columns(staging_table_create(table))])
+
+
+def _clean(value, arrow_t):
+    """
+    Normalizes a JSON value before it is typed (e.g. '' becomes NULL).
+    """
+    if value is None or value == "":
+        return None
+    if pa.types.is_integer(arrow_t) or pa.types.is_timestamp(arrow_t):
+        return int(value)
+    if pa.types.is_decimal(arrow_t) or pa.types.is_floating(arrow_t):
+        return float(value)
+    if pa.types.is_string(arrow_t):
+        return str(value)
+    return value
+
+
+def records_to_table(records, schema):
+    """
+    Converts a list of JSON records into an Arrow table typed by a schema.
+
+    The JSON keys are matched to the column names without regard to case, as
+    COPY does with the 'auto' option. The 'ts' epoch in milliseconds becomes a
+    TIMESTAMP as with the 'epochmillisecs' time format.
+    """
+    arrays = []
+    for field in schema:
+        values = []
+        for record in records:
+            value = record.get(field.name)
+            if value is None:
+                value = record.get(field.name.lower())
+            values.append(_clean(value, field.type))
+        if pa.types.is_decimal(field.type):
+            array = pc.cast(pa.array(values, type=pa.float64()), field.type, safe=False)
+        elif pa.types.is_timestamp(field.type):
+            array = pa.array(values, type=pa.int64()).cast(field.type)
+        else:
+            array = pa.array(values, type=field.type)
+        arrays.append(array)
+    return pa.Table.from_arrays(arrays, schema=schema)
+
+
+def convert(table, source, destination, rows_per_file=1000000, row_group_rows=100000, client=None,
+            objects=None):
+    """
+    Streams the JSON files of a source prefix into typed Parquet files.
+
+    Records are buffered up to 'row_group_rows' before they are typed and
+    written as a row group, and a new Parquet file is started every
+    'rows_per_file' rows. For an S3 destination, each file is written locally
+    and uploaded when it is complete.
+
+    Args:
+      table (str): 'staging_events' or 'staging_songs'.
+      source (str): the S3 URI or local directory of the JSON files.
+      destination (str): the S3 URI or local directory of the Parquet files.
+      rows_per_file (int): the maximum number of rows per Parquet file.
+      row_group_rows (int): the number of rows per row group.
+      client (boto3.client): the S3 client used to list and to upload.
+      objects (list): the JSON files to convert, as listed by
+          's3_utils.list_objects()'. Defaults to a listing of 'source'.
+    Returns:
+      outputs (list): the URIs or paths of the Parquet files written.
+    """
+    _require_pyarrow()
+    schema = get_schema(table)
+    destination = strip_quotes(destination).rstrip("/")
+    to_s3 = is_s3_uri(destination)
+    # The COPY loads the whole prefix: the files of a previous conversion go
+    clear_destination(destination, client=client)
+    workdir = tempfile.mkdtemp(prefix="parquet-") if to_s3 else destination
+    os.makedirs(workdir, exist_ok=True)
+
+    outputs = []
+    state = {'writer': None, 'path': None, 'rows': 0}
+    buffer = []
+
+    def close_file():
+        if state['writer'] is None:
+            return
+        state['writer'].close()
+        if to_s3:
+            (bucket, prefix) = parse_s3_uri(destination)
+            key = "{}/{}".format(prefix, os.path.basename(state['path'])).lstrip("/")
+            (client or get_s3_client()).upload_file(state['path'], bucket, key)
+            os.remove(state['path'])
+            outputs.append("s3://{}/{}".format(bucket, key))
+        else:
+            outputs.append(state['path'])
+        state['writer'] = None
+
+    def flush():
+        if not buffer:
+            return
+        if state['writer'] is None:
+            state['path'] = os.path.join(workdir, "part-{:05d}.parquet".format(len(outputs)))
+            state['writer'] = pq.ParquetWriter(state['path'], schema, compression='snappy')
+            state['rows'] = 0
+        state['writer'].write_table(records_to_table(buffer, schema))
+        state['rows'] += len(buffer)
+        del buffer[:]
+        if state['rows'] >= rows_per_file:
+            close_file()
+
+    start = time.perf_counter()
+    try:
+        if objects is None:
+            objects = list_objects(source, client=client, suffix=".json")
+        for obj in objects:
+            buffer.extend(read_json_records(object_uri(source, obj['Key'])))
+            if len(buffer) >= row_group_rows:
+                flush()
+        flush()
+        close_file()
+    finally:
+        if to_s3:
+            shutil.rmtree(workdir, ignore_errors=True)
+    if VERBOSE:
+        print("Converted {} JSON files of \'{}\' into {} Parquet files in {:.2f} s".format(
+            len(objects), table, len(outputs), time.perf_counter() - start))
+    return outputs
+
+
+def get_listing_uri(table):
+    """
+    Returns the URI of the listing of the JSON files a Parquet copy was built
+    from, '<PARQUET_PREFIX>/<table>.listing.json' (out of the prefix loaded
+    by the COPY). On the local backend, it is in the local mirror.
+    """
+    prefix = backend_uri(get_settings().get("ETL", "PARQUET_PREFIX")).rstrip("/")
+    return "{}/{}.listing.json".format(prefix, table)
+
+
+def write_source_listing(table, objects):
+    """
+    Saves the listing of the JSON files a Parquet copy was built from.
+    """
+    listing = {'converted_at': datetime.now(timezone.utc).isoformat(),
+               'objects': [{'Key': obj['Key'], 'Size': obj['Size'], 'ETag': obj['ETag']} for obj in objects]}
+    write_manifest(listing, get_listing_uri(table))
+
+
+def read_source_listing(table):
+    """
+    Returns the listing of the JSON files the current Parquet copy of a
+    staging table was built from, or None if it was not saved (e.g. by an
+    older conversion).
+    """
+    try:
+        records = read_json_records(get_listing_uri(table))
+    except Exception as e:
+        print("WARNING: Cannot read the listing of the Parquet copy of \'{}\': {}".format(table, e))
+        return None
+    return records[0]['objects'] if records else None
+
+
+def convert_staging_data():
+    """
+    Converts the log and song datasets into Parquet under 'PARQUET_PREFIX'
+    (see the section '[ETL]' of 'myDWH.cfg'). On the local backend, both are
+    in the local mirror of the bucket.
+
+    The listing of the JSON files of each copy is saved along with it (see
+    'write_source_listing()'), so that a full load from the Parquet copies
+    records the files it actually loaded.
+    """
+    prefix = backend_uri(get_settings().get("ETL", "PARQUET_PREFIX")).rstrip("/")
+    for (table, option) in (('staging_events', "LOG_DATA"), ('staging_songs', "SONG_DATA")):
+        source = source_uri(option)
+        objects = list_objects(source, suffix=".json")
+        convert(table, source, "{}/{}".format(prefix, table), objects=objects)
+        write_source_listing(table, objects)
+
+
+def benchmark(table, source, workdir):
+    """
+    Compares the current JSON path with the Parquet path on local files.
+
+    Reports the on-disk size of both formats, the one-off conversion time and
+    the time to read and type the data from each format.
+    """
+    _require_pyarrow()
+    schema = get_schema(table)
+    objects = list_objects(source, suffix=".json")
+    json_bytes = sum(obj['Size'] for obj in objects)
+
+    start = time.perf_counter()
+    records = []
+    for obj in objects:
+        records.extend(read_json_records(obj['Key']))
+    records_to_table(records, schema)
+    json_seconds = time.perf_counter() - start
+
+    start = time.perf_counter()
+    outputs = convert(table, source, workdir)
+    convert_seconds = time.perf_counter() - start
+    parquet_bytes = sum(os.path.getsize(path) for path in outputs)
+
+    start = time.perf_counter()
+    rows = sum(pq.read_table(path).num_rows for path in outputs)
+    parquet_seconds = time.perf_counter() - start
+
+    print("BENCHMARK {} ({} rows):".format(table, rows))
+    print("\tJSON    : {:>12} bytes, read+type {:8.3f} s".format(json_bytes, json_seconds))
+    print("\tParquet : {:>12} bytes, read+type {:8.3f} s (conversion {:.3f} s)".format(
+        parquet_bytes, parquet_seconds, convert_seconds))
+    if parquet_seconds > 0:
+        print("\tspeed-up = {:.1f}x, size ratio = {:.2f}".format(
+            json_seconds / parquet_seconds, parquet_bytes / max(1, json_bytes)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Convert the staging JSON data into Parquet.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("convert", help="convert the datasets of myDWH.cfg into PARQUET_PREFIX")
+    bench = subparsers.add_parser("benchmark", help="compare JSON and Parquet on synthetic log events")
+    bench.add_argument("--scale", type=float, default=25, help="scale factor of the synthetic data")
+    bench.add_argument("--workdir", default=None, help="local working directory")
+    args = parser.parse_args(argv)
+
+    if args.command == "convert":
+        convert_staging_data()
+    else:
+        workdir = args.workdir or tempfile.mkdtemp(prefix="parquet-bench-")
+        synthetic_data.generate(os.path.join(workdir, "json"), args.scale)
+        benchmark('staging_events', os.path.join(workdir, "json", "log_data"), os.path.join(workdir, "parquet"))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,221 @@
+import argparse
+import json
+import re
+
+import schema
+from schema import create_table_query
+from sql_queries import insert_table_queries, merge_table_queries, create_staging_table_queries
+from sql_queries import staging_events_table_create, staging_songs_table_create
+from local_engine import get_backend, LocalEngine
+from manifest import write_manifest
+from s3_utils import list_objects, object_uri, read_json_records, strip_quotes
+from settings import get_settings
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# GLOBAL VARIABLES
+jsonpaths_written = None  # The path of the jsonpaths file written by this process
+
+# The queries that read the staging tables: the columns they never mention
+# are not loaded
+STAGING_QUERIES = insert_table_queries + merge_table_queries
+
+# The CREATE TABLE statement of each staging table with all its columns
+FULL_STAGING_TABLES = {'staging_events': staging_events_table_create,
+                       'staging_songs' : staging_songs_table_create}
+
+IDENTIFIER_PATTERN = re.compile(r"\b[A-Za-z_][A-Za-z0-9_]*\b")
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_project_staging():
+    """
+    Returns True if the staging tables only hold the columns read by the
+    INSERT queries ('PROJECT_STAGING = 1' in myDWH.cfg).
+    """
+    return get_settings().getboolean("ETL", "PROJECT_STAGING", fallback=False)
+
+
+def consumed_columns(table, queries=None):
+    """
+    Returns the columns of a staging table that the queries reading it use
+    (in a SELECT list, a join or a filter).
+
+    A column counts as used if its name (case-insensitive, as in SQL) is an
+    identifier of a query that names the table. A homonym of another table
+    may keep a column that is not needed, never drop one that is.
+
+    Args:
+      table (dict): a staging table spec, e.g. 'schema.staging_events'.
+      queries (list): the SQL texts. Defaults to 'STAGING_QUERIES'.
+    Returns:
+      columns (list): the names of the used columns, in table order.
+    """
+    identifiers = set()
+    for query in queries or STAGING_QUERIES:
+        tokens = set(token.lower() for token in IDENTIFIER_PATTERN.findall(query))
+        if table['name'].lower() in tokens:
+            identifiers |= tokens
+    return [spec['name'] for spec in table['columns'] if spec['name'].lower() in identifiers]
+
+
+def projected_table(table, queries=None):
+    """
+    Returns a copy of a staging table spec without the unused columns (see
+    'consumed_columns()').
+    """
+    columns = consumed_columns(table, queries)
+    return dict(table, columns=[spec for spec in table['columns'] if spec['name'] in columns])
+
+
+def staging_table_create(name):
+    """
+    Returns the CREATE TABLE statement of a staging table: trimmed to the
+    used columns with 'PROJECT_STAGING = 1', complete otherwise.
+    """
+    if get_project_staging():
+        return create_table_query(projected_table(schema.tables[name]))
+    return FULL_STAGING_TABLES[name]
+
+
+def create_staging_queries():
+    """
+    Returns 'create_staging_table_queries' with the staging tables trimmed if
+    'PROJECT_STAGING = 1'.
+    """
+    trimmed = {FULL_STAGING_TABLES[name]: staging_table_create(name) for name in FULL_STAGING_TABLES}
+    return [trimmed.get(query, query) for query in create_staging_table_queries]
+
+
+def build_jsonpaths(table):
+    """
+    Returns the jsonpaths of the used columns of a staging table, in table
+    order, e.g. {'jsonpaths': ["$['artist']", ...]}. The JSON keys of the
+    datasets are the column names.
+    """
+    return {'jsonpaths': ["$['{}']".format(name) for name in consumed_columns(table)]}
+
+
+def get_jsonpaths_uri():
+    """
+    Returns the URI of the generated jsonpaths file of 'staging_events'.
+    """
+    prefix = strip_quotes(get_settings().get("ETL", "PROJECTION_PREFIX")).rstrip("/")
+    return "{}/staging_events_jsonpaths.json".format(prefix)
+
+
+def _write_path(destination):
+    # The local backend reads an S3 URI from its local mirror
+    if get_backend() == "duckdb":
+        config = get_settings()
+        return LocalEngine(strip_quotes(config.get("LOCAL", "DATA_DIR", fallback="data"))).local_path(destination)
+    return destination
+
+
+def write_jsonpaths(destination=None, client=None):
+    """
+    Writes the jsonpaths file of 'staging_events' to S3 or to a local file.
+    On the local backend, an S3 URI is written to its local mirror.
+
+    Returns:
+      destination (str): the URI the file is loaded from by the COPY.
+    """
+    destination = destination or get_jsonpaths_uri()
+    path = _write_path(destination)
+    write_manifest(build_jsonpaths(schema.staging_events), path, client=client)
+    if VERBOSE:
+        print("Jsonpaths of \'staging_events\' written to \'{}\'".format(path))
+    return destination
+
+
+def get_log_jsonpath():
+    """
+    Returns the jsonpaths option of the COPY of 'staging_events', quoted: the
+    generated file with 'PROJECT_STAGING = 1' (written once per process),
+    'LOG_JSONPATH' otherwise.
+    """
+    global jsonpaths_written
+    if not get_project_staging():
+        return get_settings().get("S3", "LOG_JSONPATH")
+    destination = get_jsonpaths_uri()
+    if jsonpaths_written != _write_path(destination):
+        write_jsonpaths(destination)
+        jsonpaths_written = _write_path(destination)
+    return "\'{}\'".format(destination)
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def measure_projection(uri, files=5):
+    """
+    Measures the share of a JSON dataset that the projection skips, on a
+    sample of its files.
+
+    Returns:
+      A 2-tuple (sizes, records): a dict of {field: bytes} of the serialized
+      values of each JSON field, and the number of records read.
+    """
+    sizes = {}
+    records = 0
+    for obj in list_objects(uri, suffix=".json")[:files]:
+        for record in read_json_records(object_uri(uri, obj['Key'])):
+            records += 1
+            for (field, value) in record.items():
+                sizes[field] = sizes.get(field, 0) + len(json.dumps(value))
+    return (sizes, records)
+
+
+def print_report(sample=5):
+    """
+    Prints the used and the skipped columns of each staging table, and the
+    share of the JSON values skipped on a sample of the source files.
+    """
+    config = get_settings()
+    sources = {'staging_events': "LOG_DATA", 'staging_songs': "SONG_DATA"}
+    for table in schema.staging_tables:
+        used = consumed_columns(table)
+        skipped = [spec['name'] for spec in table['columns'] if spec['name'] not in used]
+        print("{} ({} of {} columns used):".format(table['name'], len(used), len(table['columns'])))
+        print("\tused:    {}".format(", ".join(used)))
+        print("\tskipped: {}".format(", ".join(skipped) or "-"))
+        if sample:
+            uri = strip_quotes(config.get("S3", sources[table['name']]))
+            if get_backend() == "duckdb":
+                uri = LocalEngine(strip_quotes(config.get("LOCAL", "DATA_DIR", fallback="data"))).local_path(uri)
+            try:
+                (sizes, records) = measure_projection(uri, sample)
+            except Exception as e:
+                print("\tWARNING: Cannot sample \'{}\': {}".format(uri, e))
+                continue
+            total = sum(sizes.values())
+            used_keys = set(name.lower() for name in used)
+            kept = sum(size for (field, size) in sizes.items() if field.lower() in used_keys)
+            print("\tsample:  {} records, {:.0f}% of the JSON value bytes skipped".format(
+                records, 100.0 * (total - kept) / total if total else 0.0))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Project the staging tables on the columns the INSERT queries read.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    report_parser = subparsers.add_parser("report", help="print the used and the skipped staging columns")
+    report_parser.add_argument("--sample", type=int, default=5,
+                               help="source files sampled per dataset (default=5, 0 to skip)")
+    subparsers.add_parser("ddl", help="print the trimmed CREATE TABLE statements of the staging tables")
+    write_parser = subparsers.add_parser("jsonpaths", help="write the jsonpaths file of staging_events")
+    write_parser.add_argument("--destination", default=None,
+                              help="S3 URI or local path (default=<PROJECTION_PREFIX>/staging_events_jsonpaths.json)")
+    args = parser.parse_args(argv)
+
+    if args.command == "report":
+        print_report(args.sample)
+    elif args.command == "ddl":
+        for table in schema.staging_tables:
+            print(create_table_query(projected_table(table)))
+    else:
+        write_jsonpaths(args.destination)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,413 @@
+import json
+import random
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+
+from scheduler import run_dag
+from settings import api_calls, cluster_cache, client_error
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+S3_READ_ONLY_POLICY = "arn:aws:iam::aws:policy/AmazonS3ReadOnlyAccess"
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+class WaitTimeout(Exception):
+    """
+    Raised when a waited-for state is not reached in time.
+    """
+
+
+def wait_for(probe, done, timeout=1800, initial_delay=1.0, max_delay=30.0, factor=2.0,
+             sleep=time.sleep, rng=random):
+    """
+    Polls a probe with exponential backoff and full jitter until it is done.
+
+    The first probe is issued immediately and the function returns as soon as
+    a probe reports the expected state. The delay between two probes is drawn
+    uniformly in [0, d] where d doubles from 'initial_delay' up to 'max_delay'.
+
+    Args:
+      probe (callable): returns the current state (e.g. the cluster status).
+      done (callable): returns True when a state is the expected one.
+      timeout (float): the maximum time to wait in seconds.
+      initial_delay (float): the first backoff ceiling in seconds.
+      max_delay (float): the largest backoff ceiling in seconds.
+      factor (float): the growth factor of the backoff ceiling.
+      sleep (callable): the sleep function (replaceable in tests).
+      rng (random.Random): the source of jitter (replaceable in tests).
+    Returns:
+      A 2-tuple (state, probes) with the final state and the number of probes.
+    Raises:
+      WaitTimeout: if the expected state is not reached within 'timeout'.
+    """
+    deadline = time.monotonic() + timeout
+    ceiling = initial_delay
+    probes = 0
+    while True:
+        state = probe()
+        probes += 1
+        if done(state):
+            return (state, probes)
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            raise WaitTimeout("Still in state \'{}\' after {} probes".format(state, probes))
+        sleep(min(remaining, rng.uniform(0, ceiling)))
+        ceiling = min(max_delay, ceiling * factor)
+
+
+def cluster_status_probe(redshift, cluster_name):
+    """
+    Returns a probe of the status of a cluster: its 'ClusterStatus' or
+    'deleted' once the cluster no longer exists.
+    """
+    def probe():
+        cluster_cache.invalidate(cluster_name)
+        try:
+            return cluster_cache.status(redshift, cluster_name)
+        except client_error() as ce:
+            if ce.response['Error']['Code'] == 'ClusterNotFound':
+                return 'deleted'
+            raise
+    return probe
+
+
+class Timeline:
+    """
+    Records the start and end offsets of the steps of a provisioning run.
+    """
+    def __init__(self):
+        self.origin = time.monotonic()
+        self.steps = []
+        self._lock = threading.Lock()
+
+    def run(self, name, function):
+        start = time.monotonic() - self.origin
+        try:
+            return function()
+        finally:
+            with self._lock:
+                self.steps.append((name, start, time.monotonic() - self.origin))
+
+    def print(self, width=50):
+        """
+        Prints the steps as a text Gantt chart.
+        """
+        total = max((end for (_, _, end) in self.steps), default=0) or 1
+        print("PROVISIONING TIMELINE ({:.1f} s):".format(total))
+        for (name, start, end) in sorted(self.steps, key=lambda step: step[1]):
+            bar_start = int(width * start / total)
+            bar_end = max(bar_start + 1, int(width * end / total))
+            print("  {:<16} {:7.1f} -> {:7.1f} s |{}{}{}|".format(
+                name, start, end, " " * bar_start, "#" * (bar_end - bar_start), " " * (width - bar_end)))
+
+
+class Provisioner:
+    """
+    Provisions and tears down the Redshift cluster of 'myDWH.cfg'.
+
+    The independent steps run concurrently (e.g. the IAM role set-up and the
+    security group look-up) and the waits use exponential backoff. The boto3
+    clients are injected, so a mocked AWS backend can be used.
+    """
+    def __init__(self, iam, redshift, ec2, params, sleep=time.sleep):
+        """
+        Args:
+          iam, redshift, ec2 (boto3.client): the AWS service clients.
+          params (dict): the cluster parameters with the keys 'CLUSTER_NAME',
+              'CLUSTER_TYPE', 'CLUSTER_NODE_TYPE', 'CLUSTER_NODE_COUNT',
+              'CLUSTER_DB_NAME', 'CLUSTER_DB_USER', 'CLUSTER_DB_PASSWORD',
+              'CLUSTER_DB_PORT' and 'AWS_ROLE_ARN' (the role name). The
+              optional key 'SNAPSHOT_PREFIX' names the final snapshots.
+          sleep (callable): the sleep function used by the waiters.
+        """
+        self.iam = iam
+        self.redshift = redshift
+        self.ec2 = ec2
+        self.params = params
+        self.sleep = sleep
+        self.timeline = Timeline()
+        self.context = {}
+
+    def _call(self, name, function, **kwargs):
+        api_calls[name] += 1
+        return function(**kwargs)
+
+    def setup_role(self):
+        """
+        Creates the IAM role (if needed), attaches the S3 read-only policy and
+        returns the role ARN.
+        """
+        role_name = self.params['AWS_ROLE_ARN']
+        try:
+            self._call('create_role', self.iam.create_role,
+                Path='/',
+                RoleName=role_name,
+                Description="Allows Redshift clusters to call AWS services on your behalf.",
+                AssumeRolePolicyDocument=json.dumps(
+                    {'Statement': [{'Action': 'sts:AssumeRole',
+                                    'Effect': 'Allow',
+                                    'Principal': {'Service': 'redshift.amazonaws.com'}}],
+                     'Version': '2012-10-17'}))
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'EntityAlreadyExists':
+                raise
+            if VERBOSE > 0:
+                print("WARNING: The role \'{}\' already exists.".format(role_name))
+        self._call('attach_role_policy', self.iam.attach_role_policy,
+                   RoleName=role_name, PolicyArn=S3_READ_ONLY_POLICY)
+        self.context['role_arn'] = self._call('get_role', self.iam.get_role, RoleName=role_name)['Role']['Arn']
+        return self.context['role_arn']
+
+    def find_security_group(self):
+        """
+        Returns the ID of the default security group of the default VPC, where
+        the cluster is created.
+        """
+        vpcs = self._call('describe_vpcs', self.ec2.describe_vpcs,
+                          Filters=[{'Name': 'isDefault', 'Values': ['true']}])['Vpcs']
+        if not vpcs:
+            raise RuntimeError("No default VPC found in this region")
+        groups = self._call('describe_security_groups', self.ec2.describe_security_groups,
+                            Filters=[{'Name': 'vpc-id', 'Values': [vpcs[0]['VpcId']]},
+                                     {'Name': 'group-name', 'Values': ['default']}])['SecurityGroups']
+        self.context['security_group'] = groups[0]['GroupId']
+        return self.context['security_group']
+
+    def open_port(self):
+        """
+        Opens the TCP port of the database in the security group.
+        """
+        port = int(self.params['CLUSTER_DB_PORT'])
+        try:
+            self._call('authorize_security_group_ingress', self.ec2.authorize_security_group_ingress,
+                       GroupId=self.context['security_group'],
+                       IpPermissions=[{'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port,
+                                       'IpRanges': [{'CidrIp': '0.0.0.0/0'}]}])
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'InvalidPermission.Duplicate':
+                raise
+
+    def create_cluster(self):
+        """
+        Requests the creation of the cluster (no-op if it already exists).
+        """
+        params = self.params
+        try:
+            self._call('create_cluster', self.redshift.create_cluster,
+                ClusterType        = params['CLUSTER_TYPE'],
+                NodeType           = params['CLUSTER_NODE_TYPE'],
+                NumberOfNodes      = int(params['CLUSTER_NODE_COUNT']),
+                DBName             = params['CLUSTER_DB_NAME'],
+                ClusterIdentifier  = params['CLUSTER_NAME'],
+                MasterUsername     = params['CLUSTER_DB_USER'],
+                MasterUserPassword = params['CLUSTER_DB_PASSWORD'],
+                Port               = int(params['CLUSTER_DB_PORT']),
+                IamRoles           = [self.context['role_arn']])
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'ClusterAlreadyExists':
+                raise
+            if VERBOSE > 0:
+                print("WARNING: The cluster \'{}\' already exists.".format(params['CLUSTER_NAME']))
+
+    def wait_until(self, expected, timeout=1800):
+        """
+        Waits until the cluster reaches a status ('available' or 'deleted').
+        """
+        (state, probes) = wait_for(cluster_status_probe(self.redshift, self.params['CLUSTER_NAME']),
+                                   lambda state: state == expected, timeout=timeout, sleep=self.sleep)
+        if VERBOSE > 1:
+            print("\tCluster is \'{}\' after {} probes".format(state, probes))
+        return state
+
+    def _run(self, steps, max_workers=4):
+        self.timeline = Timeline()
+        nodes = [{'name': name, 'run': function, 'after': after} for (name, function, after) in steps]
+        (ok, _) = run_dag(nodes, lambda node: self.timeline.run(node['name'], node['run']), max_workers)
+        if VERBOSE > 0:
+            self.timeline.print()
+        return ok
+
+    def provision(self):
+        """
+        Provisions the cluster. Returns True if all the steps succeeded.
+        """
+        return self._run([
+            ('iam_role',       self.setup_role,                             []),
+            ('security_group', self.find_security_group,                    []),
+            ('open_port',      self.open_port,                              ['security_group']),
+            ('create_cluster', self.create_cluster,                         ['iam_role']),
+            ('wait_available', lambda: self.wait_until('available'),        ['create_cluster']),
+        ])
+
+    @property
+    def snapshot_prefix(self):
+        """
+        The identifier prefix of the final snapshots of the cluster.
+        """
+        return "{}-{}-".format(self.params.get('SNAPSHOT_PREFIX', 'sparkify'),
+                               self.params['CLUSTER_NAME']).lower()
+
+    def new_snapshot_identifier(self, now=None):
+        """
+        Returns a new final snapshot identifier, e.g.
+        'sparkify-dwhcluster-20181130-184500'.
+        """
+        now = now or datetime.now(timezone.utc)
+        return self.snapshot_prefix + now.strftime("%Y%m%d-%H%M%S")
+
+    def list_snapshots(self):
+        """
+        Returns the available final snapshots of the cluster, newest first.
+        """
+        snapshots = []
+        kwargs = {'SnapshotType': 'manual'}
+        while True:
+            page = self._call('describe_cluster_snapshots', self.redshift.describe_cluster_snapshots, **kwargs)
+            snapshots.extend(snapshot for snapshot in page['Snapshots']
+                             if snapshot['SnapshotIdentifier'].startswith(self.snapshot_prefix)
+                             and snapshot['Status'] == 'available')
+            if not page.get('Marker'):
+                break
+            kwargs['Marker'] = page['Marker']
+        return sorted(snapshots, key=lambda snapshot: snapshot['SnapshotCreateTime'], reverse=True)
+
+    def is_compatible(self, snapshot):
+        """
+        Returns True if a snapshot can be restored as the cluster of 'params':
+        same node type, number of nodes, database and master user.
+        """
+        params = self.params
+        return (snapshot['NodeType'] == params['CLUSTER_NODE_TYPE']
+                and snapshot['NumberOfNodes'] == int(params['CLUSTER_NODE_COUNT'])
+                and snapshot['DBName'] == params['CLUSTER_DB_NAME']
+                and snapshot['MasterUsername'] == params['CLUSTER_DB_USER'])
+
+    def latest_snapshot(self):
+        """
+        Returns the identifier of the newest compatible final snapshot or None.
+        """
+        for snapshot in self.list_snapshots():
+            if self.is_compatible(snapshot):
+                return snapshot['SnapshotIdentifier']
+            if VERBOSE > 0:
+                print("WARNING: The snapshot \'{}\' ({} x {}) is not compatible, skipped.".format(
+                    snapshot['SnapshotIdentifier'], snapshot['NumberOfNodes'], snapshot['NodeType']))
+        return None
+
+    def restore_cluster(self, snapshot):
+        """
+        Requests the restore of the cluster from a snapshot (no-op if the
+        cluster already exists).
+        """
+        params = self.params
+        try:
+            self._call('restore_from_cluster_snapshot', self.redshift.restore_from_cluster_snapshot,
+                ClusterIdentifier  = params['CLUSTER_NAME'],
+                SnapshotIdentifier = snapshot,
+                NodeType           = params['CLUSTER_NODE_TYPE'],
+                NumberOfNodes      = int(params['CLUSTER_NODE_COUNT']),
+                Port               = int(params['CLUSTER_DB_PORT']),
+                IamRoles           = [self.context['role_arn']])
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'ClusterAlreadyExists':
+                raise
+            if VERBOSE > 0:
+                print("WARNING: The cluster \'{}\' already exists.".format(params['CLUSTER_NAME']))
+
+    def restore(self, snapshot):
+        """
+        Restores the cluster from a snapshot. The role, the security group and
+        the TCP port are set up as for 'provision()'. Returns True if all the
+        steps succeeded.
+        """
+        return self._run([
+            ('iam_role',        self.setup_role,                            []),
+            ('security_group',  self.find_security_group,                   []),
+            ('open_port',       self.open_port,                             ['security_group']),
+            ('restore_cluster', lambda: self.restore_cluster(snapshot),     ['iam_role']),
+            ('wait_available',  lambda: self.wait_until('available'),       ['restore_cluster']),
+        ])
+
+    def prune_snapshots(self, keep, max_age_days=None, now=None):
+        """
+        Applies the retention policy to the final snapshots of the cluster.
+
+        The 'keep' newest snapshots are kept, except those older than
+        'max_age_days'. The newest snapshot is never deleted.
+
+        Args:
+          keep (int): the number of snapshots to keep.
+          max_age_days (int): the maximum age of a snapshot, or None.
+          now (datetime): the current time (replaceable in tests).
+        Returns:
+          pruned (list): the identifiers of the deleted snapshots.
+        """
+        now = now or datetime.now(timezone.utc)
+        pruned = []
+        for (rank, snapshot) in enumerate(self.list_snapshots()):
+            expired = max_age_days and now - snapshot['SnapshotCreateTime'] > timedelta(days=max_age_days)
+            if rank == 0 or (rank < keep and not expired):
+                continue
+            try:
+                self._call('delete_cluster_snapshot', self.redshift.delete_cluster_snapshot,
+                           SnapshotIdentifier=snapshot['SnapshotIdentifier'])
+            except client_error() as ce:
+                if ce.response['Error']['Code'] != 'ClusterSnapshotNotFound':
+                    raise
+            pruned.append(snapshot['SnapshotIdentifier'])
+        self.context['pruned'] = pruned
+        if VERBOSE > 0 and pruned:
+            print("Pruned {} old snapshots: {}".format(len(pruned), ", ".join(pruned)))
+        return pruned
+
+    def delete_cluster(self, snapshot=None):
+        """
+        Requests the deletion of the cluster (no-op if it does not exist). If
+        'snapshot' is set, a final snapshot is taken under that identifier.
+        """
+        if snapshot:
+            snapshot_options = {'SkipFinalClusterSnapshot': False,
+                                'FinalClusterSnapshotIdentifier': snapshot}
+        else:
+            snapshot_options = {'SkipFinalClusterSnapshot': True}
+        try:
+            self._call('delete_cluster', self.redshift.delete_cluster,
+                       ClusterIdentifier=self.params['CLUSTER_NAME'], **snapshot_options)
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'ClusterNotFound':
+                raise
+
+    def delete_role(self):
+        """
+        Detaches the policy from the IAM role and deletes the role.
+        """
+        role_name = self.params['AWS_ROLE_ARN']
+        try:
+            self._call('detach_role_policy', self.iam.detach_role_policy,
+                       RoleName=role_name, PolicyArn=S3_READ_ONLY_POLICY)
+            self._call('delete_role', self.iam.delete_role, RoleName=role_name)
+        except client_error() as ce:
+            if ce.response['Error']['Code'] != 'NoSuchEntity':
+                raise
+
+    def teardown(self, snapshot=None, keep=None, max_age_days=None):
+        """
+        Deletes the cluster, waits until it is gone and deletes the IAM role.
+
+        If 'snapshot' is set, a final snapshot is taken under that identifier
+        and, once the cluster is gone, the older snapshots are pruned down to
+        'keep' (see 'prune_snapshots()'). Returns True if all the steps
+        succeeded.
+        """
+        steps = [
+            ('delete_cluster', lambda: self.delete_cluster(snapshot),      []),
+            ('wait_deleted',   lambda: self.wait_until('deleted'),         ['delete_cluster']),
+            ('delete_role',    self.delete_role,                           ['wait_deleted']),
+        ]
+        if snapshot and keep:
+            steps.append(('prune_snapshots', lambda: self.prune_snapshots(keep, max_age_days), ['wait_deleted']))
+        return self._run(steps)
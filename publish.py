@@ -0,0 +1,188 @@
+import argparse
+import re
+
+import schema
+from sql_queries import create_star_table_queries, insert_table_graph
+from settings import get_settings
+from local_engine import database_error
+from instrumentation import timed_execute, execute_stage, get_transaction_mode
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The star tables and their rollups, published together
+STAR_TABLES = [table['name'] for table in schema.star_tables + schema.rollup_tables]
+
+# The shadow copy being built, and the previous version kept for rollback
+SHADOW_SUFFIX   = "__next"
+PREVIOUS_SUFFIX = "__prev"
+
+# A star table name in a statement (the SQL text is not consistent in case)
+STAR_TABLE_PATTERN = re.compile(r"\b({})\b".format("|".join(STAR_TABLES)), re.IGNORECASE)
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_publish_mode():
+    """
+    Returns how a full load publishes the star tables: 'direct' (rebuilt in
+    place) or 'shadow' (built aside and swapped in), see myDWH.cfg.
+    """
+    return get_settings().get("ETL", "PUBLISH_MODE", fallback="direct")
+
+
+def shadow_query(query, suffix=SHADOW_SUFFIX):
+    """
+    Rewrites a statement so that it targets the shadow copies of the star
+    tables, e.g. 'INSERT INTO dimUser' becomes 'INSERT INTO dimUser__next'.
+    The staging tables are left unchanged.
+    """
+    names = {name.lower(): name for name in STAR_TABLES}
+    return STAR_TABLE_PATTERN.sub(lambda match: names[match.group(1).lower()] + suffix, query)
+
+
+def shadow_graph():
+    """
+    Returns 'insert_table_graph' with its queries, and the tables they read
+    and write, renamed to the shadow tables. The node names and dependencies
+    are unchanged.
+    """
+    return [dict(node, query=shadow_query(node['query']),
+                 reads=[shadow_query(table) for table in node['reads']],
+                 writes=[shadow_query(table) for table in node['writes']]) for node in insert_table_graph]
+
+
+def drop_shadow_table_queries():
+    """
+    Returns the statements that drop the shadow and previous copies.
+    """
+    return ["DROP TABLE IF EXISTS {}{};".format(name, suffix)
+            for suffix in (SHADOW_SUFFIX, PREVIOUS_SUFFIX) for name in STAR_TABLES]
+
+
+def existing_tables(cur):
+    """
+    Returns the lower-case names of the tables of the current schema (the
+    homonyms of other schemas, e.g. 'pg_catalog', are ignored).
+    """
+    cur.execute("SELECT table_name FROM information_schema.tables WHERE table_schema = current_schema();")
+    return {name.lower() for (name,) in cur.fetchall()}
+
+
+def prepare_shadow_tables(cur, conn):
+    """
+    Re-creates empty shadow copies of the star tables. The live star tables
+    are not touched. The staging tables are emptied by their COPY step (see
+    'etl.load_full()').
+
+    Args:
+      cur (psycopg2.extensions.cursor): a cursor on the connection 'conn'.
+      conn (psycopg2.extensions.connection): a connection to the database.
+    Returns:
+      True if the shadow tables are ready, False otherwise.
+    """
+    queries = ["DROP TABLE IF EXISTS {}{};".format(name, SHADOW_SUFFIX) for name in STAR_TABLES]
+    queries += [shadow_query(query) for query in create_star_table_queries]
+    if get_transaction_mode() == "stage":
+        return execute_stage(cur, conn, queries, "shadow")
+    for query in queries:
+        if VERBOSE > 1:
+            print("Execute query: {}".format(query))
+        try:
+            timed_execute(cur, conn, query, "shadow")
+        except database_error() as e:
+            print("Error executing query: {}".format(e))
+            return False
+    return True
+
+
+def publish(cur, conn):
+    """
+    Swaps the shadow tables in as the live star tables, all in a single
+    transaction: readers see either the previous or the new version of every
+    table, never a mix or a partial table. The previous version is kept as
+    '<table>__prev' for 'rollback()'.
+
+    Returns:
+      True if the new tables were published, False otherwise (the live tables
+      are then unchanged).
+    """
+    tables = existing_tables(cur)
+    missing = [name for name in STAR_TABLES if (name + SHADOW_SUFFIX).lower() not in tables]
+    if missing:
+        print("ERROR: Missing shadow tables: {}".format(", ".join(missing)))
+        return False
+    renames = []
+    for name in STAR_TABLES:
+        renames.append("DROP TABLE IF EXISTS {}{};".format(name, PREVIOUS_SUFFIX))
+        if name.lower() in tables:
+            renames.append("ALTER TABLE {0} RENAME TO {0}{1};".format(name, PREVIOUS_SUFFIX))
+        renames.append("ALTER TABLE {0}{1} RENAME TO {0};".format(name, SHADOW_SUFFIX))
+    ok = execute_stage(cur, conn, renames, "publish")
+    if ok and VERBOSE:
+        print("Published the star tables (the previous version is kept as \'<table>{}\')".format(PREVIOUS_SUFFIX))
+    if not ok:
+        print("ERROR: The star tables were not published. The live tables are unchanged.")
+    return ok
+
+
+def rollback(cur, conn):
+    """
+    Swaps the previous version of the star tables back in, in a single
+    transaction. The rolled-back version is kept as '<table>__next'.
+
+    Returns:
+      True if the previous version was restored, False otherwise.
+    """
+    tables = existing_tables(cur)
+    missing = [name for name in STAR_TABLES if (name + PREVIOUS_SUFFIX).lower() not in tables]
+    if missing:
+        print("ERROR: No previous version of: {}".format(", ".join(missing)))
+        return False
+    renames = []
+    for name in STAR_TABLES:
+        renames.append("DROP TABLE IF EXISTS {}{};".format(name, SHADOW_SUFFIX))
+        renames.append("ALTER TABLE {0} RENAME TO {0}{1};".format(name, SHADOW_SUFFIX))
+        renames.append("ALTER TABLE {0}{1} RENAME TO {0};".format(name, PREVIOUS_SUFFIX))
+    ok = execute_stage(cur, conn, renames, "rollback")
+    if ok and VERBOSE:
+        print("Rolled back the star tables (the rolled-back version is kept as \'<table>{}\')".format(SHADOW_SUFFIX))
+    return ok
+
+
+def status(cur):
+    """
+    Prints the row count of the live, shadow and previous star tables.
+    """
+    tables = existing_tables(cur)
+    print("{:<16} {:>12} {:>12} {:>12}".format("table", "live", SHADOW_SUFFIX, PREVIOUS_SUFFIX))
+    for name in STAR_TABLES:
+        counts = []
+        for suffix in ("", SHADOW_SUFFIX, PREVIOUS_SUFFIX):
+            if (name + suffix).lower() in tables:
+                cur.execute("SELECT COUNT(*) FROM {}{};".format(name, suffix))
+                counts.append(cur.fetchone()[0])
+            else:
+                counts.append("-")
+        print("{:<16} {:>12} {:>12} {:>12}".format(name, *counts))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Manage the published versions of the star tables.")
+    parser.add_argument("command", choices=["status", "rollback"],
+                        help="print the row counts of each version, or swap the previous version back in")
+    args = parser.parse_args(argv)
+
+    from create_cluster import connect_warehouse
+    (conn, _) = connect_warehouse()
+    cur = conn.cursor()
+    if args.command == "status":
+        status(cur)
+    elif not rollback(cur, conn):
+        conn.close()
+        quit()
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
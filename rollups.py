@@ -0,0 +1,358 @@
+import argparse
+import os
+import statistics
+import time
+from datetime import datetime
+
+from time_dimension import truncate
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The time range of the events being merged: the rollups are refreshed from
+# the first to the last affected hour (or day)
+RANGE_START = "(SELECT DATE_TRUNC(\'{0}\', MIN(ts)) FROM staging_event_keys)"
+RANGE_END   = "(SELECT DATE_TRUNC(\'{0}\', MAX(ts)) + INTERVAL \'1 {0}\' FROM staging_event_keys)"
+
+# The rollups, from the smallest to the largest. Each declares the
+# dimensions it can group or filter on (as SQL over the rollup), the grain of
+# its time column (None if it cannot be filtered on time), and its SQL:
+#   - 'select': the aggregate over factSongPlay, with a '{where}' placeholder
+#   - 'delete': the rows of the affected range, before they are recomputed
+#   - 'where': the filter of the affected range on factSongPlay
+ROLLUPS = [
+    {'name': 'aggPlaysHourly',
+     'grain': 'hour',
+     'time': 'hour_start',
+     'dimensions': {'hour': 'hour_start', 'day': 'CAST(hour_start AS DATE)', 'level': 'level'},
+     'select': """
+INSERT INTO aggPlaysHourly (hour_start, level, plays, users)
+    SELECT
+        DATE_TRUNC('hour', start_time) AS hour_start,
+        level,
+        COUNT(*)                       AS plays,
+        COUNT(DISTINCT user_id)        AS users
+    FROM factSongPlay{where}
+    GROUP BY DATE_TRUNC('hour', start_time), level;
+""",
+     'delete': """
+DELETE FROM aggPlaysHourly
+WHERE hour_start >= {0} AND hour_start < {1};
+""".format(RANGE_START.format("hour"), RANGE_END.format("hour")),
+     'where': """
+    WHERE start_time >= {0} AND start_time < {1}""".format(RANGE_START.format("hour"), RANGE_END.format("hour"))},
+
+    {'name': 'aggPlaysBySong',
+     'grain': 'day',
+     'time': 'play_date',
+     'dimensions': {'day': 'play_date', 'song_id': 'song_id', 'artist_id': 'artist_id'},
+     'select': """
+INSERT INTO aggPlaysBySong (play_date, song_id, artist_id, plays)
+    SELECT
+        CAST(start_time AS DATE) AS play_date,
+        song_id,
+        artist_id,
+        COUNT(*)                 AS plays
+    FROM factSongPlay{where}
+    GROUP BY CAST(start_time AS DATE), song_id, artist_id;
+""",
+     'delete': """
+DELETE FROM aggPlaysBySong
+WHERE play_date >= CAST({0} AS DATE) AND play_date < CAST({1} AS DATE);
+""".format(RANGE_START.format("day"), RANGE_END.format("day")),
+     'where': """
+    WHERE start_time >= {0} AND start_time < {1}""".format(RANGE_START.format("day"), RANGE_END.format("day"))},
+
+    # A session is recomputed as a whole, from all its plays, as soon as one
+    # of its events is merged
+    {'name': 'aggUserSessions',
+     'grain': None,
+     'time': None,
+     'dimensions': {'user_id': 'user_id', 'session_id': 'session_id'},
+     'select': """
+INSERT INTO aggUserSessions (user_id, session_id, session_start, session_end, plays, paid_plays)
+    SELECT
+        user_id,
+        session_id,
+        MIN(start_time)                                  AS session_start,
+        MAX(start_time)                                  AS session_end,
+        COUNT(*)                                         AS plays,
+        SUM(CASE WHEN level = 'paid' THEN 1 ELSE 0 END) AS paid_plays
+    FROM factSongPlay{where}
+    GROUP BY user_id, session_id;
+""",
+     'delete': """
+DELETE FROM aggUserSessions
+USING
+    (SELECT DISTINCT userId, sessionId FROM staging_event_keys) AS affected_sessions
+WHERE aggUserSessions.user_id    = affected_sessions.userId
+  AND aggUserSessions.session_id = affected_sessions.sessionId;
+""",
+     'where': """
+    WHERE EXISTS (SELECT 1 FROM staging_event_keys
+                  WHERE staging_event_keys.userId    = factSongPlay.user_id
+                    AND staging_event_keys.sessionId = factSongPlay.session_id)"""},
+]
+
+# The same dimensions on the fact table, for the queries no rollup answers
+FACT_DIMENSIONS = {'hour': "DATE_TRUNC('hour', start_time)", 'day': "CAST(start_time AS DATE)",
+                   'level': 'level', 'song_id': 'song_id', 'artist_id': 'artist_id',
+                   'user_id': 'user_id', 'session_id': 'session_id'}
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_rollup(name):
+    """
+    Returns the declaration of a rollup (see 'ROLLUPS').
+    """
+    for rollup in ROLLUPS:
+        if rollup['name'] == name:
+            return rollup
+    raise ValueError("Unknown rollup \'{}\'".format(name))
+
+
+def rollup_insert(name):
+    """
+    Returns the INSERT that builds a rollup from the whole fact table.
+    """
+    return get_rollup(name)['select'].format(where="")
+
+
+def rollup_refresh(name):
+    """
+    Returns the statements that refresh a rollup for the events of
+    'staging_event_keys' only: the rows of the affected hours, days or
+    sessions are deleted, then aggregated again from the fact table.
+    """
+    rollup = get_rollup(name)
+    return [rollup['delete'], rollup['select'].format(where=rollup['where'])]
+
+
+def _literal(value):
+    if isinstance(value, datetime):
+        return "\'{}\'".format(value.isoformat(sep=" "))
+    if isinstance(value, (int, float)):
+        return str(value)
+    return "\'{}\'".format(str(value).replace("\'", "\'\'"))
+
+
+def route(group_by, start=None, end=None, filters=None, top=None, use_rollups=True):
+    """
+    Builds the query of a number of songplays, on the smallest rollup that
+    can answer it, or on factSongPlay.
+
+    A rollup answers a query if it has every dimension grouped or filtered
+    on and, with a time range, if both bounds fall on its grain (e.g. whole
+    days for 'aggPlaysBySong').
+
+    Args:
+      group_by (list): the dimensions, e.g. ['hour', 'level'] (see
+          'FACT_DIMENSIONS').
+      start (datetime): the start of the time range (inclusive), or None.
+      end (datetime): the end of the time range (exclusive), or None.
+      filters (dict): the dimensions filtered on, e.g. {'level': 'paid'}.
+      top (int): if set, only the groups with the most plays are returned.
+      use_rollups (bool): if False, the fact table is always queried.
+    Returns:
+      A 2-tuple (table, query): the table queried and the SELECT statement,
+      whose columns are the dimensions then 'plays' (a BIGINT in both cases).
+    """
+    filters = filters or {}
+    needed = list(group_by) + list(filters)
+    unknown = [name for name in needed if name not in FACT_DIMENSIONS]
+    if unknown:
+        raise ValueError("Unknown dimensions: {}".format(", ".join(unknown)))
+    timed = start is not None or end is not None
+    (table, dimensions, measure, time_column) = ("factSongPlay", FACT_DIMENSIONS, "COUNT(*)", "start_time")
+    for rollup in ROLLUPS if use_rollups else []:
+        if any(name not in rollup['dimensions'] for name in needed):
+            continue
+        if timed and (rollup['grain'] is None or
+                      any(bound is not None and truncate(bound, rollup['grain']) != bound for bound in (start, end))):
+            continue
+        (table, dimensions, measure, time_column) = (rollup['name'], rollup['dimensions'], "CAST(SUM(plays) AS BIGINT)",
+                                                      rollup['time'])
+        break
+    conditions = ["{} = {}".format(dimensions[name], _literal(value)) for (name, value) in filters.items()]
+    if start is not None:
+        conditions.append("{} >= {}".format(time_column, _literal(start)))
+    if end is not None:
+        conditions.append("{} < {}".format(time_column, _literal(end)))
+    columns = ["{} AS {}".format(dimensions[name], name) for name in group_by]
+    query = "SELECT {} FROM {}".format(", ".join(columns + ["{} AS plays".format(measure)]), table)
+    if conditions:
+        query += " WHERE " + " AND ".join(conditions)
+    if group_by:
+        order = [str(i + 1) for i in range(len(group_by))]
+        if top is not None:
+            order.insert(0, "plays DESC")
+        query += " GROUP BY {} ORDER BY {}".format(", ".join(dimensions[name] for name in group_by), ", ".join(order))
+    if top is not None:
+        query += " LIMIT {}".format(int(top))
+    return (table, query + ";")
+
+
+def plays(cur, group_by, start=None, end=None, filters=None, top=None, use_rollups=True):
+    """
+    Runs a query built by 'route()' and returns its rows.
+    """
+    (table, query) = route(group_by, start, end, filters, top, use_rollups)
+    if VERBOSE > 1:
+        print("Routed to \'{}\': {}".format(table, query))
+    cur.execute(query)
+    return cur.fetchall()
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+# The dashboard queries of the benchmark: (label, group_by, filters, top,
+# last week only)
+DASHBOARD_QUERIES = [
+    ("plays per hour and level",    ['hour', 'level'],         {},                None, False),
+    ("plays per day",               ['day'],                   {},                None, False),
+    ("paid plays per day",          ['day'],                   {'level': 'paid'}, None, False),
+    ("top 10 songs",                ['song_id'],               {},                10,   False),
+    ("top 10 artists, last week",   ['artist_id'],             {},                10,   True),
+    ("plays per user session",      ['user_id', 'session_id'], {},                None, False),
+]
+
+
+def _timed(cur, query):
+    start = time.perf_counter()
+    cur.execute(query)
+    rows = cur.fetchall()
+    return (time.perf_counter() - start, rows)
+
+
+def benchmark_scale(data_dir, repeat=3):
+    """
+    Loads a local dataset, builds the rollups, and times each dashboard query
+    on the fact table and on its rollup. Then times the refresh of the
+    rollups for the events of the last day only, against their rebuild.
+
+    Returns:
+      A dict with the keys 'rows' (the rows of the fact table and of each
+      rollup), 'queries' (a list of dicts with 'label', 'table', 'raw_s',
+      'rollup_s' and 'same', True if both return the same rows) and
+      'refresh_s' and 'rebuild_s'.
+    """
+    import etl
+    import local_engine
+    from benchmark import use_local_dataset
+    from projection import create_staging_queries
+    from sql_queries import copy_table_queries, drop_table_queries, create_star_table_queries
+    from sql_queries import staging_event_keys_insert, staging_song_keys_insert, songplay_table_insert
+
+    use_local_dataset(data_dir)
+    conn = local_engine.connect(data_dir, ":memory:")
+    cur = conn.cursor()
+    for query in drop_table_queries + create_staging_queries() + create_star_table_queries:
+        cur.execute(query)
+    for query in copy_table_queries:
+        cur.execute(etl.format_copy_query(query))
+    for query in (staging_event_keys_insert, staging_song_keys_insert, songplay_table_insert):
+        cur.execute(query)
+    for rollup in ROLLUPS:
+        cur.execute(rollup_insert(rollup['name']))
+    rows = {}
+    for name in ["factSongPlay"] + [rollup['name'] for rollup in ROLLUPS]:
+        cur.execute("SELECT COUNT(*) FROM {};".format(name))
+        rows[name] = cur.fetchone()[0]
+
+    cur.execute("SELECT MAX(start_time) FROM factSongPlay;")
+    last = truncate(cur.fetchone()[0], "day")
+    week = (datetime.fromordinal(last.toordinal() - 6), datetime.fromordinal(last.toordinal() + 1))
+    queries = []
+    for (label, group_by, filters, top, last_week) in DASHBOARD_QUERIES:
+        (start, end) = week if last_week else (None, None)
+        (table, rollup_query) = route(group_by, start, end, filters, top)
+        (_, raw_query) = route(group_by, start, end, filters, top, use_rollups=False)
+        (raw, routed) = ([], [])
+        for _ in range(repeat):
+            (raw_s, raw_rows) = _timed(cur, raw_query)
+            (rollup_s, rollup_rows) = _timed(cur, rollup_query)
+            raw.append(raw_s)
+            routed.append(rollup_s)
+        queries.append({'label': label, 'table': table, 'raw_s': statistics.median(raw),
+                        'rollup_s': statistics.median(routed),
+                        'same': raw_rows == rollup_rows})
+
+    # Refresh for the events of the last day only, as after an incremental load
+    cur.execute("DELETE FROM staging_event_keys WHERE ts < {};".format(_literal(last)))
+    (refresh, rebuild) = ([], [])
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for rollup in ROLLUPS:
+            for query in rollup_refresh(rollup['name']):
+                cur.execute(query)
+        refresh.append(time.perf_counter() - start)
+        start = time.perf_counter()
+        for rollup in ROLLUPS:
+            cur.execute("DELETE FROM {};".format(rollup['name']))
+            cur.execute(rollup_insert(rollup['name']))
+        rebuild.append(time.perf_counter() - start)
+    conn.close()
+    return {'rows': rows, 'queries': queries,
+            'refresh_s': statistics.median(refresh), 'rebuild_s': statistics.median(rebuild)}
+
+
+def print_benchmark(scale, results):
+    print("SCALE FACTOR {} ({}):".format(scale, ", ".join(
+        "{} {} rows".format(name, count) for (name, count) in results['rows'].items())))
+    print("\t{:<28} {:<16} {:>11} {:>11} {:>8} {:>6}".format("query", "routed to", "fact", "rollup", "speedup",
+                                                           "same"))
+    for query in results['queries']:
+        print("\t{:<28} {:<16} {:9.4f} s {:9.4f} s {:>7.1f}x {:>6}".format(
+            query['label'], query['table'], query['raw_s'], query['rollup_s'],
+            query['raw_s'] / max(query['rollup_s'], 1e-9), "yes" if query['same'] else "NO"))
+    print("\t{:<45} {:9.4f} s {:9.4f} s {:>7.1f}x".format(
+        "refresh for the last day / rebuild", results['refresh_s'], results['rebuild_s'],
+        results['rebuild_s'] / max(results['refresh_s'], 1e-9)))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the songplay rollups, or benchmark them locally.")
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    query_parser = subparsers.add_parser("query", help="count the songplays, on a rollup when one answers")
+    query_parser.add_argument("--by", nargs="*", default=[], choices=sorted(FACT_DIMENSIONS),
+                              help="the dimensions to group by")
+    query_parser.add_argument("--start", type=datetime.fromisoformat, default=None,
+                              help="the start of the time range, e.g. 2018-11-01")
+    query_parser.add_argument("--end", type=datetime.fromisoformat, default=None,
+                              help="the end of the time range (excluded)")
+    query_parser.add_argument("--level", default=None, help="only count the plays of a user level")
+    query_parser.add_argument("--top", type=int, default=None, help="only print the groups with the most plays")
+    query_parser.add_argument("--raw", action="store_true", help="query factSongPlay even if a rollup answers")
+    bench_parser = subparsers.add_parser("benchmark", help="compare the dashboard queries on the local backend")
+    bench_parser.add_argument("--scales", type=float, nargs="+", default=[1, 5, 25],
+                              help="scale factors of the synthetic data (default=1 5 25)")
+    bench_parser.add_argument("--repeat", type=int, default=3, help="runs per query, the median is kept (default=3)")
+    bench_parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic data (default=42)")
+    bench_parser.add_argument("--data-root", default=os.path.join(".etl_state", "bench_data"),
+                              help="where the synthetic datasets are generated and reused")
+    args = parser.parse_args(argv)
+
+    if args.command == "benchmark":
+        import synthetic_data
+        for scale in args.scales:
+            data_dir = os.path.join(args.data_root, "sf_{}_seed_{}".format(scale, args.seed))
+            if not os.path.isdir(data_dir):
+                synthetic_data.generate(data_dir, scale, args.seed)
+            print_benchmark(scale, benchmark_scale(data_dir, args.repeat))
+        return
+
+    from create_cluster import connect_warehouse
+    (conn, _) = connect_warehouse()
+    filters = {'level': args.level} if args.level else {}
+    (table, query) = route(args.by, args.start, args.end, filters, args.top, not args.raw)
+    print("Routed to \'{}\': {}".format(table, query))
+    cur = conn.cursor()
+    cur.execute(query)
+    for row in cur.fetchall():
+        print("\t" + "\t".join(str(value) for value in row))
+    conn.close()
+
+
+if __name__ == "__main__":
+    main()
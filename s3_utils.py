@@ -0,0 +1,163 @@
+import json
+import os
+from datetime import datetime, timezone
+
+from settings import get_client
+
+# GLOBAL VARIABLES
+s3 = None  # A boto3 service client for S3, created on first use
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_s3_client():
+    """
+    Returns a boto3 client for S3 created from the 'myDWH.cfg' credentials.
+    The client is created once and reused by the subsequent calls.
+    """
+    global s3
+    if s3 is None:
+        s3 = get_client('s3')
+    return s3
+
+
+def strip_quotes(value):
+    """
+    Returns a configuration value without its surrounding single quotes.
+    """
+    return value.strip().strip("\'")
+
+
+def is_s3_uri(uri):
+    """
+    Returns True if a path is an S3 URI (e.g. 's3://udacity-dend/log_data').
+    """
+    return strip_quotes(uri).startswith("s3://")
+
+
+def parse_s3_uri(uri):
+    """
+    Splits an S3 URI into a bucket name and a key prefix.
+
+    Args:
+      uri (str): an S3 URI with or without surrounding quotes, as found in the
+          section '[S3]' of 'myDWH.cfg'.
+    Returns:
+      A 2-tuple (bucket, prefix).
+    Raises:
+      ValueError: if the URI does not start with 's3://'.
+    """
+    uri = strip_quotes(uri)
+    if not uri.startswith("s3://"):
+        raise ValueError("Not an S3 URI: \'{}\'".format(uri))
+    (bucket, _, prefix) = uri[len("s3://"):].partition("/")
+    return (bucket, prefix)
+
+
+def object_record(obj):
+    """
+    Returns the record of an object of a 'list_objects_v2' response: a dict
+    with the keys 'Key', 'Size', 'ETag' (without quotes) and 'LastModified'.
+    """
+    return {'Key': obj['Key'],
+            'Size': obj['Size'],
+            'ETag': obj.get('ETag', '').strip('"'),
+            'LastModified': obj.get('LastModified')}
+
+
+def file_record(path):
+    """
+    Returns the record of a local file, shaped like 'object_record()'. Its
+    ETag is derived from the size and the modification time of the file.
+    """
+    stat = os.stat(path)
+    return {'Key': path,
+            'Size': stat.st_size,
+            'ETag': "{:x}-{:x}".format(stat.st_size, stat.st_mtime_ns),
+            'LastModified': datetime.fromtimestamp(stat.st_mtime, tz=timezone.utc)}
+
+
+def iter_objects(uri, client=None, suffix=None):
+    """
+    Yields the objects under an S3 prefix or under a local directory, one
+    page (or one directory) at a time, so that the whole listing is never
+    held in memory.
+
+    The objects come in listing order: by key on S3, and directory by
+    directory (in name order) for a local directory.
+
+    Args:
+      uri (str): an S3 URI or the path of a local directory.
+      client (boto3.client): an S3 client. Defaults to 'get_s3_client()'.
+      suffix (str): if set, only the keys ending with this suffix are listed.
+    Yields:
+      The records of the objects (see 'object_record()' and 'file_record()').
+    """
+    if is_s3_uri(uri):
+        (bucket, prefix) = parse_s3_uri(uri)
+        client = client or get_s3_client()
+        paginator = client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix):
+            for obj in page.get('Contents', []):
+                if suffix is None or obj['Key'].endswith(suffix):
+                    yield object_record(obj)
+    else:
+        root = strip_quotes(uri)
+        for (dirpath, dirnames, filenames) in os.walk(root):
+            dirnames.sort()
+            for filename in sorted(filenames):
+                if suffix is None or filename.endswith(suffix):
+                    yield file_record(os.path.join(dirpath, filename))
+
+
+def list_objects(uri, client=None, suffix=None):
+    """
+    Lists the objects under an S3 prefix or under a local directory.
+
+    The S3 listing is paginated and works with any client that implements
+    the 'list_objects_v2' paginator (e.g. a local S3 stand-in). A local
+    directory is listed recursively and returns the same record shape.
+
+    Args:
+      uri (str): an S3 URI or the path of a local directory.
+      client (boto3.client): an S3 client. Defaults to 'get_s3_client()'.
+      suffix (str): if set, only the keys ending with this suffix are listed.
+    Returns:
+      objects (list): a list of dicts with the keys 'Key', 'Size', 'ETag' and
+          'LastModified', sorted by key. For a local directory, the key is the
+          path of the file.
+    """
+    return sorted(iter_objects(uri, client, suffix), key=lambda obj: obj['Key'])
+
+
+def object_uri(uri, key):
+    """
+    Returns the full URI of an object listed by 'list_objects()' under 'uri'.
+    """
+    if is_s3_uri(uri):
+        (bucket, _) = parse_s3_uri(uri)
+        return "s3://{}/{}".format(bucket, key)
+    return key
+
+
+def read_json_records(uri):
+    """
+    Returns the JSON records of an S3 object or a local file (one or more
+    JSON objects).
+    """
+    if is_s3_uri(uri):
+        (bucket, key) = parse_s3_uri(uri)
+        text = get_s3_client().get_object(Bucket=bucket, Key=key)['Body'].read().decode('utf-8')
+    else:
+        with open(uri, encoding='utf-8') as f:
+            text = f.read()
+    decoder = json.JSONDecoder()
+    records = []
+    position = 0
+    while True:
+        while position < len(text) and text[position].isspace():
+            position += 1
+        if position >= len(text):
+            return records
+        (record, position) = decoder.raw_decode(text, position)
+        records.append(record)
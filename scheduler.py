@@ -0,0 +1,196 @@
+import time
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+
+from sql_queries import insert_table_graph
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def build_dag(nodes):
+    """
+    Derives the dependencies between the nodes of a query graph.
+
+    A node depends on every other node that writes a table it reads, and on
+    the nodes named in its optional 'after' list.
+
+    Args:
+      nodes (list): a list of dicts with the keys 'name', 'query', 'reads',
+          'writes' and optionally 'after' and 'cost' (see sql_queries.py).
+    Returns:
+      deps (dict): maps each node name to the set of node names it depends on.
+    Raises:
+      ValueError: if a dependency is unknown or if the graph has a cycle.
+    """
+    names = [node['name'] for node in nodes]
+    if len(set(names)) != len(names):
+        raise ValueError("Duplicate node names in query graph: {}".format(names))
+    writers = {}
+    for node in nodes:
+        for table in node.get('writes', []):
+            writers.setdefault(table.lower(), set()).add(node['name'])
+
+    deps = {}
+    for node in nodes:
+        upstream = set()
+        for table in node.get('reads', []):
+            upstream |= writers.get(table.lower(), set())
+        for name in node.get('after', []):
+            if name not in names:
+                raise ValueError("Node \'{}\' depends on unknown node \'{}\'".format(node['name'], name))
+            upstream.add(name)
+        upstream.discard(node['name'])
+        deps[node['name']] = upstream
+
+    # Fails on cycles
+    topological_waves(deps)
+    return deps
+
+
+def topological_waves(deps):
+    """
+    Groups the nodes of a DAG into waves of nodes that can run concurrently.
+
+    Args:
+      deps (dict): maps each node name to the set of node names it depends on.
+    Returns:
+      waves (list): a list of lists of node names. The nodes of a wave only
+          depend on nodes of the previous waves.
+    Raises:
+      ValueError: if the graph has a cycle.
+    """
+    remaining = {name: set(upstream) for (name, upstream) in deps.items()}
+    waves = []
+    while remaining:
+        wave = sorted(name for (name, upstream) in remaining.items() if not upstream)
+        if not wave:
+            raise ValueError("Cycle detected in query graph between: {}".format(sorted(remaining)))
+        waves.append(wave)
+        for name in wave:
+            del remaining[name]
+        for upstream in remaining.values():
+            upstream.difference_update(wave)
+    return waves
+
+
+def critical_path(nodes, deps, costs=None):
+    """
+    Computes the longest chain of dependent nodes of a query graph.
+
+    Args:
+      nodes (list): the nodes of the query graph.
+      deps (dict): the dependencies returned by 'build_dag()'.
+      costs (dict): optional map of node name to measured duration. Defaults
+          to the 'cost' estimate of each node (or 1).
+    Returns:
+      A 2-tuple (path, length) where 'path' is the list of node names on the
+      critical path and 'length' its total cost.
+    """
+    if costs is None:
+        costs = {node['name']: node.get('cost', 1) for node in nodes}
+    finish = {}
+    previous = {}
+    for wave in topological_waves(deps):
+        for name in wave:
+            start = 0
+            previous[name] = None
+            for upstream in deps[name]:
+                if finish[upstream] > start:
+                    start = finish[upstream]
+                    previous[name] = upstream
+            finish[name] = start + costs.get(name, 1)
+
+    if not finish:
+        return ([], 0)
+    name = max(finish, key=finish.get)
+    length = finish[name]
+    path = []
+    while name is not None:
+        path.append(name)
+        name = previous[name]
+    return (list(reversed(path)), length)
+
+
+def print_plan(nodes, max_workers):
+    """
+    Prints the execution plan of a query graph without running it (dry-run).
+
+    Args:
+      nodes (list): the nodes of the query graph.
+      max_workers (int): the maximum number of queries running at once.
+    """
+    deps = build_dag(nodes)
+    print("EXECUTION PLAN ({} nodes, up to {} workers):".format(len(nodes), max_workers))
+    for (i, wave) in enumerate(topological_waves(deps)):
+        print("  Wave {}:".format(i + 1))
+        for name in wave:
+            upstream = ", ".join(sorted(deps[name])) or "-"
+            print("    {:<18} after: {}".format(name, upstream))
+    (path, length) = critical_path(nodes, deps)
+    print("  Critical path: {} (cost = {})".format(" -> ".join(path), length))
+
+
+def run_dag(nodes, execute, max_workers):
+    """
+    Runs the nodes of a query graph in parallel while honoring dependencies.
+
+    A node is submitted as soon as all its upstream nodes have completed. If
+    a node fails, no new node is started and its downstream nodes are skipped.
+
+    Args:
+      nodes (list): the nodes of the query graph.
+      execute (callable): called as 'execute(node)' from a worker thread. It
+          must raise an exception if the node fails.
+      max_workers (int): the maximum number of nodes running at the same time.
+    Returns:
+      A 2-tuple (ok, durations) where 'ok' is True if all nodes succeeded and
+      'durations' maps the name of each completed node to its duration in
+      seconds.
+    """
+    deps = build_dag(nodes)
+    by_name = {node['name']: node for node in nodes}
+    pending = {name: set(upstream) for (name, upstream) in deps.items()}
+    durations = {}
+    failed = []
+
+    def timed_execute(node):
+        start = time.perf_counter()
+        execute(node)
+        return time.perf_counter() - start
+
+    with ThreadPoolExecutor(max_workers=max(1, max_workers)) as executor:
+        running = {}
+        while True:
+            if not failed:
+                ready = sorted(name for (name, upstream) in pending.items() if not upstream)
+                for name in ready:
+                    del pending[name]
+                    running[executor.submit(timed_execute, by_name[name])] = name
+                    if VERBOSE > 1:
+                        print("\tSTART {}".format(name))
+            if not running:
+                break
+            (done, _) = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    durations[name] = future.result()
+                except Exception as e:
+                    failed.append(name)
+                    print("\t{:<18} FAILED: {}".format(name, e))
+                    continue
+                if VERBOSE:
+                    print("\t{:<18} {:8.2f} s".format(name, durations[name]))
+                for upstream in pending.values():
+                    upstream.discard(name)
+
+    if failed and pending:
+        print("WARNING: Skipped because of a failed upstream query: {}".format(", ".join(sorted(pending))))
+    return (not failed, durations)
+
+
+if __name__ == "__main__":
+    # Dry-run: print the plan of the INSERT stage
+    print_plan(insert_table_graph, len(insert_table_graph))
@@ -0,0 +1,269 @@
+#===========================================================
+# DECLARATIVE SCHEMA
+#
+# The columns of every table, from which the CREATE TABLE
+# statements of 'sql_queries.py' are generated. A column is
+# described by its name, its SQL type, its compression
+# encoding and its attributes:
+#   - 'not_null', 'distkey', 'sortkey' (bool)
+#   - 'identity' (str), e.g. '0,1' for IDENTITY(0,1)
+#   - 'source' (str), the staging column a star column is
+#     loaded from, e.g. 'staging_events.userAgent'. It lets
+#     the encoding advisor profile the star tables from the
+#     staging data (see encoding_advisor.py).
+#   - 'references' (str), the dimension column a fact column
+#     joins, e.g. 'dimUser.user_id'. These are the edges of
+#     the join graph of the star schema (see distribution.py).
+#
+# The time dimension declares its grain: one row per distinct
+# hour of the events ('hour', the finest of its attributes),
+# joined by the 'time_key' of the fact table. A finer grain
+# only multiplies its rows (see time_dimension.py).
+#
+# A table declares its distribution style: 'KEY' (on the
+# column marked 'distkey'), 'ALL', 'EVEN' or 'AUTO'. The
+# staging tables leave it to Redshift. The star tables follow
+# the plan of distribution.py: the dimensions are small and
+# copied on every node (ALL), so no join of the fact table
+# redistributes rows, and the fact table is spread evenly
+# (EVEN) as its join keys are skewed (e.g. popular songs).
+#
+# The encodings follow the advice of encoding_advisor.py:
+# AZ64 for the numbers and the timestamps, BYTEDICT for the
+# strings with few distinct values, ZSTD for the others, and
+# RAW for the sort keys (a compressed sort key makes range-
+# restricted scans read more blocks).
+#===========================================================
+
+# The encodings and the distribution styles that can be declared
+ENCODINGS   = ["RAW", "AZ64", "ZSTD", "BYTEDICT", "RUNLENGTH"]
+DISTSTYLES  = ["KEY", "ALL", "EVEN", "AUTO"]
+
+
+def column(name, sql_type, encode, not_null=False, distkey=False, sortkey=False, identity=None,
+           source=None, references=None):
+    """
+    Returns the spec of a column as a dict (see the header of this module).
+    """
+    if encode not in ENCODINGS:
+        raise ValueError("Unsupported encoding \'{}\'".format(encode))
+    return {'name': name, 'type': sql_type, 'encode': encode, 'not_null': not_null,
+            'distkey': distkey, 'sortkey': sortkey, 'identity': identity, 'source': source,
+            'references': references}
+
+
+#===========================================================
+# STAGING TABLES
+#===========================================================
+staging_events = {'name': 'staging_events', 'columns': [
+    column('artist',           'VARCHAR',      'ZSTD'),
+    column('auth',             'VARCHAR',      'BYTEDICT'),
+    column('firstName',        'VARCHAR',      'ZSTD'),
+    column('gender',           'CHAR(1)',      'BYTEDICT'),
+    column('itemInSession',    'INTEGER',      'AZ64'),
+    column('lastName',         'VARCHAR',      'ZSTD'),
+    column('length',           'DECIMAL',      'AZ64'),
+    column('level',            'VARCHAR',      'BYTEDICT'),
+    column('location',         'VARCHAR',      'ZSTD'),
+    column('method',           'CHAR(6)',      'BYTEDICT'),
+    column('page',             'VARCHAR',      'BYTEDICT'),
+    column('registration',     'DECIMAL',      'AZ64'),
+    column('sessionId',        'INTEGER',      'AZ64'),
+    column('song',             'VARCHAR',      'ZSTD'),
+    column('status',           'INTEGER',      'AZ64'),
+    column('ts',               'TIMESTAMP',    'AZ64'),
+    column('userAgent',        'VARCHAR',      'ZSTD'),
+    column('userId',           'INTEGER',      'AZ64'),
+]}
+
+staging_songs = {'name': 'staging_songs', 'columns': [
+    column('artist_id',        'VARCHAR(18)',  'ZSTD'),
+    column('artist_latitude',  'DECIMAL(9,6)', 'AZ64'),
+    column('artist_location',  'VARCHAR',      'ZSTD'),
+    column('artist_longitude', 'DECIMAL(9,6)', 'AZ64'),
+    column('artist_name',      'VARCHAR',      'ZSTD'),
+    column('duration',         'DECIMAL',      'AZ64'),
+    column('num_songs',        'INTEGER',      'AZ64'),
+    column('song_id',          'VARCHAR(18)',  'ZSTD', not_null=True),
+    column('title',            'VARCHAR',      'ZSTD'),
+    column('year',             'INTEGER',      'AZ64'),
+]}
+
+
+#===========================================================
+# MATCH KEY TABLES
+#
+# The NextSong events and the songs keyed by a 64-bit hash of
+# their normalized title and artist name (see the normalize
+# queries of sql_queries.py). Both are distributed and sorted
+# on the key, so the songplay join is collocated on every
+# slice and can run as a merge join.
+#===========================================================
+staging_event_keys = {'name': 'staging_event_keys', 'diststyle': 'KEY', 'columns': [
+    column('match_key',        'BIGINT',       'RAW',  not_null=True, distkey=True, sortkey=True),
+    column('ts',               'TIMESTAMP',    'AZ64'),
+    column('userId',           'INTEGER',      'AZ64'),
+    column('level',            'VARCHAR',      'BYTEDICT'),
+    column('sessionId',        'INTEGER',      'AZ64'),
+    column('location',         'VARCHAR',      'ZSTD'),
+    column('userAgent',        'VARCHAR',      'ZSTD'),
+]}
+
+staging_song_keys = {'name': 'staging_song_keys', 'diststyle': 'KEY', 'columns': [
+    column('match_key',        'BIGINT',       'RAW',  not_null=True, distkey=True, sortkey=True),
+    column('song_id',          'VARCHAR(18)',  'ZSTD', not_null=True),
+    column('artist_id',        'VARCHAR(18)',  'ZSTD'),
+]}
+
+
+#===========================================================
+# STAR TABLES
+#===========================================================
+factSongPlay = {'name': 'factSongPlay', 'diststyle': 'EVEN', 'columns': [
+    column('songplay_id',      'INTEGER',      'AZ64', identity='0,1'),
+    column('start_time',       'TIMESTAMP',    'RAW',  not_null=True, sortkey=True, source='staging_events.ts'),
+    column('time_key',         'TIMESTAMP',    'AZ64', not_null=True, source='staging_events.ts',
+           references='dimTime.start_time'),
+    column('user_id',          'INTEGER',      'AZ64', not_null=True, source='staging_events.userId',
+           references='dimUser.user_id'),
+    column('level',            'VARCHAR',      'BYTEDICT', source='staging_events.level'),
+    column('song_id',          'VARCHAR(18)',  'ZSTD', not_null=True, source='staging_songs.song_id',
+           references='dimSong.song_id'),
+    column('artist_id',        'VARCHAR(18)',  'ZSTD', not_null=True, source='staging_songs.artist_id',
+           references='dimArtist.artist_id'),
+    column('session_id',       'INTEGER',      'AZ64', not_null=True, source='staging_events.sessionId'),
+    column('location',         'VARCHAR',      'ZSTD', source='staging_events.location'),
+    column('user_agent',       'VARCHAR',      'ZSTD', source='staging_events.userAgent'),
+]}
+
+dimSong = {'name': 'dimSong', 'diststyle': 'ALL', 'columns': [
+    column('song_id',          'VARCHAR(18)',  'RAW',  not_null=True, sortkey=True, source='staging_songs.song_id'),
+    column('title',            'VARCHAR',      'ZSTD', not_null=True, source='staging_songs.title'),
+    column('artist_id',        'VARCHAR(18)',  'ZSTD', not_null=True, source='staging_songs.artist_id'),
+    column('year',             'INTEGER',      'AZ64', not_null=True, source='staging_songs.year'),
+    column('duration',         'DECIMAL',      'AZ64', not_null=True, source='staging_songs.duration'),
+]}
+
+dimArtist = {'name': 'dimArtist', 'diststyle': 'ALL', 'columns': [
+    column('artist_id',        'VARCHAR(18)',  'RAW',  not_null=True, sortkey=True, source='staging_songs.artist_id'),
+    column('artist_name',      'VARCHAR',      'ZSTD', not_null=True, source='staging_songs.artist_name'),
+    column('artist_location',  'VARCHAR',      'ZSTD', source='staging_songs.artist_location'),
+    column('artist_latitude',  'DECIMAL(9,6)', 'AZ64', source='staging_songs.artist_latitude'),
+    column('artist_longitude', 'DECIMAL(9,6)', 'AZ64', source='staging_songs.artist_longitude'),
+]}
+
+dimUser = {'name': 'dimUser', 'diststyle': 'ALL', 'columns': [
+    column('user_id',          'INTEGER',      'RAW',  not_null=True, sortkey=True, source='staging_events.userId'),
+    column('first_name',       'VARCHAR',      'ZSTD', not_null=True, source='staging_events.firstName'),
+    column('last_name',        'VARCHAR',      'ZSTD', not_null=True, source='staging_events.lastName'),
+    column('gender',           'CHAR(1)',      'BYTEDICT', not_null=True, source='staging_events.gender'),
+    column('level',            'VARCHAR',      'BYTEDICT', not_null=True, source='staging_events.level'),
+]}
+
+dimTime = {'name': 'dimTime', 'diststyle': 'ALL', 'grain': 'hour', 'columns': [
+    column('start_time',       'TIMESTAMP',    'RAW',  not_null=True, sortkey=True, source='staging_events.ts'),
+    column('hour',             'INTEGER',      'AZ64'),
+    column('day',              'INTEGER',      'AZ64'),
+    column('week',             'INTEGER',      'AZ64'),
+    column('month',            'INTEGER',      'AZ64'),
+    column('year',             'INTEGER',      'AZ64'),
+    column('weekday',          'INTEGER',      'AZ64'),
+]}
+
+
+#===========================================================
+# ROLLUP TABLES
+#
+# The songplays pre-aggregated for the dashboards (see
+# rollups.py): per hour and user level, per day and song, and
+# per user session. Each is refreshed with the fact table for
+# the hours, days or sessions touched by the new events only.
+#===========================================================
+aggPlaysHourly = {'name': 'aggPlaysHourly', 'diststyle': 'ALL', 'columns': [
+    column('hour_start',       'TIMESTAMP',    'RAW',  not_null=True, sortkey=True),
+    column('level',            'VARCHAR',      'BYTEDICT'),
+    column('plays',            'BIGINT',       'AZ64', not_null=True),
+    column('users',            'BIGINT',       'AZ64', not_null=True),
+]}
+
+aggPlaysBySong = {'name': 'aggPlaysBySong', 'diststyle': 'EVEN', 'columns': [
+    column('play_date',        'DATE',         'RAW',  not_null=True, sortkey=True),
+    column('song_id',          'VARCHAR(18)',  'ZSTD', not_null=True),
+    column('artist_id',        'VARCHAR(18)',  'ZSTD', not_null=True),
+    column('plays',            'BIGINT',       'AZ64', not_null=True),
+]}
+
+aggUserSessions = {'name': 'aggUserSessions', 'diststyle': 'EVEN', 'columns': [
+    column('user_id',          'INTEGER',      'AZ64', not_null=True),
+    column('session_id',       'INTEGER',      'AZ64', not_null=True),
+    column('session_start',    'TIMESTAMP',    'RAW',  not_null=True, sortkey=True),
+    column('session_end',      'TIMESTAMP',    'AZ64', not_null=True),
+    column('plays',            'BIGINT',       'AZ64', not_null=True),
+    column('paid_plays',       'BIGINT',       'AZ64', not_null=True),
+]}
+
+
+#===========================================================
+# TABLE LISTS
+#===========================================================
+staging_tables = [staging_events, staging_songs]
+
+match_tables = [staging_event_keys, staging_song_keys]
+
+star_tables = [factSongPlay, dimUser, dimSong, dimArtist, dimTime]
+
+rollup_tables = [aggPlaysHourly, aggPlaysBySong, aggUserSessions]
+
+tables = {table['name']: table for table in staging_tables + match_tables + star_tables + rollup_tables}
+
+
+#===========================================================
+# DDL GENERATION
+#===========================================================
+def column_definition(spec):
+    """
+    Returns the definition of a column in a CREATE TABLE statement, e.g.
+    'song_id VARCHAR(18) ENCODE ZSTD NOT NULL DISTKEY'.
+    """
+    parts = ["{:<16} {:<12}".format(spec['name'], spec['type'])]
+    if spec['identity']:
+        parts.append("IDENTITY({})".format(spec['identity']))
+    parts.append("ENCODE {:<8}".format(spec['encode']))
+    if spec['not_null']:
+        parts.append("NOT NULL")
+    if spec['distkey']:
+        parts.append("DISTKEY")
+    if spec['sortkey']:
+        parts.append("SORTKEY")
+    return " ".join(parts).rstrip()
+
+
+def create_table_query(table):
+    """
+    Generates the CREATE TABLE statement of a table spec.
+
+    Args:
+      table (dict): a table spec, e.g. 'schema.factSongPlay'.
+    Returns:
+      query (str): the statement, e.g. 'CREATE TABLE IF NOT EXISTS ...'.
+    """
+    diststyle = table.get('diststyle')
+    distkeys = [spec['name'] for spec in table['columns'] if spec['distkey']]
+    if diststyle is not None and diststyle not in DISTSTYLES:
+        raise ValueError("Unsupported distribution style \'{}\'".format(diststyle))
+    if (diststyle == "KEY") != (len(distkeys) == 1) or len(distkeys) > 1:
+        raise ValueError("The table \'{}\' must have one DISTKEY column with DISTSTYLE KEY, "
+                         "and none otherwise".format(table['name']))
+    lines = ",\n".join("    " + column_definition(spec) for spec in table['columns'])
+    suffix = "\nDISTSTYLE {}".format(diststyle) if diststyle not in (None, "KEY") else ""
+    return "CREATE TABLE IF NOT EXISTS {} (\n{}\n){};\n".format(table['name'], lines, suffix)
+
+
+def with_distribution(table, diststyle, distkey=None):
+    """
+    Returns a copy of a table spec with another distribution style, e.g.
+    'with_distribution(dimUser, "ALL")' or
+    'with_distribution(factSongPlay, "KEY", "user_id")'.
+    """
+    columns = [dict(spec, distkey=(spec['name'] == distkey)) for spec in table['columns']]
+    return dict(table, diststyle=diststyle, columns=columns)
@@ -0,0 +1,207 @@
+import configparser
+import threading
+import time
+from collections import Counter
+
+# GLOBAL VARIABLES
+CONFIG_FILE = 'myDWH.cfg'   # The default configuration file
+api_calls   = Counter()     # Debug counter of the AWS API round-trips per call name
+
+_settings   = {}            # The loaded settings, one per configuration file
+_lock       = threading.Lock()
+_session    = None          # The boto3 session shared by the scripts, created on first use
+_clients    = {}            # The boto3 service clients created from '_session'
+_aws_lock   = threading.Lock()
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+class Settings:
+    """
+    The parameters of the 'myDWH.cfg' configuration file, read once from disk.
+
+    Values are accessed with the same section/option pairs as ConfigParser,
+    e.g. 'get_settings().get("CLUSTER", "CLUSTER_NAME")'.
+    """
+    def __init__(self, path=CONFIG_FILE):
+        self.path = path
+        self.reload()
+
+    def reload(self):
+        """
+        Re-reads the configuration file from disk.
+        """
+        self._config = configparser.ConfigParser()
+        self._config.read(self.path)
+
+    def get(self, section, option, **kwargs):
+        return self._config.get(section, option, **kwargs)
+
+    def getint(self, section, option, **kwargs):
+        return self._config.getint(section, option, **kwargs)
+
+    def getfloat(self, section, option, **kwargs):
+        return self._config.getfloat(section, option, **kwargs)
+
+    def getboolean(self, section, option, **kwargs):
+        return self._config.getboolean(section, option, **kwargs)
+
+    def has_option(self, section, option):
+        return self._config.has_option(section, option)
+
+    def set(self, section, option, value):
+        """
+        Overrides a value in memory only (the configuration file is unchanged).
+        """
+        if not self._config.has_section(section):
+            self._config.add_section(section)
+        self._config.set(section, option, str(value))
+
+
+def get_settings(path=CONFIG_FILE):
+    """
+    Returns the Settings object of a configuration file, loading it on first use.
+
+    Args:
+      path (str): the path of the configuration file (default='myDWH.cfg').
+    Returns:
+      settings (Settings): the shared settings object.
+    """
+    with _lock:
+        if path not in _settings:
+            _settings[path] = Settings(path)
+        return _settings[path]
+
+
+def get_session():
+    """
+    Returns the boto3 session created from the 'myDWH.cfg' credentials.
+
+    The session is created once per process and boto3 is only imported then,
+    so a run that never calls AWS (e.g. on the local backend) does not pay for
+    its import.
+    """
+    global _session
+    with _aws_lock:
+        if _session is None:
+            import boto3
+            config = get_settings()
+            _session = boto3.session.Session(region_name           = config.get('AWS','AWS_REGION'),
+                                             aws_access_key_id     = config.get('USR','USR_KEY'),
+                                             aws_secret_access_key = config.get('USR','USR_SECRET'))
+        return _session
+
+
+def get_client(service):
+    """
+    Returns the boto3 client of a service (e.g. 'redshift') created from the
+    shared session. The client is created once and reused by the subsequent
+    calls.
+    """
+    session = get_session()
+    with _aws_lock:
+        if service not in _clients:
+            _clients[service] = session.client(service)
+        return _clients[service]
+
+
+def client_error():
+    """
+    Returns the exception class of a failed AWS API call, i.e.
+    'botocore.exceptions.ClientError'. botocore is only imported once an
+    error is being handled, e.g. 'except client_error() as ce:'.
+    """
+    from botocore.exceptions import ClientError
+    return ClientError
+
+
+def reset_session():
+    """
+    Forgets the shared session and its clients (e.g. in a forked worker
+    process, which must create its own).
+    """
+    global _session
+    with _aws_lock:
+        _session = None
+        _clients.clear()
+
+
+class ClusterMetadataCache:
+    """
+    A time-bounded cache of the 'describe_clusters' properties of a cluster.
+
+    The endpoint, the role ARN and the status of a cluster are served from the
+    cache until its time-to-live expires or until 'invalidate()' is called.
+    Every call to the AWS API is counted in 'api_calls'.
+    """
+    def __init__(self, ttl=300):
+        """
+        Args:
+          ttl (float): the time-to-live of a cache entry in seconds.
+        """
+        self.ttl = ttl
+        self._entries = {}
+        self._lock = threading.Lock()
+
+    def describe(self, rs_client, cluster_name):
+        """
+        Returns the properties of a cluster as returned by 'describe_clusters'.
+
+        Args:
+          rs_client (boto3.client): a boto3 client for Redshift.
+          cluster_name (str): the identifier of the cluster.
+        Returns:
+          cluster_props (dict): the properties of the cluster.
+        Raises:
+          botocore.exceptions.ClientError: if the cluster cannot be described.
+        """
+        with self._lock:
+            entry = self._entries.get(cluster_name)
+            if entry is not None and time.monotonic() - entry[0] < self.ttl:
+                return entry[1]
+            api_calls['describe_clusters'] += 1
+            cluster_props = rs_client.describe_clusters(ClusterIdentifier=cluster_name)['Clusters'][0]
+            self._entries[cluster_name] = (time.monotonic(), cluster_props)
+            return cluster_props
+
+    def endpoint(self, rs_client, cluster_name):
+        """
+        Returns the endpoint address of a cluster.
+        """
+        return self.describe(rs_client, cluster_name)['Endpoint']['Address']
+
+    def role_arn(self, rs_client, cluster_name):
+        """
+        Returns the first IAM role ARN attached to a cluster.
+        """
+        return self.describe(rs_client, cluster_name)['IamRoles'][0]['IamRoleArn']
+
+    def status(self, rs_client, cluster_name):
+        """
+        Returns the status of a cluster (e.g. 'available').
+        """
+        return self.describe(rs_client, cluster_name)['ClusterStatus']
+
+    def invalidate(self, cluster_name=None):
+        """
+        Drops the cached properties of a cluster, or of all clusters if None.
+        """
+        with self._lock:
+            if cluster_name is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(cluster_name, None)
+
+
+# The cluster metadata cache shared by all the scripts
+cluster_cache = ClusterMetadataCache(
+    ttl=get_settings().getfloat("ETL", "CLUSTER_CACHE_TTL", fallback=300))
+
+
+def print_api_calls():
+    """
+    Prints the debug counter of the AWS API round-trips.
+    """
+    total = sum(api_calls.values())
+    print("AWS API calls: {} ({})".format(total, ", ".join(
+        "{}={}".format(name, count) for (name, count) in sorted(api_calls.items())) or "-"))
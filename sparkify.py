@@ -0,0 +1,228 @@
+import argparse
+import importlib
+import os
+import re
+import subprocess
+import sys
+import time
+
+# Taken when this module is imported: the origin of the startup figures
+START = time.perf_counter()
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The stages in pipeline order, and the stages run by 'all'
+STAGES     = ['provision', 'schema', 'load', 'maintain', 'teardown']
+ALL_STAGES = ['provision', 'schema', 'load']
+
+# The module entry points profiled by 'imports'
+PROFILED_MODULES = ['settings', 'create_cluster', 'create_tables', 'etl', 'maintenance', 'delete_cluster']
+
+# A line of 'python -X importtime': self and cumulative times in us, name
+IMPORTTIME_PATTERN = re.compile(r"^import time:\s+(\d+)\s+\|\s+(\d+)\s+\|( +)(\S+)\s*$")
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+class Pipeline:
+    """
+    Runs the stages of one invocation on shared resources.
+
+    The stage modules are imported on first use only, so that a stage never
+    pays for the dependencies of another one (e.g. 'teardown' never imports
+    psycopg2). All the stages use the boto3 session of 'settings.get_session()'
+    and a single warehouse connection, opened on first use.
+    """
+    def __init__(self, args):
+        self.args = args
+        self.conn = None
+        self.dsn = None
+        self.snapshot = None
+        self.import_times = {}
+        self.stage_times = []
+
+    def import_module(self, name):
+        """
+        Imports a module and records the time of its first import.
+        """
+        start = time.perf_counter()
+        module = importlib.import_module(name)
+        self.import_times.setdefault(name, time.perf_counter() - start)
+        return module
+
+    def connection(self):
+        """
+        Returns the warehouse connection shared by the stages.
+        """
+        if self.conn is None:
+            create_cluster = self.import_module('create_cluster')
+            (self.conn, self.dsn) = create_cluster.connect_warehouse()
+        return self.conn
+
+    def close(self):
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+
+    def provision(self):
+        create_cluster = self.import_module('create_cluster')
+        self.snapshot = create_cluster.provision(self.args.restore)
+        return True
+
+    def schema(self):
+        if self.snapshot:
+            # Dropping the tables would throw the restored data away
+            print("Skipping the schema stage: the tables were restored from \'{}\'.".format(self.snapshot))
+            return True
+        create_tables = self.import_module('create_tables')
+        create_tables.build_schema(self.connection())
+        return True
+
+    def load(self):
+        etl = self.import_module('etl')
+        load_mode = self.args.mode or ("incremental" if self.snapshot else etl.get_load_mode())
+        return etl.run(self.connection(), self.dsn, load_mode, self.args.resume)
+
+    def maintain(self):
+        maintenance = self.import_module('maintenance')
+        return maintenance.run(self.connection(), self.dsn)
+
+    def teardown(self):
+        # The connection must not outlive the cluster
+        self.close()
+        delete_cluster = self.import_module('delete_cluster')
+        delete_cluster.teardown(self.args.snapshot, confirm=not self.args.yes)
+        return True
+
+    def run(self, stages):
+        """
+        Runs stages in order and stops at the first one that fails.
+
+        Returns:
+          True if all the stages succeeded, False otherwise.
+        """
+        ok = True
+        try:
+            for stage in stages:
+                start = time.perf_counter()
+                if VERBOSE > 0:
+                    print("\n===== {} =====".format(stage.upper()))
+                ok = getattr(self, stage)()
+                self.stage_times.append((stage, start, time.perf_counter() - start))
+                if not ok:
+                    print("ERROR: The stage \'{}\' failed.".format(stage))
+                    break
+        finally:
+            self.close()
+        return ok
+
+    def print_timings(self):
+        """
+        Prints the first-import time of each module and the duration of each
+        stage, measured from the import of this module.
+        """
+        print("\nTIMINGS (since start-up):")
+        for (name, seconds) in self.import_times.items():
+            print("\timport {:<20} {:9.3f} s".format(name, seconds))
+        if self.stage_times:
+            print("\t{:<27} {:9.3f} s".format("time to first stage", self.stage_times[0][1] - START))
+        for (stage, _, seconds) in self.stage_times:
+            print("\tstage  {:<20} {:9.3f} s".format(stage, seconds))
+        print("\t{:<27} {:9.3f} s".format("total", time.perf_counter() - START))
+
+
+def importtime(command, cwd=None):
+    """
+    Runs a Python command under '-X importtime' and parses its report.
+
+    Args:
+      command (list): the arguments after 'python -X importtime'.
+      cwd (str): the working directory of the command.
+    Returns:
+      A 2-tuple (wall, imports) where 'wall' is the run time of the process
+      in seconds and 'imports' is a list of (name, depth, self_us, cumulative_us)
+      tuples in report order.
+    """
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, "-X", "importtime"] + command,
+                            cwd=cwd, capture_output=True, text=True)
+    wall = time.perf_counter() - start
+    imports = []
+    for line in result.stderr.splitlines():
+        match = IMPORTTIME_PATTERN.match(line)
+        if match is not None:
+            (self_us, cumulative_us, indent, name) = match.groups()
+            imports.append((name, (len(indent) - 1) // 2, int(self_us), int(cumulative_us)))
+    return (wall, imports)
+
+
+def profile_imports(modules=PROFILED_MODULES, top=5):
+    """
+    Reports the cold start-up cost of the CLI and of each module entry point,
+    each measured in a fresh interpreter with 'python -X importtime'.
+
+    Args:
+      modules (list): the modules to profile.
+      top (int): the number of heaviest direct imports reported per module.
+    """
+    cwd = os.path.dirname(os.path.abspath(__file__))
+    (wall, imports) = importtime([os.path.join(cwd, "sparkify.py"), "--help"], cwd)
+    own = sum(self_us for (_, _, self_us, _) in imports)
+    print("IMPORT PROFILE (python -X importtime, cold interpreter):")
+    print("\t{:<20} wall {:7.3f} s, all imports {:7.3f} s".format("sparkify --help", wall, own / 1e6))
+    for module in modules:
+        (wall, imports) = importtime(["-c", "import " + module], cwd)
+        # The report is in post-order: the children of the module are the
+        # lines since the previous top-level import (e.g. of 'site')
+        positions = [i for (i, imported) in enumerate(imports) if imported[1] == 0]
+        end = max((i for i in positions if imports[i][0] == module), default=len(imports))
+        begin = max((i + 1 for i in positions if i < end), default=0)
+        cumulative = imports[end][3] if end < len(imports) else 0
+        print("\t{:<20} wall {:7.3f} s, import {:7.3f} s".format(module, wall, cumulative / 1e6))
+        children = sorted((imported for imported in imports[begin:end] if imported[1] == 1),
+                          key=lambda imported: imported[3], reverse=True)
+        for (name, _, _, cumulative_us) in children[:top]:
+            print("\t    {:<32} {:7.3f} s".format(name, cumulative_us / 1e6))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(
+        description="Run the stages of the Sparkify pipeline in one process.",
+        epilog="Example: python sparkify.py provision schema load")
+    parser.add_argument("stages", nargs="+", choices=STAGES + ["all", "imports"],
+                        help="the stages to run in order ('all' = provision schema load), or "
+                             "\'imports\' to profile the start-up cost of each entry point")
+    parser.add_argument("--restore", action="store_true",
+                        help="provision: restore the newest compatible final snapshot")
+    mode = parser.add_mutually_exclusive_group()
+    mode.add_argument("--full", dest="mode", action="store_const", const="full",
+                      help="load: reload the whole datasets")
+    mode.add_argument("--incremental", dest="mode", action="store_const", const="incremental",
+                      help="load: only load the log files arrived since the last run")
+    parser.add_argument("--resume", action="store_true",
+                        help="load: resume the last full load, skipping the steps completed with unchanged inputs")
+    parser.add_argument("--snapshot", action="store_true",
+                        help="teardown: take a final snapshot and prune the old ones")
+    parser.add_argument("--yes", action="store_true", help="teardown: do not ask for confirmation")
+    parser.add_argument("--timings", action="store_true",
+                        help="print the import and stage timings at the end")
+    args = parser.parse_args(argv)
+
+    if "imports" in args.stages:
+        profile_imports()
+        return
+    stages = []
+    for stage in args.stages:
+        stages.extend(ALL_STAGES if stage == "all" else [stage])
+
+    pipeline = Pipeline(args)
+    ok = pipeline.run(stages)
+    if args.timings or VERBOSE > 1:
+        pipeline.print_timings()
+    if not ok:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
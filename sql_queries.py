@@ -1,111 +1,46 @@
 #OBSOLETE import configparser
+import schema
+from schema import create_table_query
+from time_dimension import time_key, time_table_query
+from rollups import rollup_insert, rollup_refresh
 
 #===========================================================
 # DROP TABLES QUERIES
 #===========================================================
 staging_events_table_drop = "DROP TABLE IF EXISTS staging_events;"
 staging_songs_table_drop  = "DROP TABLE IF EXISTS staging_songs;"
+staging_event_keys_table_drop = "DROP TABLE IF EXISTS staging_event_keys;"
+staging_song_keys_table_drop  = "DROP TABLE IF EXISTS staging_song_keys;"
 
 songplay_table_drop       = "DROP TABLE IF EXISTS factSongPlay;"
 song_table_drop           = "DROP TABLE IF EXISTS dimSong;"
 artist_table_drop         = "DROP TABLE IF EXISTS dimArtist;"
 user_table_drop           = "DROP TABLE IF EXISTS dimUser;"
 time_table_drop           = "DROP TABLE IF EXISTS dimTime;"
+plays_hourly_table_drop   = "DROP TABLE IF EXISTS aggPlaysHourly;"
+plays_by_song_table_drop  = "DROP TABLE IF EXISTS aggPlaysBySong;"
+user_sessions_table_drop  = "DROP TABLE IF EXISTS aggUserSessions;"
 
 #===========================================================
-# CREATE STAGING TABLES QUERIES
-#===========================================================
-staging_events_table_create = """CREATE TABLE IF NOT EXISTS staging_events (
-    artist           VARCHAR,
-    auth             VARCHAR,
-    firstName        VARCHAR,
-    gender           CHAR(1),
-    itemInSession    INTEGER,
-    lastName         VARCHAR,
-    length           DECIMAL,
-    level            VARCHAR,
-    location         VARCHAR,
-    method           CHAR(6),
-    page             VARCHAR,
-    registration     DECIMAL,
-    sessionId        INTEGER,
-    song             VARCHAR,
-    status           INTEGER,
-    ts               TIMESTAMP,
-    userAgent        VARCHAR,
-    userId           INTEGER
-);
-"""
-
-staging_songs_table_create = """CREATE TABLE IF NOT EXISTS staging_songs (
-    artist_id        VARCHAR(18),  
-    artist_latitude  DECIMAL(9,6),
-    artist_location  VARCHAR,
-    artist_longitude DECIMAL(9,6),
-    artist_name      VARCHAR,
-    duration         DECIMAL,
-    num_songs        INTEGER,
-    song_id          VARCHAR(18) NOT NULL,
-    title            VARCHAR,
-    year             INTEGER 
-);
-"""
-
-
-#===========================================================
-# CREATE STAR TABLES QUERIES
+# CREATE TABLES QUERIES
+#
+# Generated from the declarative schema of schema.py, which
+# declares the compression encoding of every column.
 #===========================================================
+staging_events_table_create = create_table_query(schema.staging_events)
+staging_songs_table_create  = create_table_query(schema.staging_songs)
+staging_event_keys_table_create = create_table_query(schema.staging_event_keys)
+staging_song_keys_table_create  = create_table_query(schema.staging_song_keys)
 
-songplay_table_create = ("""CREATE TABLE IF NOT EXISTS factSongPlay (
-    songplay_id      INTEGER     IDENTITY(0,1),
-    start_time       TIMESTAMP   NOT NULL SORTKEY,
-    user_id          INTEGER     NOT NULL,
-    level            VARCHAR,
-    song_id          VARCHAR(18) NOT NULL DISTKEY,
-    artist_id        VARCHAR(18) NOT NULL,
-    session_id       INTEGER     NOT NULL,
-    location         VARCHAR,
-    user_agent       VARCHAR
-);
-""")
+songplay_table_create       = create_table_query(schema.factSongPlay)
+song_table_create           = create_table_query(schema.dimSong)
+artist_table_create         = create_table_query(schema.dimArtist)
+user_table_create           = create_table_query(schema.dimUser)
+time_table_create           = create_table_query(schema.dimTime)
 
-song_table_create = ("""CREATE TABLE IF NOT EXISTS dimSong (
-    song_id          VARCHAR(18) NOT NULL DISTKEY SORTKEY,
-    title            VARCHAR     NOT NULL,
-    artist_id        VARCHAR(18) NOT NULL,
-    year             INTEGER     NOT NULL,
-    duration         DECIMAL     NOT NULL
-);
-""")
-
-artist_table_create = ("""CREATE TABLE IF NOT EXISTS dimArtist (
-    artist_id        VARCHAR(18)  NOT NULL DISTKEY SORTKEY,
-    artist_name      VARCHAR      NOT NULL,
-    artist_location  VARCHAR,
-    artist_latitude  DECIMAL(9,6),
-    artist_longitude DECIMAL(9,6)
-);
-""")
-
-user_table_create = ("""CREATE TABLE IF NOT EXISTS dimUser (
-    user_id          INTEGER     NOT NULL DISTKEY SORTKEY,
-    first_name       VARCHAR     NOT NULL,
-    last_name        VARCHAR     NOT NULL,
-    gender           CHAR(1)     NOT NULL,
-    level            VARCHAR     NOT NULL
-);
-""")
-
-time_table_create = ("""CREATE TABLE IF NOT EXISTS dimTime (
-    start_time       TIMESTAMP   NOT NULL SORTKEY,
-    hour             INTEGER,
-    day              INTEGER,
-    week             INTEGER,
-    month            INTEGER,
-    year             INTEGER,
-    weekday          INTEGER
-);
-""")
+plays_hourly_table_create   = create_table_query(schema.aggPlaysHourly)
+plays_by_song_table_create  = create_table_query(schema.aggPlaysBySong)
+user_sessions_table_create  = create_table_query(schema.aggUserSessions)
 
 #===========================================================
 # COPY STAGING TABLES QUERIES
@@ -131,31 +66,128 @@ staging_songs_copy = ("""
     JSON 'auto';
 """)
 
+# Same as above but the FROM clause names a COPY manifest that
+# lists the input files (see manifest.py)
+staging_events_copy_manifest = ("""
+COPY staging_events FROM {} 
+    credentials 'aws_iam_role={}'
+    region {}
+    TIMEFORMAT AS 'epochmillisecs'
+    JSON {}
+    MANIFEST;
+""")
+
+staging_songs_copy_manifest = ("""
+    COPY staging_songs FROM {} 
+    credentials 'aws_iam_role={}'
+    region {}
+    JSON 'auto'
+    MANIFEST;
+""")
+
+# Loads the song dataset once compacted into large compressed
+# JSON-lines files (see compaction.py). The last placeholder is
+# the compression option: GZIP or ZSTD.
+staging_songs_copy_compacted = ("""
+    COPY staging_songs FROM {} 
+    credentials 'aws_iam_role={}'
+    region {}
+    JSON 'auto'
+    {};
+""")
+
+# Loads the staging tables from typed Parquet files (see
+# parquet_staging.py). The Parquet columns match the columns
+# of the staging tables by position. The bucket must be in the
+# same region as the cluster.
+staging_events_copy_parquet = ("""
+COPY staging_events FROM {} 
+    credentials 'aws_iam_role={}'
+    FORMAT AS PARQUET;
+""")
+
+staging_songs_copy_parquet = ("""
+    COPY staging_songs FROM {} 
+    credentials 'aws_iam_role={}'
+    FORMAT AS PARQUET;
+""")
+
+
+#===========================================================
+# NORMALIZE QUERIES
+#
+# An event is matched to a song on a 64-bit hash of the title
+# and the artist name, lower-cased and stripped of spaces and
+# punctuation: 'Let It Be ' by 'the Beatles' matches 'let it
+# be' by 'The Beatles.'. The key is computed once per row of
+# each staging table, into tables distributed on it (see
+# schema.py), so the songplay join compares two BIGINTs on the
+# same slice rather than redistributing unbounded VARCHARs.
+# A song title that is listed under several song ids keeps the
+# smallest one, so each event matches at most one song.
+#===========================================================
+match_key = ("FNV_HASH(REGEXP_REPLACE(LOWER({0}), '[[:space:][:punct:]]+', '') || '|' || "
+             "REGEXP_REPLACE(LOWER({1}), '[[:space:][:punct:]]+', ''))")
+
+staging_event_keys_insert = ("""
+INSERT INTO staging_event_keys (match_key, ts, userId, level, sessionId, location, userAgent)
+    SELECT
+        {} AS match_key,
+        ts,
+        userId,
+        level,
+        sessionId,
+        location,
+        userAgent
+    FROM
+        staging_events
+    WHERE
+        page = 'NextSong' AND song IS NOT NULL AND artist IS NOT NULL;
+""").format(match_key.format("song", "artist"))
+
+staging_song_keys_insert = ("""
+INSERT INTO staging_song_keys (match_key, song_id, artist_id)
+    SELECT match_key, song_id, artist_id
+    FROM
+        (SELECT
+            match_key,
+            song_id,
+            artist_id,
+            ROW_NUMBER() OVER (PARTITION BY match_key ORDER BY song_id) AS match_key_ranked
+        FROM
+            (SELECT
+                {} AS match_key,
+                song_id,
+                artist_id
+            FROM
+                staging_songs
+            WHERE title IS NOT NULL AND artist_name IS NOT NULL) AS song_keys) AS ranked_song_keys
+    WHERE match_key_ranked = 1;
+""").format(match_key.format("title", "artist_name"))
+
 
 #===========================================================
 # INSERT QUERY LISTS - Avoid Duplicates
 #===========================================================
 songplay_table_insert = ("""
-INSERT INTO factSongplay (start_time, user_id, level, song_id, artist_id,
+INSERT INTO factSongplay (start_time, time_key, user_id, level, song_id, artist_id,
                           session_id,  location, user_agent)
-    SELECT DISTINCT
-        staging_events.ts        AS start_time,
-        staging_events.userId    AS user_id,
-        staging_events.level     AS level,
-        staging_songs.song_id    AS song_id,
-        staging_songs.artist_id  As artist_id,
-        staging_events.sessionId AS session_id,
-        staging_events.location  AS location,
-        staging_events.userAgent AS user_agent
+    SELECT
+        staging_event_keys.ts        AS start_time,
+        {}   AS time_key,
+        staging_event_keys.userId    AS user_id,
+        staging_event_keys.level     AS level,
+        staging_song_keys.song_id    AS song_id,
+        staging_song_keys.artist_id  AS artist_id,
+        staging_event_keys.sessionId AS session_id,
+        staging_event_keys.location  AS location,
+        staging_event_keys.userAgent AS user_agent
     FROM
-        staging_events
-    JOIN staging_songs
-        ON staging_events.song   = staging_songs.title AND 
-           staging_events.artist = staging_songs.artist_name        
-    WHERE
-        staging_events.page   = 'NextSong'
+        staging_event_keys
+    JOIN staging_song_keys
+        ON staging_event_keys.match_key = staging_song_keys.match_key
     ;
-""")
+""").format(time_key("staging_event_keys.ts"))
 
 user_table_insert = ("""
 INSERT INTO dimUser (user_id, first_name, last_name, gender, level)
@@ -202,42 +234,126 @@ artist_table_insert = ("""
             staging_songs;
 """)
 
-time_table_insert = ("""
-    INSERT INTO dimTime (start_time, hour, day, week, month, year, weekday)
-        SELECT
-            ts                         AS start_time,
-            EXTRACT(hour      FROM ts) AS hour,
-            EXTRACT(day       FROM ts) AS day,
-            EXTRACT(week      FROM ts) AS week,
-            EXTRACT(month     FROM ts) AS month,
-            EXTRACT(year      FROM ts) AS year,
-            EXTRACT(dayofweek FROM ts) AS weekday
+# One row per distinct time key at the grain of schema.py (see time_dimension.py)
+time_table_insert = time_table_query()
+
+
+#===========================================================
+# ROLLUP QUERIES
+#
+# The rollups are aggregated from factSongPlay (see rollups.py).
+# A full load builds them from the whole fact table. An
+# incremental load refreshes the hours, days and sessions of
+# the merged events only.
+#===========================================================
+plays_hourly_table_insert  = rollup_insert("aggPlaysHourly")
+plays_by_song_table_insert = rollup_insert("aggPlaysBySong")
+user_sessions_table_insert = rollup_insert("aggUserSessions")
+
+rollup_table_merges = (rollup_refresh("aggPlaysHourly") +
+                       rollup_refresh("aggPlaysBySong") +
+                       rollup_refresh("aggUserSessions"))
+
+
+#===========================================================
+# INCREMENTAL MERGE QUERIES
+#
+# Used by the incremental load mode (see incremental.py). The
+# staging_events table only holds the newly arrived log files
+# and the merge only touches the rows affected by them. All the
+# statements can run inside a single transaction.
+#===========================================================
+staging_events_clear = "DELETE FROM staging_events;"
+staging_songs_clear  = "DELETE FROM staging_songs;"
+staging_event_keys_clear = "DELETE FROM staging_event_keys;"
+staging_song_keys_clear  = "DELETE FROM staging_song_keys;"
+
+time_table_merge = time_table_query(merge=True)
+
+user_table_merge_delete = ("""
+    DELETE FROM dimUser
+    USING
+        (SELECT DISTINCT userid FROM staging_events WHERE userid IS NOT NULL) AS new_users
+    WHERE dimUser.user_id = new_users.userid;
+""")
+
+user_table_merge_insert = ("""
+INSERT INTO dimUser (user_id, first_name, last_name, gender, level)
+    SELECT
+        userid    AS user_id,
+        firstname AS first_name,
+        lastname  AS last_name,
+        gender    AS gender,
+        level     AS level
     FROM
-        staging_events
-    WHERE ts IS NOT NULL;    
+        (SELECT
+            userid,
+            firstname,
+            lastname,
+            gender,
+            level,
+            ROW_NUMBER() OVER (PARTITION BY userid ORDER BY ts DESC) AS userid_ranked
+        FROM
+            staging_events
+        WHERE userid IS NOT NULL) AS latest_users
+    WHERE userid_ranked=1;
 """)
 
+songplay_table_merge = ("""
+INSERT INTO factSongplay (start_time, time_key, user_id, level, song_id, artist_id,
+                          session_id,  location, user_agent)
+    SELECT
+        staging_event_keys.ts        AS start_time,
+        {}   AS time_key,
+        staging_event_keys.userId    AS user_id,
+        staging_event_keys.level     AS level,
+        staging_song_keys.song_id    AS song_id,
+        staging_song_keys.artist_id  AS artist_id,
+        staging_event_keys.sessionId AS session_id,
+        staging_event_keys.location  AS location,
+        staging_event_keys.userAgent AS user_agent
+    FROM
+        staging_event_keys
+    JOIN staging_song_keys
+        ON staging_event_keys.match_key = staging_song_keys.match_key
+    WHERE
+        NOT EXISTS
+            (SELECT 1 FROM factSongPlay
+             WHERE factSongPlay.start_time = staging_event_keys.ts
+               AND factSongPlay.user_id    = staging_event_keys.userId
+               AND factSongPlay.session_id = staging_event_keys.sessionId)
+    ;
+""").format(time_key("staging_event_keys.ts"))
+
 
 #===========================================================
 # DROP QUERY LISTS
 #===========================================================
 drop_table_queries = [staging_events_table_drop, 
                       staging_songs_table_drop,
+                      staging_event_keys_table_drop,
+                      staging_song_keys_table_drop,
                       songplay_table_drop, user_table_drop, song_table_drop,
-                      artist_table_drop, time_table_drop]
+                      artist_table_drop, time_table_drop,
+                      plays_hourly_table_drop, plays_by_song_table_drop, user_sessions_table_drop]
 
 
 #===========================================================
 # CREATE QUERY LISTS
 #===========================================================
 create_staging_table_queries = [staging_events_table_create,
-                                staging_songs_table_create]
+                                staging_songs_table_create,
+                                staging_event_keys_table_create,
+                                staging_song_keys_table_create]
 
 create_star_table_queries = [songplay_table_create, 
                              user_table_create, 
                              song_table_create, 
                              artist_table_create, 
-                             time_table_create]
+                             time_table_create,
+                             plays_hourly_table_create,
+                             plays_by_song_table_create,
+                             user_sessions_table_create]
 
 
 #===========================================================
@@ -246,12 +362,96 @@ create_star_table_queries = [songplay_table_create,
 copy_table_queries = [staging_events_copy,
                       staging_songs_copy]
 
+copy_manifest_queries = {"staging_events": staging_events_copy_manifest,
+                         "staging_songs" : staging_songs_copy_manifest}
+
+copy_parquet_queries  = {"staging_events": staging_events_copy_parquet,
+                         "staging_songs" : staging_songs_copy_parquet}
+
 #===========================================================
 # INSERT QUERY LISTS
 #===========================================================
-insert_table_queries = [artist_table_insert,
+insert_table_queries = [staging_event_keys_insert,
+                        staging_song_keys_insert,
+                        artist_table_insert,
                         song_table_insert,
                         time_table_insert,
                         user_table_insert,
-                        songplay_table_insert]
+                        songplay_table_insert,
+                        plays_hourly_table_insert,
+                        plays_by_song_table_insert,
+                        user_sessions_table_insert]
+
 
+#===========================================================
+# INSERT QUERY GRAPH
+#
+# Declares the tables read and written by each INSERT query so
+# that independent queries can be scheduled in parallel (see
+# scheduler.py). A node depends on every node that writes a
+# table it reads, and on the nodes listed in 'after' which is
+# used for logical dependencies not visible in the SQL text.
+# The 'cost' is a relative estimate used for the critical path.
+#===========================================================
+insert_table_graph = [
+    {"name"  : "staging_event_keys",
+     "query" : staging_event_keys_insert,
+     "reads" : ["staging_events"],
+     "writes": ["staging_event_keys"],
+     "cost"  : 1},
+    {"name"  : "staging_song_keys",
+     "query" : staging_song_keys_insert,
+     "reads" : ["staging_songs"],
+     "writes": ["staging_song_keys"],
+     "cost"  : 1},
+    {"name"  : "dimArtist",
+     "query" : artist_table_insert,
+     "reads" : ["staging_songs"],
+     "writes": ["dimArtist"],
+     "cost"  : 1},
+    {"name"  : "dimSong",
+     "query" : song_table_insert,
+     "reads" : ["staging_songs"],
+     "writes": ["dimSong"],
+     "cost"  : 1},
+    {"name"  : "dimTime",
+     "query" : time_table_insert,
+     "reads" : ["staging_events"],
+     "writes": ["dimTime"],
+     "cost"  : 2},
+    {"name"  : "dimUser",
+     "query" : user_table_insert,
+     "reads" : ["staging_events"],
+     "writes": ["dimUser"],
+     "cost"  : 1},
+    {"name"  : "factSongPlay",
+     "query" : songplay_table_insert,
+     "reads" : ["staging_event_keys", "staging_song_keys"],
+     "writes": ["factSongPlay"],
+     "after" : ["dimArtist", "dimSong", "dimTime", "dimUser"],
+     "cost"  : 3},
+    {"name"  : "aggPlaysHourly",
+     "query" : plays_hourly_table_insert,
+     "reads" : ["factSongPlay"],
+     "writes": ["aggPlaysHourly"],
+     "cost"  : 1},
+    {"name"  : "aggPlaysBySong",
+     "query" : plays_by_song_table_insert,
+     "reads" : ["factSongPlay"],
+     "writes": ["aggPlaysBySong"],
+     "cost"  : 1},
+    {"name"  : "aggUserSessions",
+     "query" : user_sessions_table_insert,
+     "reads" : ["factSongPlay"],
+     "writes": ["aggUserSessions"],
+     "cost"  : 1},
+]
+
+#===========================================================
+# MERGE QUERY LISTS
+#===========================================================
+merge_table_queries = [staging_event_keys_insert,
+                       time_table_merge,
+                       user_table_merge_delete,
+                       user_table_merge_insert,
+                       songplay_table_merge] + rollup_table_merges
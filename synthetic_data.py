@@ -0,0 +1,223 @@
+import argparse
+import bisect
+import itertools
+import json
+import os
+import random
+import string
+from datetime import datetime, timezone
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# Sizes of the dataset at scale factor 1
+SONGS_PER_SCALE  = 2000
+USERS_PER_SCALE  = 100
+EVENTS_PER_SCALE = 8000
+DAYS             = 30
+
+# Shape of the activity log
+NEXTSONG_RATIO   = 0.82   # Share of the events that are song plays
+LOGGED_OUT_RATIO = 0.03   # Share of the events with a NULL (empty) userId
+UNKNOWN_RATIO    = 0.20   # Share of the song plays absent from song_data
+PAID_RATIO       = 0.25   # Share of the users with a paid level
+
+# The columns of 'staging_events' in table order, as listed by the jsonpaths
+LOG_COLUMNS = ["artist", "auth", "firstName", "gender", "itemInSession",
+               "lastName", "length", "level", "location", "method", "page",
+               "registration", "sessionId", "song", "status", "ts",
+               "userAgent", "userId"]
+
+OTHER_PAGES = ["Home", "Logout", "Settings", "Add to Playlist", "Thumbs Up",
+               "Thumbs Down", "Downgrade", "Upgrade", "Help", "About"]
+LOCATIONS   = ["San Francisco-Oakland-Hayward, CA", "Phoenix-Mesa-Scottsdale, AZ",
+               "New York-Newark-Jersey City, NY-NJ-PA", "Atlanta-Sandy Springs-Roswell, GA",
+               "Chicago-Naperville-Elgin, IL-IN-WI", "Memphis, TN"]
+USER_AGENTS = ["\"Mozilla/5.0 (Windows NT 6.1; WOW64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/36.0.1985.143 Safari/537.36\"",
+               "\"Mozilla/5.0 (Macintosh; Intel Mac OS X 10_9_4) AppleWebKit/537.78.2 (KHTML, like Gecko) Version/7.0.6 Safari/537.78.2\"",
+               "Mozilla/5.0 (X11; Ubuntu; Linux x86_64; rv:31.0) Gecko/20100101 Firefox/31.0"]
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+class ZipfSampler:
+    """
+    Draws the indices 0..n-1 with a Zipf-like skew (index 0 is the most popular).
+    """
+    def __init__(self, n, exponent, rng):
+        weights = [1.0 / (rank ** exponent) for rank in range(1, n + 1)]
+        self._cumulative = list(itertools.accumulate(weights))
+        self._rng = rng
+
+    def sample(self):
+        return bisect.bisect_left(self._cumulative, self._rng.random() * self._cumulative[-1])
+
+
+def _random_id(rng, prefix, length=16):
+    return prefix + "".join(rng.choice(string.ascii_uppercase + string.digits) for _ in range(length))
+
+
+def generate_songs(rng, count):
+    """
+    Returns a list of song records shaped like the files of 'song_data'.
+    """
+    artists = []
+    for i in range(max(1, count // 3)):
+        has_location = rng.random() < 0.6
+        artists.append({"artist_id": _random_id(rng, "AR"),
+                        "artist_name": "Artist {}".format(i),
+                        "artist_location": rng.choice(LOCATIONS) if has_location else "",
+                        "artist_latitude": round(rng.uniform(25, 48), 5) if has_location else None,
+                        "artist_longitude": round(rng.uniform(-122, -70), 5) if has_location else None})
+    songs = []
+    for i in range(count):
+        artist = rng.choice(artists)
+        song = {"num_songs": 1}
+        song.update(artist)
+        song.update({"song_id": _random_id(rng, "SO"),
+                     "title": "Song {}".format(i),
+                     "duration": round(rng.uniform(60, 600), 5),
+                     "year": rng.choice([0] + list(range(1960, 2011)))})
+        songs.append(song)
+    return songs
+
+
+def write_song_data(directory, songs, rng):
+    """
+    Writes one JSON file per song under 'song_data/X/Y/Z/TR....json'.
+    """
+    for song in songs:
+        track_id = _random_id(rng, "TR")
+        path = os.path.join(directory, "song_data", track_id[2], track_id[3], track_id[4])
+        os.makedirs(path, exist_ok=True)
+        with open(os.path.join(path, track_id + ".json"), "w") as f:
+            json.dump(song, f)
+
+
+def generate_events(rng, songs, users, count, start, days):
+    """
+    Yields log events with popular songs, heavy users, a 'NextSong' page ratio
+    and logged-out events with an empty userId. The events are ordered by time.
+    """
+    song_sampler = ZipfSampler(len(songs), 1.1, rng)
+    user_sampler = ZipfSampler(len(users), 0.9, rng)
+    step_ms = days * 24 * 3600 * 1000 // max(1, count)
+    ts = int(start.timestamp() * 1000)
+    sessions = {}
+    for _ in range(count):
+        ts += rng.randint(1, 2 * step_ms)
+        user = users[user_sampler.sample()]
+        session = sessions.setdefault(user['userId'], [rng.randint(1, 10 ** 4), 0])
+        if rng.random() < 0.02:
+            session[0] += 1
+            session[1] = 0
+        session[1] += 1
+        logged_out = rng.random() < LOGGED_OUT_RATIO
+        event = {"artist": None, "auth": "Logged Out" if logged_out else "Logged In",
+                 "firstName": None if logged_out else user['firstName'],
+                 "gender": None if logged_out else user['gender'],
+                 "itemInSession": session[1],
+                 "lastName": None if logged_out else user['lastName'],
+                 "length": None, "level": user['level'],
+                 "location": None if logged_out else user['location'],
+                 "method": "GET", "page": rng.choice(OTHER_PAGES),
+                 "registration": None if logged_out else user['registration'],
+                 "sessionId": session[0], "song": None, "status": 200, "ts": ts,
+                 "userAgent": None if logged_out else user['userAgent'],
+                 "userId": "" if logged_out else str(user['userId'])}
+        if not logged_out and rng.random() < NEXTSONG_RATIO:
+            if rng.random() < UNKNOWN_RATIO:
+                (artist, title, length) = ("Unknown {}".format(rng.randint(1, 10 ** 5)),
+                                           "Unknown song {}".format(rng.randint(1, 10 ** 5)),
+                                           round(rng.uniform(60, 600), 5))
+            else:
+                song = songs[song_sampler.sample()]
+                (artist, title, length) = (song['artist_name'], song['title'], song['duration'])
+            event.update({"artist": artist, "song": title, "length": length,
+                          "method": "PUT", "page": "NextSong"})
+        yield event
+
+
+def generate_users(rng, count):
+    """
+    Returns a list of user profiles.
+    """
+    users = []
+    for i in range(count):
+        users.append({"userId": i + 1,
+                      "firstName": "First{}".format(i), "lastName": "Last{}".format(i),
+                      "gender": rng.choice("FM"),
+                      "level": "paid" if rng.random() < PAID_RATIO else "free",
+                      "location": rng.choice(LOCATIONS),
+                      "registration": float(1540000000000 + rng.randint(0, 10 ** 9)),
+                      "userAgent": rng.choice(USER_AGENTS)})
+    return users
+
+
+def write_log_data(directory, events):
+    """
+    Writes the events as newline-delimited JSON, one file per day under
+    'log_data/YYYY/MM/YYYY-MM-DD-events.json'.
+    """
+    handles = {}
+    try:
+        for event in events:
+            day = datetime.fromtimestamp(event['ts'] / 1000, tz=timezone.utc)
+            key = day.strftime("%Y/%m/%Y-%m-%d-events.json")
+            if key not in handles:
+                path = os.path.join(directory, "log_data", key)
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+                handles[key] = open(path, "w")
+            handles[key].write(json.dumps(event) + "\n")
+    finally:
+        for handle in handles.values():
+            handle.close()
+
+
+def write_jsonpaths(directory):
+    """
+    Writes the 'log_json_path.json' file matching the log events.
+    """
+    with open(os.path.join(directory, "log_json_path.json"), "w") as f:
+        json.dump({"jsonpaths": ["$['{}']".format(column) for column in LOG_COLUMNS]}, f, indent=4)
+
+
+def generate(directory, scale=1.0, seed=42, start=datetime(2018, 11, 1, tzinfo=timezone.utc), days=DAYS):
+    """
+    Writes a synthetic Sparkify dataset that mirrors the layout of the S3
+    bucket: 'song_data/', 'log_data/' and 'log_json_path.json'.
+
+    Args:
+      directory (str): the output directory.
+      scale (float): the scale factor (1 = 2000 songs, 100 users, 8000 events).
+      seed (int): the seed of the random generator (same seed, same data).
+      start (datetime): the time of the first event.
+      days (int): the number of days covered by the log.
+    Returns:
+      counts (dict): the number of songs, users and events written.
+    """
+    rng = random.Random(seed)
+    songs = generate_songs(rng, max(1, int(SONGS_PER_SCALE * scale)))
+    users = generate_users(rng, max(1, int(USERS_PER_SCALE * scale)))
+    events = max(1, int(EVENTS_PER_SCALE * scale))
+    os.makedirs(directory, exist_ok=True)
+    write_song_data(directory, songs, rng)
+    write_log_data(directory, generate_events(rng, songs, users, events, start, days))
+    write_jsonpaths(directory)
+    counts = {"songs": len(songs), "users": len(users), "events": events}
+    if VERBOSE:
+        print("Generated scale factor {} in \'{}\': {}".format(scale, directory, counts))
+    return counts
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Generate a synthetic Sparkify dataset.")
+    parser.add_argument("--scale", type=float, default=1.0, help="scale factor (default=1)")
+    parser.add_argument("--seed", type=int, default=42, help="random seed (default=42)")
+    parser.add_argument("--out", default="data", help="output directory (default=data)")
+    args = parser.parse_args(argv)
+    generate(args.out, args.scale, args.seed)
+
+
+if __name__ == "__main__":
+    main()
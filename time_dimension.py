@@ -0,0 +1,198 @@
+import argparse
+import os
+import statistics
+import time
+
+import schema
+from schema import create_table_query
+
+#  Set verbosity to 0|1|2 (default=0)
+VERBOSE = 1
+
+# The grains of the time dimension, finest first. The attributes of 'dimTime'
+# stop at the hour, so a finer grain only adds rows.
+GRAINS = ["second", "minute", "hour", "day"]
+
+# The time dimension as it was built before the grain was declared: one row
+# per staging event, with duplicates. Only kept for the benchmark.
+PER_EVENT_QUERY = """
+INSERT INTO {} (start_time, hour, day, week, month, year, weekday)
+    SELECT
+        ts                         AS start_time,
+        EXTRACT(hour      FROM ts) AS hour,
+        EXTRACT(day       FROM ts) AS day,
+        EXTRACT(week      FROM ts) AS week,
+        EXTRACT(month     FROM ts) AS month,
+        EXTRACT(year      FROM ts) AS year,
+        EXTRACT(dayofweek FROM ts) AS weekday
+    FROM
+        staging_events
+    WHERE ts IS NOT NULL;
+"""
+
+# An analyst query: the songplays per weekday and hour
+JOIN_QUERY = """
+SELECT {0}.weekday, {0}.hour, COUNT(*)
+FROM bench_songplays JOIN {0} ON bench_songplays.{1} = {0}.start_time
+GROUP BY {0}.weekday, {0}.hour;
+"""
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def get_grain():
+    """
+    Returns the grain of 'dimTime' declared in schema.py, e.g. 'hour'.
+    """
+    grain = schema.dimTime['grain']
+    if grain not in GRAINS:
+        raise ValueError("Unsupported time grain \'{}\'".format(grain))
+    return grain
+
+
+def time_key(column, grain=None):
+    """
+    Returns the SQL expression of the time key of a timestamp column, e.g.
+    "DATE_TRUNC('hour', ts)".
+    """
+    return "DATE_TRUNC(\'{}\', {})".format(grain or get_grain(), column)
+
+
+def truncate(value, grain=None):
+    """
+    Truncates a datetime to a grain, as 'time_key()' does in SQL.
+    """
+    if value is None:
+        return None
+    grain = grain or get_grain()
+    fields = {"second": {'microsecond': 0},
+              "minute": {'microsecond': 0, 'second': 0},
+              "hour"  : {'microsecond': 0, 'second': 0, 'minute': 0},
+              "day"   : {'microsecond': 0, 'second': 0, 'minute': 0, 'hour': 0}}
+    return value.replace(**fields[grain])
+
+
+def time_table_query(grain=None, merge=False, table="dimTime"):
+    """
+    Generates the INSERT of the time dimension.
+
+    The distinct time keys of the staging events are computed first, then all
+    the attributes of each key in a single pass. With 'merge', the keys
+    already in the table are skipped, so that each incremental load only adds
+    the new ones.
+
+    Args:
+      grain (str): one of 'GRAINS'. Defaults to the grain of schema.py.
+      merge (bool): if True, only insert the keys missing from the table.
+      table (str): the table to fill (default='dimTime').
+    Returns:
+      query (str): the INSERT statement.
+    """
+    where = ""
+    if merge:
+        where = ("\n        WHERE NOT EXISTS"
+                 "\n            (SELECT 1 FROM {0} WHERE {0}.start_time = time_keys.start_time)").format(table)
+    return ("""
+    INSERT INTO {0} (start_time, hour, day, week, month, year, weekday)
+        SELECT
+            start_time,
+            EXTRACT(hour      FROM start_time) AS hour,
+            EXTRACT(day       FROM start_time) AS day,
+            EXTRACT(week      FROM start_time) AS week,
+            EXTRACT(month     FROM start_time) AS month,
+            EXTRACT(year      FROM start_time) AS year,
+            EXTRACT(dayofweek FROM start_time) AS weekday
+        FROM
+            (SELECT DISTINCT {1} AS start_time FROM staging_events WHERE ts IS NOT NULL) AS time_keys{2};
+""").format(table, time_key("ts", grain), where)
+
+
+################## THIS IS A LINE OF 80 CHARACTERS ############################
+
+def _timed(cur, query):
+    start = time.perf_counter()
+    cur.execute(query)
+    return time.perf_counter() - start
+
+
+def benchmark_scale(data_dir, repeat=3):
+    """
+    Builds the time dimension at each grain, and the per-event version, from
+    a local dataset, and times a songplays-per-hour join on each.
+
+    Returns:
+      A dict of {variant: result} where 'result' holds the keys 'rows',
+      'build_s' and 'join_s' (medians) and 'join_rows', the number of
+      songplays counted by the join ('per_event' counts the duplicates).
+    """
+    import etl
+    import local_engine
+    from benchmark import use_local_dataset
+    from sql_queries import copy_table_queries, songplay_table_insert
+    from sql_queries import staging_event_keys_insert, staging_song_keys_insert
+    from sql_queries import drop_table_queries, create_star_table_queries
+    from projection import create_staging_queries
+
+    use_local_dataset(data_dir)
+    conn = local_engine.connect(data_dir, ":memory:")
+    cur = conn.cursor()
+    for query in drop_table_queries + create_staging_queries() + create_star_table_queries:
+        cur.execute(query)
+    for query in copy_table_queries:
+        cur.execute(etl.format_copy_query(query))
+    for query in (staging_event_keys_insert, staging_song_keys_insert, songplay_table_insert):
+        cur.execute(query)
+    # The songplays with their time key at every grain
+    cur.execute("CREATE TABLE bench_songplays AS SELECT start_time AS per_event, {} FROM factSongPlay;".format(
+        ", ".join("{} AS {}".format(time_key("start_time", grain), grain) for grain in GRAINS)))
+
+    variants = [("per_event", lambda table: PER_EVENT_QUERY.format(table))]
+    variants += [(grain, lambda table, grain=grain: time_table_query(grain, table=table)) for grain in GRAINS]
+    results = {}
+    for (name, build_query) in variants:
+        table = "bench_dimTime_{}".format(name)
+        (builds, joins) = ([], [])
+        for _ in range(repeat):
+            cur.execute("DROP TABLE IF EXISTS {};".format(table))
+            cur.execute(create_table_query(dict(schema.dimTime, name=table)))
+            builds.append(_timed(cur, build_query(table)))
+            joins.append(_timed(cur, JOIN_QUERY.format(table, name)))
+            join_rows = sum(row[2] for row in cur.fetchall())
+        cur.execute("SELECT COUNT(*) FROM {};".format(table))
+        results[name] = {'rows': cur.fetchone()[0], 'build_s': statistics.median(builds),
+                         'join_s': statistics.median(joins), 'join_rows': join_rows}
+    conn.close()
+    return results
+
+
+def print_benchmark(scale, results):
+    print("SCALE FACTOR {} (dimTime grain in schema.py: {}):".format(scale, get_grain()))
+    print("\t{:<10} {:>10} {:>8} {:>11} {:>11} {:>12}".format(
+        "variant", "rows", "shrink", "build", "join", "songplays"))
+    per_event = results['per_event']['rows']
+    for (name, result) in results.items():
+        print("\t{:<10} {:>10} {:>7.0f}x {:9.4f} s {:9.4f} s {:>12}".format(
+            name, result['rows'], per_event / max(result['rows'], 1), result['build_s'], result['join_s'],
+            result['join_rows']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the grains of the time dimension on the local backend.")
+    parser.add_argument("--scales", type=float, nargs="+", default=[1, 5, 25],
+                        help="scale factors of the synthetic data (default=1 5 25)")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per variant, the median is kept (default=3)")
+    parser.add_argument("--seed", type=int, default=42, help="seed of the synthetic data (default=42)")
+    parser.add_argument("--data-root", default=os.path.join(".etl_state", "bench_data"),
+                        help="where the synthetic datasets are generated and reused")
+    args = parser.parse_args(argv)
+
+    import synthetic_data
+    for scale in args.scales:
+        data_dir = os.path.join(args.data_root, "sf_{}_seed_{}".format(scale, args.seed))
+        if not os.path.isdir(data_dir):
+            synthetic_data.generate(data_dir, scale, args.seed)
+        print_benchmark(scale, benchmark_scale(data_dir, args.repeat))
+
+
+if __name__ == "__main__":
+    main()